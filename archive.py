@@ -0,0 +1,387 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary columnar archive of data points.
+
+Each segment (one per month by default) is made of three files, one per
+column, holding fixed-width native values:
+    archive.<segment>.time         unsigned 32 bit seconds since EPOCH
+    archive.<segment>.power        signed 32 bit watts
+    archive.<segment>.temperature  64 bit float degrees Celsius
+Rows are sorted by time within a segment, so that ArchiveReader can find a
+time range with a binary search on the memory-mapped time column.
+"""
+
+import os, sys, time, array, mmap, struct, bisect
+
+from parser import DataPoint
+from data_save import DataSaver
+
+COLUMNS = (
+    # name, array type code, struct format
+    ('time', 'I', '=I'),
+    ('power', 'i', '=i'),
+    ('temperature', 'd', '=d'),
+    )
+
+for _name, _typecode, _format in COLUMNS:
+    assert array.array(_typecode).itemsize == struct.calcsize(_format)
+
+FILE_NAME_TEMPLATE = "archive.%s.%s"
+
+def _column_path(directory, segment, column):
+    return os.path.join(directory, FILE_NAME_TEMPLATE % (segment, column))
+
+class ArchiveDataSaver(DataSaver):
+    # segments are named after the UTC time of their data
+    SEGMENT_TEMPLATE = "%Y-%m"
+
+    def __init__(self, directory, batch_size=100):
+        """
+        Data points are written by batches of batch_size, and on flush() and
+        close().
+        """
+        self._directory = os.path.abspath(directory)
+        print "Archive: will save in", self._directory
+        self._batch_size = batch_size
+        self._segment = None
+        self._files = None
+        self._last_time = None
+        self._pending = None
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+    def _open_segment(self, segment):
+        self._close_segment()
+        print >> sys.stderr, "Archive: now writing segment", segment
+        paths = [_column_path(self._directory, segment, name)
+                 for name, typecode, format in COLUMNS]
+        length = 0
+        if all(os.path.exists(path) for path in paths):
+            length = min(os.path.getsize(path) // struct.calcsize(format)
+                         for path, (name, typecode, format)
+                         in zip(paths, COLUMNS))
+
+        self._segment = segment
+        self._files = []
+        self._pending = []
+        for path, (name, typecode, format) in zip(paths, COLUMNS):
+            column_file = open(path, "ab")
+            # we may have been killed in the middle of a write
+            column_file.truncate(length * struct.calcsize(format))
+            self._files.append(column_file)
+            self._pending.append(array.array(typecode))
+
+        self._last_time = None
+        if length > 0:
+            time_format = COLUMNS[0][2]
+            size = struct.calcsize(time_format)
+            time_file = open(paths[0], "rb")
+            try:
+                time_file.seek((length - 1) * size)
+                self._last_time = struct.unpack(time_format,
+                                                time_file.read(size))[0]
+            finally:
+                time_file.close()
+
+    def _close_segment(self):
+        if self._files is None:
+            return
+        self.flush()
+        for column_file in self._files:
+            column_file.close()
+        self._files = None
+        self._pending = None
+        self._segment = None
+
+    def update(self, data_point):
+        assert(isinstance(data_point.time, (int, long)))
+        segment = time.strftime(self.SEGMENT_TEMPLATE,
+                                time.gmtime(data_point.time))
+        if segment != self._segment:
+            self._open_segment(segment)
+
+        if self._last_time is not None and data_point.time <= self._last_time:
+            if data_point.time < self._last_time:
+                # would break the ordering of the time column
+                print >> sys.stderr, "Archive: ignoring out of order", data_point
+            # else already saved, e.g. replayed from a spool
+            return
+        self._last_time = data_point.time
+
+        times, powers, temperatures = self._pending
+        times.append(data_point.time)
+        powers.append(data_point.power)
+        temperatures.append(data_point.temperature)
+        if len(times) >= self._batch_size:
+            self.flush()
+
+    def update_many(self, batch):
+        if not len(batch):
+            return
+        times = batch.times
+        first, last = times[0], times[-1]
+        segment = time.strftime(self.SEGMENT_TEMPLATE, time.gmtime(first))
+        if (segment != time.strftime(self.SEGMENT_TEMPLATE, time.gmtime(last))
+                or any(times[i] >= times[i + 1] for i in xrange(len(times) - 1))):
+            # spans several segments or needs the ordering checks
+            DataSaver.update_many(self, batch)
+            return
+
+        if segment != self._segment:
+            self._open_segment(segment)
+        if self._last_time is not None and first <= self._last_time:
+            DataSaver.update_many(self, batch)
+            return
+        self._last_time = last
+
+        pending_times, powers, temperatures = self._pending
+        # arrays only extend arrays of the same type
+        pending_times.fromlist(times.tolist())
+        powers.fromlist(batch.powers.tolist())
+        temperatures.fromlist(batch.temperatures.tolist())
+        if len(pending_times) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._files is None:
+            return
+        for column_file, pending in zip(self._files, self._pending):
+            pending.tofile(column_file)
+            column_file.flush()
+            del pending[:]
+
+    def backfill(self, intervals, device=None, temperature=None):
+        """
+        The segments that get data points are rewritten with them in time
+        order.
+        """
+        import history
+        self.flush()
+        reader = ArchiveReader(self._directory)
+        try:
+            def held(start, end):
+                rows = []
+                for columns in reader.query(start, end):
+                    rows.extend(zip(*columns))
+                return rows
+            batch = history.missing_points(intervals, held,
+                                           temperature=temperature)
+        finally:
+            reader.close()
+        segments = {}
+        for row in zip(batch.times, batch.powers, batch.temperatures):
+            segment = time.strftime(self.SEGMENT_TEMPLATE, time.gmtime(row[0]))
+            segments.setdefault(segment, []).append(row)
+        for segment, rows in sorted(segments.iteritems()):
+            if segment == self._segment:
+                # reopened with the new rows on the next update
+                self._close_segment()
+            self._insert(segment, rows)
+
+    def _insert(self, segment, rows):
+        paths = [_column_path(self._directory, segment, name)
+                 for name, typecode, format in COLUMNS]
+        columns = []
+        for path, (name, typecode, format) in zip(paths, COLUMNS):
+            column = array.array(typecode)
+            if os.path.exists(path):
+                column_file = open(path, "rb")
+                try:
+                    column.fromstring(column_file.read())
+                finally:
+                    column_file.close()
+            columns.append(column)
+        # as in _open_segment(), a killed write may have left more of a column
+        length = min(len(column) for column in columns)
+        times = columns[0]
+        positions = [bisect.bisect_right(times, row[0], 0, length)
+                     for row in rows]
+        for index, (path, column) in enumerate(zip(paths, columns)):
+            merged = array.array(column.typecode)
+            previous = 0
+            for position, row in zip(positions, rows):
+                merged.extend(column[previous:position])
+                merged.append(row[index])
+                previous = position
+            merged.extend(column[previous:length])
+            column_file = open(path + ".tmp", "wb")
+            try:
+                merged.tofile(column_file)
+                column_file.flush()
+                os.fsync(column_file.fileno())
+            finally:
+                column_file.close()
+        # all the columns are written before any of them replaces the old one
+        for path in paths:
+            os.rename(path + ".tmp", path)
+
+    def close(self):
+        self._close_segment()
+
+
+class ColumnView(object):
+    """
+    Read-only sequence of the values of a column, read directly from a memory
+    map without copying. Slicing returns another ColumnView.
+    """
+    def __init__(self, buffer, typecode, format, start, stop):
+        self._buffer = buffer
+        self._typecode = typecode
+        self._format = format
+        self._item_size = struct.calcsize(format)
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("ColumnView does not support steps")
+            return ColumnView(self._buffer, self._typecode, self._format,
+                              self._start + start,
+                              self._start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ColumnView index out of range")
+        return struct.unpack_from(self._format, self._buffer,
+                                  (self._start + index) * self._item_size)[0]
+
+    def __iter__(self):
+        # by chunks, copying a bit at a time
+        CHUNK = 4096
+        for chunk_start in xrange(self._start, self._stop, CHUNK):
+            chunk_stop = min(chunk_start + CHUNK, self._stop)
+            for value in array.array(self._typecode, self._buffer[
+                    chunk_start * self._item_size:chunk_stop * self._item_size]):
+                yield value
+
+    def to_array(self):
+        return array.array(self._typecode, self._buffer[
+                self._start * self._item_size:self._stop * self._item_size])
+
+
+class ArchiveSegment(object):
+    def __init__(self, directory, name):
+        self.name = name
+        self._files = []
+        self._maps = []
+        sizes = []
+        for column, typecode, format in COLUMNS:
+            column_file = open(_column_path(directory, name, column), "rb")
+            self._files.append(column_file)
+            sizes.append(os.fstat(column_file.fileno()).st_size
+                         // struct.calcsize(format))
+        self.size = os.fstat(self._files[0].fileno()).st_size
+        # columns may differ in length if we got killed while writing
+        self.length = min(sizes)
+        self.columns = []
+        for column_file, (column, typecode, format) in zip(self._files,
+                                                           COLUMNS):
+            if self.length > 0:
+                column_map = mmap.mmap(column_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                self._maps.append(column_map)
+            else:
+                column_map = ''
+            self.columns.append(ColumnView(column_map, typecode, format,
+                                           0, self.length))
+
+    def range(self, start, end):
+        """
+        Return the time, power and temperature ColumnViews of the rows with
+        start <= time < end.
+        """
+        times = self.columns[0]
+        first = bisect.bisect_left(times, start)
+        last = bisect.bisect_left(times, end, first)
+        return tuple(column[first:last] for column in self.columns)
+
+    def close(self):
+        for column_map in self._maps:
+            column_map.close()
+        for column_file in self._files:
+            column_file.close()
+        self._maps = []
+        self._files = []
+
+
+class ArchiveReader(object):
+    """
+    Reads what ArchiveDataSaver wrote in directory.
+    """
+    def __init__(self, directory):
+        self._directory = os.path.abspath(directory)
+        self._segments = {}
+
+    def segment_names(self):
+        prefix, suffix = FILE_NAME_TEMPLATE.split("%s")[0], ".time"
+        names = []
+        for file_name in os.listdir(self._directory):
+            if file_name.startswith(prefix) and file_name.endswith(suffix):
+                names.append(file_name[len(prefix):-len(suffix)])
+        return sorted(names)
+
+    def _segment(self, name):
+        segment = self._segments.get(name)
+        time_path = _column_path(self._directory, name, 'time')
+        if segment is not None and segment.size != os.path.getsize(time_path):
+            # it was written to since we mapped it
+            segment.close()
+            segment = None
+        if segment is None:
+            segment = ArchiveSegment(self._directory, name)
+            self._segments[name] = segment
+        return segment
+
+    def query(self, start, end):
+        """
+        Yield, for each segment with data in [start, end[ and in time order, a
+        tuple of time, power and temperature ColumnViews.
+        """
+        # segment names sort like their times
+        template = ArchiveDataSaver.SEGMENT_TEMPLATE
+        first = time.strftime(template, time.gmtime(start))
+        last = time.strftime(template, time.gmtime(max(start, end - 1)))
+        for name in self.segment_names():
+            if first <= name <= last:
+                columns = self._segment(name).range(start, end)
+                if len(columns[0]):
+                    yield columns
+
+    def data_points(self, start, end):
+        for times, powers, temperatures in self.query(start, end):
+            for row in zip(times, powers, temperatures):
+                yield DataPoint(*row)
+
+    def close(self):
+        for segment in self._segments.itervalues():
+            segment.close()
+        self._segments = {}
+
+if __name__ == '__main__':
+    # print the CSV of the data between two times, in seconds since EPOCH
+    directory, start, end = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    reader = ArchiveReader(directory)
+    for data_point in reader.data_points(start, end):
+        print data_point.to_csv()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the CC128 parsers: messages per second, and peak RSS
+while parsing all the messages with how much it grew per message, for the
+BeautifulSoup parser and the streaming one.
+
+Usage: benchmarks/bench_parser.py [number of messages]
+"""
+
+import os, sys, time, gc, resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import parser
+
+MESSAGE_TEMPLATE = ("<msg><src>CC128-v0.11</src><dsb>00089</dsb>"
+        "<time>13:%02d:%02d</time><tmpr>%.1f</tmpr><sensor>0</sensor>"
+        "<id>00077</id><type>1</type><ch1><watts>%05d</watts></ch1></msg>\r\n")
+
+HIST_MESSAGE = ("<msg><src>CC128-v0.11</src><dsb>00089</dsb>"
+        "<time>13:02:39</time><hist><dsw>00032</dsw><type>1</type>"
+        "<units>kwhr</units><data><sensor>0</sensor><h024>001.1</h024>"
+        "<h022>000.9</h022></data></hist></msg>\r\n")
+
+def make_lines(count):
+    lines = []
+    for i in xrange(count):
+        if i % 100 == 99:
+            lines.append(HIST_MESSAGE)
+        else:
+            lines.append(MESSAGE_TEMPLATE % (i / 60 % 60, i % 60,
+                                             18 + (i % 50) / 10.,
+                                             300 + i % 1000))
+    return lines
+
+def run(parser_class, lines):
+    _parser = parser_class()
+    count = 0
+    for line in lines:
+        for data_point in _parser.parse_msg(line):
+            count += 1
+    return count
+
+def measure_speed(parser_class, lines):
+    gc.collect()
+    start = time.time()
+    count = run(parser_class, lines)
+    elapsed = time.time() - start
+    return count, count / elapsed
+
+def _parse_all(parser_class, lines, result_pipe):
+    _parser = parser_class()
+    # warm up imports and caches so that we only measure the parsing
+    for data_point in _parser.parse_msg(lines[0]):
+        pass
+    gc.collect()
+    # ru_maxrss is in KiB on Linux
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kept, as the savers would
+    data_points = []
+    for line in lines:
+        data_points.extend(_parser.parse_msg(line))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_pipe.send((peak_rss, peak_rss - start_rss))
+    result_pipe.close()
+
+def measure_memory(parser_class, lines):
+    """
+    Return the peak RSS of a process parsing lines, in KiB, and how much it
+    grew while parsing, per message, in bytes. Every parser runs in its own
+    process, so that peak RSS is its own.
+    """
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_parse_all,
+                                      args=(parser_class, lines, sender))
+    process.start()
+    sender.close()
+    peak_rss, growth = receiver.recv()
+    process.join()
+    return peak_rss, growth * 1024. / len(lines)
+
+PARSERS = (
+    ("bs4", parser.CC128Parser),
+    ("stream", parser.CC128StreamParser),
+    )
+
+if __name__ == '__main__':
+    message_count = 5000
+    if len(sys.argv) > 1:
+        message_count = int(sys.argv[1])
+    lines = make_lines(message_count)
+
+    print "%d lines (1%% history messages)" % message_count
+    for name, parser_class in PARSERS:
+        count, rate = measure_speed(parser_class, lines)
+        peak_rss, per_message = measure_memory(parser_class, lines)
+        print ("%-8s %6d data points, %9.1f msg/s, peak RSS %d KiB, "
+               "%.0f bytes per msg" % (name, count, rate, peak_rss,
+                                       per_message))
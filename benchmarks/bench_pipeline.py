@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End to end benchmark of CucoLogger: messages from the simulator (or a
+capture) go through the parser and the savers, for each parser and saver
+combination. Reported are the messages per second (closing the savers
+included), the per-message latency percentiles (from the moment the message
+is read to the moment all savers got it) and the peak RSS. Every combination
+runs in its own process, so that peak RSS is its own.
+
+Usage: benchmarks/bench_pipeline.py [-n MESSAGES] [-c CAPTURE] [-o OUTPUT_DIR]
+"""
+
+import os, sys, time, gc, shutil, tempfile, resource, argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import cucologger, simulator
+
+def _have_rrdtool():
+    try:
+        import rrdtool
+    except ImportError:
+        return False
+    return True
+
+def saver_combinations(directory):
+    """
+    Return (name, savers configuration) tuples, the savers writing in
+    subdirectories of directory.
+    """
+    def where(name):
+        return os.path.join(directory, name)
+    combinations = [
+        ("csv", {"CsvDataSaver": {"directory": where("csv"),
+                                  "queue": False}}),
+        ("csv-bz2", {"CsvDataSaver": {"directory": where("csv-bz2"),
+                                      "compress": True, "queue": False}}),
+        ("csv-queued", {"CsvDataSaver": {"directory": where("csv-queued"),
+                                         "queue": {"size": 1000}}}),
+        ("archive", {"ArchiveDataSaver": {"directory": where("archive"),
+                                          "queue": False}}),
+        ]
+    if _have_rrdtool():
+        combinations.append(("rrd", {"RrdDataSaver": {
+                "directory": where("rrd"), "batch_size": 100,
+                "queue": False}}))
+        combinations.append(("all", {
+                "CsvDataSaver": {"directory": where("all"), "queue": False},
+                "ArchiveDataSaver": {"directory": where("all"),
+                                     "queue": False},
+                "RrdDataSaver": {"directory": where("all"),
+                                 "batch_size": 100, "queue": False}}))
+    return combinations
+
+class SimulatedClockParser(object):
+    """
+    Gives the data points of parser times one period apart: the live parsers
+    use the current time, and at full speed several messages would get the
+    same second, which RRD refuses.
+    """
+    def __init__(self, parser, start, period=6):
+        self._parser = parser
+        self._time = start
+        self._period = period
+
+    def parse_batch(self, data):
+        batch = self._parser.parse_batch(data)
+        for i in xrange(len(batch)):
+            batch.times[i] = self._time
+            self._time += self._period
+        return batch
+
+def timed(messages, latencies):
+    """
+    Yield messages, appending to latencies the time each one took to be
+    processed, that is until the next one was asked for.
+    """
+    for message in messages:
+        start = time.time()
+        yield message
+        latencies.append(time.time() - start)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run_combination(parser_name, savers_config, messages, result_pipe):
+    # keep the savers' chatter out of the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    config = {"parser": parser_name, "savers": savers_config}
+    latencies = []
+    logger = cucologger.CucoLogger(config, timed(messages, latencies))
+    logger._parser = SimulatedClockParser(logger._parser,
+                                          int(time.time()) - 6 * len(messages))
+    gc.collect()
+    start = time.time()
+    logger.run()
+    elapsed = time.time() - start
+    latencies.sort()
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_pipe.send((len(messages) / elapsed,
+                      [percentile(latencies, p) for p in (.5, .9, .99, 1.)],
+                      peak_rss))
+    result_pipe.close()
+
+def measure(parser_name, savers_config, messages):
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=run_combination,
+            args=(parser_name, savers_config, messages, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    return result
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+            description="End to end benchmark of CucoLogger")
+    arg_parser.add_argument("-n", "--messages", type=int, default=20000,
+            help="number of simulated messages")
+    arg_parser.add_argument("-c", "--capture",
+            help="replay this capture instead of simulating")
+    arg_parser.add_argument("-o", "--output-dir",
+            help="where savers write (default: a temporary directory)")
+    args = arg_parser.parse_args()
+
+    if args.capture:
+        messages = list(simulator.ReplaySource(args.capture, speed=0))
+    else:
+        messages = list(simulator.SimulatedCC128(speed=0, count=args.messages,
+                                                 seed=0))
+    base_directory = args.output_dir or tempfile.mkdtemp(prefix="cuco-bench")
+
+    print "%d messages" % len(messages)
+    print "%-8s %-12s %10s %9s %9s %9s %9s %10s" % ("parser", "savers",
+            "msg/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "peak RSS")
+    try:
+        for parser_name in ("stream", "bs4"):
+            directory = os.path.join(base_directory, parser_name)
+            for name, savers_config in saver_combinations(directory):
+                result = measure(parser_name, savers_config, messages)
+                if result is None:
+                    print "%-8s %-12s failed" % (parser_name, name)
+                    continue
+                rate, latencies, peak_rss = result
+                print "%-8s %-12s %10.1f %9.3f %9.3f %9.3f %9.3f %7d KiB" % ((
+                        parser_name, name, rate) +
+                        tuple(latency * 1000 for latency in latencies) +
+                        (peak_rss,))
+                sys.stdout.flush()
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(base_directory)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Backfill the savers of a configuration from CSV files written by
+CsvDataSaver, possibly bz2 compressed, or gzip compressed by maintenance.py:
+
+    bulk_import.py [-j JOBS] [-b BATCH] cucologger.conf power.*.csv*
+
+Files are decompressed and parsed in parallel, and fed to the savers in time
+order. The files waiting to be compressed (.pending) are imported after the
+compressed file of their day, without what a killed compression left of them
+at its end. The rows CsvDataSaver.backfill() estimated from the history
+(.backfill) are not imported: the savers fill the gaps from the history
+themselves.
+"""
+
+import os, sys, time, argparse, multiprocessing
+
+import parser, data_save
+
+def read_csv_file(path):
+    """
+    Return the content of a CSV file written by CsvDataSaver.
+    """
+    if path.endswith('.bz2'):
+        end = None
+        sizes = data_save.killed_append_sizes(path)
+        if sizes is not None:
+            # the rest is in the .pending file it was compressing
+            end = sizes[0]
+        return "".join(data_save.read_bz2_streams(path, end=end))
+    if path.endswith('.gz'):
+        return "".join(data_save.read_gzip_members(path))
+    csv_file = open(path)
+    try:
+        return csv_file.read()
+    finally:
+        csv_file.close()
+
+def load_csv_file(path):
+    """
+    Return the times, powers and temperatures arrays of a CSV file.
+    """
+    return parser.CSVParser().parse_columns(read_csv_file(path))
+
+def load_csv_batch(path):
+    """
+    Return the data points of a CSV file as a DataPointBatch, with their
+    sensors and channels if the file has them.
+    """
+    return parser.CSVParser().parse_batch(read_csv_file(path))
+
+# not CSV data, or already in another file
+SKIPPED_SUFFIXES = (data_save.CsvDataSaver.INDEX_SUFFIX,
+                    data_save.CsvDataSaver.BACKFILL_SUFFIX,
+                    data_save.APPENDING_SUFFIX, ".tmp")
+
+def _sort_key(path):
+    """
+    The name of the file without the compression extension sorts by date.
+    The files of a day come in the order query.py reads them: gzip (merged by
+    maintenance.py), bz2, the files waiting to be compressed in the order they
+    were written, then the file being written.
+    """
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        return (name[:-len('.gz')], 0)
+    if name.endswith('.bz2'):
+        return (name[:-len('.bz2')], 1)
+    if name.endswith(data_save.BackgroundCompressor.PENDING_SUFFIX):
+        base, number = name.rsplit('.', 2)[:2]
+        try:
+            count = int(number.split('-')[-1])
+        except ValueError:
+            count = 0
+        return (base, 2, os.path.getmtime(path), count)
+    return (name, 3)
+
+class BulkImporter(object):
+    def __init__(self, savers, jobs=None, batch_size=10000):
+        self._savers = savers
+        self._jobs = jobs
+        self._batch_size = batch_size
+        self.rows = 0
+
+    def _feed(self, data):
+        for start in xrange(0, len(data), self._batch_size):
+            batch = data[start:start + self._batch_size]
+            for saver in self._savers:
+                saver.update_many(batch)
+
+    def run(self, paths):
+        # power.*.csv* also matches the index files and the others
+        paths = sorted((path for path in paths
+                        if not path.endswith(SKIPPED_SUFFIXES)),
+                       key=_sort_key)
+        pool = multiprocessing.Pool(self._jobs)
+        start_time = time.time()
+        try:
+            # imap keeps the order of the files
+            for path, data in zip(paths, pool.imap(load_csv_batch, paths)):
+                file_start_time = time.time()
+                self._feed(data)
+                self.rows += len(data)
+                elapsed = max(time.time() - start_time, 1e-6)
+                print >> sys.stderr, ("%s: %d rows in %.2fs, total %d rows, "
+                        "%.0f rows/s" % (path, len(data),
+                                         time.time() - file_start_time,
+                                         self.rows, self.rows / elapsed))
+        finally:
+            pool.close()
+            pool.join()
+        return self.rows, time.time() - start_time
+
+if __name__ == '__main__':
+    import json
+    import cucologger
+
+    arg_parser = argparse.ArgumentParser(
+            description="Import CsvDataSaver files into the configured savers")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="number of parsing processes (default: number of CPUs)")
+    arg_parser.add_argument("-b", "--batch-size", type=int, default=10000,
+            help="number of rows given to the savers at a time")
+    arg_parser.add_argument("config", help="CucoLogger configuration file")
+    arg_parser.add_argument("files", nargs="+", help="CSV files to import")
+    args = arg_parser.parse_args()
+
+    config = json.load(open(args.config))
+    # files may have the rows of all the sensors: the savers that do not know
+    # about sensors only get sensor 0
+    savers = [cucologger.make_saver(saver, saver_config, sensors=True)
+              for saver, saver_config in config['savers'].iteritems()
+              if saver != "ThermostatSaver"]
+
+    importer = BulkImporter(savers, args.jobs, args.batch_size)
+    try:
+        rows, elapsed = importer.run(args.files)
+    finally:
+        for saver in savers:
+            saver.close()
+    print >> sys.stderr, "Imported %d rows in %.1fs: %.0f rows/s" % (
+            rows, elapsed, rows / max(elapsed, 1e-6))
@@ -0,0 +1,192 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Swing-door compression of data points: only the points needed to draw the
+signal as straight lines between them, each field staying within its own
+tolerance of every point left out, are kept.
+
+Stored points are never more than max_interval seconds apart, unless there
+was no data in between: Expander draws lines between stored points that are
+at most max_interval seconds apart, putting back one point every period
+seconds or so, and leaves longer gaps alone.
+
+Files holding compressed points start with a header line such as:
+    # swing-door period=6 max_interval=300 power=5 temperature=0.1
+"""
+
+HEADER_PREFIX = "# swing-door "
+
+def format_header(period, max_interval, tolerances):
+    """
+    tolerances is a list of (field name, tolerance) tuples.
+    """
+    return "%speriod=%s max_interval=%s %s\n" % (HEADER_PREFIX, period,
+            max_interval, " ".join("%s=%s" % (name, tolerance)
+                                   for name, tolerance in tolerances))
+
+def is_header(line):
+    return line.startswith(HEADER_PREFIX)
+
+def parse_header(line):
+    """
+    Return an Expander for the data following the header line.
+    """
+    settings = dict(item.split("=", 1)
+                    for item in line[len(HEADER_PREFIX):].split())
+    return Expander(float(settings['period']), int(settings['max_interval']))
+
+class SwingDoorCompressor(object):
+    """
+    Compresses points made of a time stamp and a tuple of values, given in
+    time order. add() and flush() return the points to store.
+    """
+    def __init__(self, tolerances, max_interval=300):
+        self._tolerances = tuple(tolerances)
+        self._max_interval = max_interval
+        self.reset()
+
+    def reset(self):
+        """
+        Start again, as for a new file. The held point is forgotten.
+        """
+        # last stored point
+        self._archive_time = None
+        self._archive = None
+        # last point received, not stored yet
+        self._held_time = None
+        self._held = None
+        # slopes from the archived point that keep all the points since then
+        # within tolerance
+        self._lower = None
+        self._upper = None
+
+    def _start(self, time_stamp, values):
+        self._archive_time = time_stamp
+        self._archive = values
+        self._held_time = self._held = None
+        self._lower = None
+        self._upper = None
+
+    def _open_door(self, time_stamp, values):
+        elapsed = float(time_stamp - self._archive_time)
+        self._lower = [(value - tolerance - archived) / elapsed
+                       for value, tolerance, archived
+                       in zip(values, self._tolerances, self._archive)]
+        self._upper = [(value + tolerance - archived) / elapsed
+                       for value, tolerance, archived
+                       in zip(values, self._tolerances, self._archive)]
+        self._held_time = time_stamp
+        self._held = values
+
+    def _fits(self, time_stamp, values):
+        """
+        Tell whether a line from the archived point to this one stays within
+        tolerance of all the points since then, and narrow the door if so.
+        """
+        elapsed = float(time_stamp - self._archive_time)
+        lower = self._lower
+        upper = self._upper
+        for value, archived, low, high in zip(values, self._archive, lower,
+                                              upper):
+            if not low <= (value - archived) / elapsed <= high:
+                return False
+        for i, (value, tolerance, archived) in enumerate(zip(values,
+                self._tolerances, self._archive)):
+            low = (value - tolerance - archived) / elapsed
+            if low > lower[i]:
+                lower[i] = low
+            high = (value + tolerance - archived) / elapsed
+            if high < upper[i]:
+                upper[i] = high
+        self._held_time = time_stamp
+        self._held = values
+        return True
+
+    def add(self, time_stamp, values):
+        if self._archive_time is None:
+            self._start(time_stamp, values)
+            return [(time_stamp, values)]
+        stored = []
+        if self._held_time is not None:
+            if (time_stamp <= self._held_time
+                    or time_stamp - self._archive_time > self._max_interval):
+                stored.extend(self.flush())
+            elif self._fits(time_stamp, values):
+                return stored
+            else:
+                stored.extend(self.flush())
+        previous_time = self._archive_time
+        if (time_stamp <= previous_time
+                or time_stamp - previous_time > self._max_interval):
+            # out of order, or after a gap: nothing to draw a line from
+            self._start(time_stamp, values)
+            stored.append((time_stamp, values))
+        else:
+            self._open_door(time_stamp, values)
+        return stored
+
+    def flush(self):
+        """
+        Return the held point, if any, which lines are then drawn from.
+        """
+        if self._held_time is None:
+            return []
+        held = self._held_time, self._held
+        self._start(*held)
+        return [held]
+
+class Expander(object):
+    """
+    Puts back the points left out by a SwingDoorCompressor, one every period
+    seconds or so. Integer values stay integers, others are rounded to two
+    decimals.
+    """
+    def __init__(self, period, max_interval):
+        self._period = period
+        self._max_interval = max_interval
+        self._last_time = None
+        self._last = None
+
+    def add(self, time_stamp, values):
+        """
+        Return the points between the previous stored point and this one,
+        followed by this one.
+        """
+        points = []
+        last_time = self._last_time
+        if last_time is not None:
+            elapsed = time_stamp - last_time
+            if 0 < elapsed <= self._max_interval:
+                steps = int(round(elapsed / self._period))
+                last = self._last
+                for step in xrange(1, steps):
+                    fraction = float(step) / steps
+                    point = []
+                    for previous, value in zip(last, values):
+                        interpolated = previous + (value - previous) * fraction
+                        if isinstance(previous, (int, long)) and isinstance(
+                                value, (int, long)):
+                            point.append(int(round(interpolated)))
+                        else:
+                            point.append(round(interpolated, 2))
+                    points.append((last_time + int(round(elapsed * fraction)),
+                                   tuple(point)))
+        points.append((time_stamp, values))
+        self._last_time = time_stamp
+        self._last = values
+        return points
@@ -16,48 +16,766 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import parser, serial_tools, data_save
+import os, sys, time, signal, json, errno, atexit, inspect, threading
+import collections, traceback
+
+# savers and sources, and what they need, are only imported once the
+# configuration is known to use them
+import parser, data_save, metrics, registry
+
+PARSERS = ("stream", "bs4")
 
 class CucoLoggerConfigException(Exception):
     pass
 
+class CucoLoggerAlreadyRunning(Exception):
+    pass
+
+def check_saver_config(saver, saver_config, per_device=False, sensors=False):
+    """
+    Raise CucoLoggerConfigException if saver is unknown or if its generic
+    entries are wrong, without importing it.
+    """
+    try:
+        registry.check_saver(saver)
+    except registry.RegistryError, e:
+        raise CucoLoggerConfigException(str(e))
+    if not isinstance(saver_config, dict):
+        raise CucoLoggerConfigException(
+                "The configuration of %s should be a mapping" % saver)
+    if saver_config.get('device') is not None and not per_device:
+        raise CucoLoggerConfigException(
+                "%s has a device but there are no devices" % saver)
+    if saver_config.get('sensor') is not None and not sensors:
+        raise CucoLoggerConfigException(
+                "%s has a sensor but sensors are not parsed" % saver)
+    queue_config = saver_config.get('queue', {})
+    if queue_config is not False:
+        if not isinstance(queue_config, dict):
+            raise CucoLoggerConfigException(
+                    "The queue of %s should be a mapping or false" % saver)
+        overflow = queue_config.get('overflow', 'block')
+        if overflow not in data_save.QueuedDataSaver.OVERFLOW_POLICIES:
+            raise CucoLoggerConfigException(
+                    "Unknown overflow policy for %s: %s" % (saver, overflow))
+
+def make_saver(saver, saver_config, per_device=False, sensors=False):
+    """
+    Create a saver from its name in the registry and its configuration. The
+    saver runs in its own thread behind a bounded queue, whose "size" and
+    "overflow" policy can be given in a "queue" entry, unless that entry is
+    false.
+
+    With per_device, data comes from several devices: a saver with a
+    "directory" gets one instance per device, writing in a subdirectory named
+    after the device, and a saver with a "device" entry only gets the data of
+    that device. Others get everything.
+
+    With sensors, data points come from all the sensors: a saver with a
+    "sensor" entry only gets the data of that sensor, and savers that do not
+    know about sensors only get the data of sensor 0, the whole house.
+    """
+    check_saver_config(saver, saver_config, per_device, sensors)
+    saver_config = dict(saver_config)
+    device = saver_config.pop('device', None)
+    sensor = saver_config.pop('sensor', None)
+    queue_config = saver_config.pop('queue', {})
+
+    try:
+        constructor = registry.saver_class(saver)
+    except registry.RegistryError, e:
+        raise CucoLoggerConfigException(str(e))
+    if device is not None:
+        instance = data_save.DeviceFilterSaver(constructor(**saver_config),
+                                               device)
+    elif per_device and 'directory' in saver_config:
+        directory = saver_config['directory']
+        def make_device_saver(device):
+            device_config = dict(saver_config,
+                                 directory=os.path.join(directory, device))
+            return constructor(**device_config)
+        instance = data_save.PerDeviceSaver(make_device_saver)
+    else:
+        instance = constructor(**saver_config)
+    if sensors and sensor is None and not getattr(constructor, 'SENSORS',
+                                                  False):
+        sensor = 0
+    if sensor is not None:
+        instance = data_save.SensorFilterSaver(instance, sensor)
+
+    if queue_config is not False:
+        try:
+            instance = data_save.QueuedDataSaver(instance, **queue_config)
+        except (ValueError, TypeError), e:
+            raise CucoLoggerConfigException("Bad queue for %s: %s" % (saver, e))
+    return instance
+
+def saver_resources(saver, saver_config):
+    """
+    Return what a saver made from saver_config would hold on to, as a set of
+    ("directory", absolute path), ("serial", device path) and ("listen",
+    "address:port") tuples, defaults included. A port that is a path is a
+    serial device, a number is listened on if the saver has an address to
+    listen on: a saver connecting to a host holds nothing there.
+    """
+    arguments = {}
+    try:
+        constructor = registry.saver_class(saver)
+        if isinstance(constructor, type):
+            constructor = constructor.__init__
+        spec = inspect.getargspec(constructor)
+        if spec.defaults:
+            arguments.update(zip(spec.args[-len(spec.defaults):],
+                                 spec.defaults))
+    except (registry.RegistryError, TypeError):
+        # no arguments we can find out about, such as object.__init__
+        pass
+    arguments.update(saver_config)
+    resources = set()
+    if arguments.get('directory') is not None:
+        resources.add(("directory", os.path.abspath(arguments['directory'])))
+    port = arguments.get('port')
+    if isinstance(port, basestring):
+        resources.add(("serial", port))
+    elif port is not None and 'address' in arguments:
+        resources.add(("listen", "%s:%s" % (arguments['address'], port)))
+    return resources
+
+def shared_resources(resources, others):
+    """
+    Return the resources of resources also in others, a directory being
+    shared with the ones it contains.
+    """
+    shared = set()
+    for kind, value in resources:
+        for other_kind, other_value in others:
+            if kind != other_kind:
+                continue
+            if value == other_value or (kind == "directory" and (
+                    value.startswith(other_value + os.sep)
+                    or other_value.startswith(value + os.sep))):
+                shared.add((kind, value))
+    return shared
+
+class _HeldData(data_save.DataSaver):
+    """
+    Keeps what is given to it, for the savers that are not made yet. Past
+    max_points data points, the oldest ones are dropped (and counted in
+    dropped); backfills are always kept.
+    """
+    def __init__(self, max_points=100000):
+        self._max_points = max_points
+        self._calls = collections.deque()
+        self._points = 0
+        self.dropped = 0
+
+    def _hold(self, method, arguments, points=0):
+        self._calls.append((method, arguments, points))
+        self._points += points
+        if self._points <= self._max_points:
+            return
+        if not self.dropped:
+            print >> sys.stderr, ("Reload: more than %d data points held, "
+                                  "dropping the oldest ones" % self._max_points)
+        kept = collections.deque()
+        while self._points > self._max_points:
+            call = self._calls.popleft()
+            if call[2]:
+                self._points -= call[2]
+                self.dropped += call[2]
+            else:
+                kept.append(call)
+        kept.extend(self._calls)
+        self._calls = kept
+
+    def update(self, data_point):
+        self._hold("update", (data_point,), 1)
+
+    def update_many(self, batch):
+        self._hold("update_many", (batch,), len(batch))
+
+    def backfill(self, intervals, device=None, temperature=None):
+        self._hold("backfill", (intervals, device, temperature))
+
+    def replay(self, savers):
+        for method, arguments, points in self._calls:
+            for saver in savers:
+                getattr(saver, method)(*arguments)
+        self._calls = collections.deque()
+        self._points = 0
+
+def make_metrics(metrics_config):
+    """
+    Return the metrics.Metrics to report to and the list of its exporters,
+    from the "metrics" configuration entry. Without it, metrics are disabled.
+    """
+    if metrics_config is None:
+        return metrics.NULL_METRICS, []
+    metrics_config = dict(metrics_config)
+    stats_file = metrics_config.pop('stats_file', None)
+    interval = metrics_config.pop('interval', 10)
+    prometheus_config = metrics_config.pop('prometheus', None)
+    if metrics_config:
+        raise CucoLoggerConfigException("Unknown metrics entries: %s"
+                                        % ", ".join(metrics_config))
+
+    instance = metrics.Metrics()
+    exporters = []
+    if stats_file is not None:
+        exporters.append(metrics.StatsFileWriter(instance, stats_file,
+                                                 interval))
+    if prometheus_config is not None:
+        exporters.append(metrics.PrometheusServer(instance,
+                                                  **prometheus_config))
+    return instance, exporters
+
+def make_spool(spool_config, savers):
+    """
+    Return a spool.SpoolingDataSaver in front of savers, a list of (name,
+    saver) tuples, from the "spool" configuration entry.
+    """
+    import spool
+    spool_config = dict(spool_config)
+    saver_config = {}
+    for option in ('ack_interval', 'retry_interval', 'replay_batch_size'):
+        if option in spool_config:
+            saver_config[option] = spool_config.pop(option)
+    try:
+        return spool.SpoolingDataSaver(spool.Spool(**spool_config), savers,
+                                       **saver_config)
+    except TypeError, e:
+        raise CucoLoggerConfigException("Bad spool configuration: %s" % e)
+
+def make_source(source_config):
+    """
+    Create a source from the "source" configuration entry, whose "type" is
+    its name in the registry: "serial" by default, or "devices" if the entry
+    has "devices".
+    """
+    source_config = dict(source_config)
+    source_type = source_config.pop('type', None)
+    if source_type is None:
+        if 'devices' in source_config:
+            source_type = "devices"
+        else:
+            source_type = "serial"
+    if source_config.get('devices') == "auto":
+        del source_config['devices']
+    try:
+        return registry.source_class(source_type)(**source_config)
+    except registry.RegistryError, e:
+        raise CucoLoggerConfigException(str(e))
+    except TypeError, e:
+        raise CucoLoggerConfigException("Bad source configuration: %s" % e)
+
+def _running_pid(pidfile):
+    """
+    Return the pid in pidfile if that process is running, None otherwise.
+    """
+    try:
+        pid = int(open(pidfile).read().strip())
+        os.kill(pid, 0)
+    except (IOError, ValueError):
+        return None
+    except OSError, e:
+        if e.errno != errno.EPERM:
+            return None
+    return pid
+
+def daemonize(pidfile=None, log_file=None):
+    """
+    Go on running in the background, detached from the terminal, with the
+    usual double fork. Output goes to log_file if given, and is lost
+    otherwise. Only returns in the daemon, whose pid is written to pidfile,
+    removed on exit. The current directory stays the same, for the relative
+    paths of the configuration.
+
+    This has to happen before anything starts a thread.
+    """
+    if pidfile is not None:
+        pidfile = os.path.abspath(pidfile)
+        pid = _running_pid(pidfile)
+        if pid is not None:
+            raise CucoLoggerAlreadyRunning("Already running as %d" % pid)
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.umask(022)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    null = os.open(os.devnull, os.O_RDWR)
+    output = null
+    if log_file is not None:
+        output = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                         0644)
+    os.dup2(null, 0)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    # line by line, so that the log file is readable as it goes
+    sys.stdout = os.fdopen(1, "w", 1)
+    sys.stderr = os.fdopen(2, "w", 1)
+
+    if pidfile is not None:
+        pid = os.getpid()
+        pid_file = open(pidfile + ".tmp", "w")
+        pid_file.write("%d\n" % pid)
+        pid_file.close()
+        os.rename(pidfile + ".tmp", pidfile)
+        def remove_pidfile():
+            if _running_pid(pidfile) == pid:
+                os.remove(pidfile)
+        atexit.register(remove_pidfile)
+
 class CucoLogger(object):
-    def __init__(self, config):
+    # what a reload takes from the new configuration, the rest needs a restart
+    RELOADABLE = ('savers', 'spool', 'shutdown_timeout')
+    # seconds between two attempts to make the savers of a reload that
+    # failed, holding the data meanwhile
+    RELOAD_RETRY_INTERVAL = 30
+
+    def __init__(self, config, source=None):
+        """
+        Messages are read from source, any iterable of CC128 messages such as
+        a simulator.SimulatedCC128, or by default from the serial port
+        described by the "source" entry of config. If that entry has
+        "devices" (a mapping of names to ports, or "auto" for all the CC128s
+        plugged in), source gives (device name, message) tuples instead, read
+        by default from a serial_tools.MultiCC128Source.
+
+        If config has "sensors" set, the data of each sensor, with its
+        channels, is parsed instead of the total of the house.
+
+        With a "backfill" entry, the gaps in the data of the savers are
+        filled from the history the CC128 sends (see history.py). That takes
+        a while, so it needs every saver to be queued: the intervals to fill
+        are handed to the worker threads of the savers.
+
+        When stopped by a signal, the savers are given "shutdown_timeout"
+        seconds (default 10) to write what they hold.
+
+        The whole configuration is checked before any saver or source is
+        imported.
+        """
+        source_config = config.get('source', {})
+        self._multi_device = (source_config.get('devices') is not None
+                              or source_config.get('type') == "devices")
+        self._sensors = bool(config.get('sensors', False))
+        self._backfilling = config.get('backfill') is not None
+        self._check_savers(config)
+        try:
+            registry.check_source(source_config.get('type', 'serial'))
+        except registry.RegistryError, e:
+            raise CucoLoggerConfigException(str(e))
+        self._parser_name = config.get('parser', 'stream')
+        if self._parser_name not in PARSERS:
+            raise CucoLoggerConfigException("Unknown parser: %s"
+                                            % self._parser_name)
+
+        backfill_config = config.get('backfill')
+        if backfill_config is not None and self._parser_name != "stream":
+            raise CucoLoggerConfigException(
+                    "Backfilling needs the stream parser")
+
+        self._config = config
+        self._shutdown_timeout = config.get('shutdown_timeout', 10)
+        self._metrics, self._exporters = make_metrics(config.get('metrics'))
+        self._savers, self._saver_names = self._make_savers(config)
+        self._resources = self._config_resources(config)
+        # (thread, resources) of the savers being detached
+        self._drains = []
+        # while a reload waits for the previous savers to be detached
+        self._held = None
+        self._pending_reload = None
+        self._reload_started = None
+        self._reload_warned = False
+        self._reload_retry_at = None
+
+        self._backfiller = None
+        if backfill_config is not None:
+            import history
+            try:
+                self._backfiller = history.Backfiller(self._savers,
+                                                      **backfill_config)
+            except (ValueError, TypeError), e:
+                raise CucoLoggerConfigException("Bad backfill: %s" % e)
+            self._metrics.gauge("cucologger_backfilled_intervals",
+                                lambda: self._backfiller.intervals)
+
+        if source is None:
+            source = make_source(source_config)
+        self._source = source
+
+        self._parser = self._make_parser()
+        # one per device, they keep incomplete messages
+        self._parsers = {}
+        if hasattr(self._parser, 'malformed'):
+            self._metrics.gauge("cucologger_malformed_messages",
+                    lambda: self._parser.malformed + sum(
+                        device_parser.malformed
+                        for device_parser in self._parsers.values()))
+        if hasattr(self._source, 'reconnections'):
+            self._metrics.gauge("cucologger_source_reconnections",
+                                lambda: self._source.reconnections)
+
+        self._flush_requested = False
+        self._reload_requested = False
+        self._config_file = None
+        self._stop_requested = False
+
+    def _check_savers(self, config):
         if "savers" not in config or len(config['savers']) == 0:
             raise CucoLoggerConfigException("no savers in config")
+        for saver, saver_config in config['savers'].iteritems():
+            check_saver_config(saver, saver_config, self._multi_device,
+                               self._sensors)
+            if self._backfilling and saver_config.get('queue') is False:
+                # backfilling would hold up the reading loop
+                raise CucoLoggerConfigException(
+                        "%s needs its queue for backfilling" % saver)
 
-        self._savers = []
+    def _make_savers(self, config):
+        """
+        Return the savers of config and their names.
+        """
+        savers = []
+        names = []
+        try:
+            for saver, saver_config in config['savers'].iteritems():
+                savers.append(make_saver(saver, saver_config,
+                                         self._multi_device, self._sensors))
+                names.append(saver)
+            if 'spool' in config:
+                savers = [make_spool(config['spool'], zip(names, savers))]
+                names = ["spool"]
+        except Exception:
+            for saver in savers:
+                saver.close()
+            raise
+        for name, instance in zip(names, savers):
+            instance.set_metrics(self._metrics, name)
+        return savers, names
+
+    def _config_resources(self, config):
+        resources = set()
         for saver, saver_config in config['savers'].iteritems():
-            if saver == "RrdDataSaver":
-                constructor = data_save.RrdDataSaver
-            elif saver == "CsvDataSaver":
-                constructor = data_save.CsvDataSaver
-            elif saver == "ThermostatSaver":
-                constructor = data_save.ThermostatSaver
-            else:
-                raise CucoLoggerConfigException("Unknown saver: %s" % saver)
-            self._savers.append(constructor(**saver_config))
+            resources |= saver_resources(saver, saver_config)
+        if config.get('spool', {}).get('directory') is not None:
+            resources.add(("directory",
+                           os.path.abspath(config['spool']['directory'])))
+        return resources
+
+    def _use_savers(self, config, savers, names, resources):
+        """
+        Save with savers from now on, config being the one they come from.
+        """
+        self._savers, self._saver_names = savers, names
+        self._resources = resources
+        if self._backfiller is not None:
+            self._backfiller.savers = savers
+        new_config = dict((key, value) for key, value in self._config.iteritems()
+                          if key not in self.RELOADABLE)
+        new_config.update((key, value) for key, value in config.iteritems()
+                          if key in self.RELOADABLE)
+        self._config = new_config
+        self._shutdown_timeout = new_config.get('shutdown_timeout', 10)
 
-        self._source = serial_tools.open_cc128()
-        self._parser = parser.CC128LiveParser()
+    def _drain(self, savers, resources):
+        """
+        Detach savers in another thread, which is returned. Until it is done,
+        the resources of the savers are not given to new ones.
+        """
+        def detach_all():
+            for saver in savers:
+                try:
+                    saver.detach()
+                except Exception:
+                    print >> sys.stderr, "Error detaching a saver:"
+                    traceback.print_exc()
+        thread = threading.Thread(target=detach_all, name="saver drain")
+        thread.daemon = True
+        thread.start()
+        self._drains.append((thread, resources))
+        return thread
+
+    def _wait_for_drains(self, deadline):
+        """
+        Wait until deadline at most for the savers being detached. Return
+        whether they were all done in time.
+        """
+        for thread, resources in self._drains:
+            thread.join(max(0, deadline - time.time()))
+        self._drains = [(thread, resources)
+                        for thread, resources in self._drains
+                        if thread.is_alive()]
+        if self._drains:
+            print >> sys.stderr, ("Savers still busy after %ss, giving up on "
+                                  "them" % self._shutdown_timeout)
+            return False
+        return True
+
+    def reload(self, config):
+        """
+        Replace the savers by the ones of config. Only the entries in
+        RELOADABLE are taken into account. If the savers of config are
+        wrong, the current ones are kept.
+
+        The new savers are made first, then the current ones are detached in
+        the background. New savers that would use the resources of a current
+        one (see saver_resources()) can only be made once it is detached, so
+        that they carry on with its files: until then, what comes is held in
+        memory. The resources of savers from a previous reload that are
+        still being detached cannot be used at all.
+        """
+        self._check_savers(config)
+        if self._held is not None:
+            raise CucoLoggerConfigException("the previous reload is not done")
+        for key in sorted(set(config) | set(self._config)):
+            if (key not in self.RELOADABLE
+                    and config.get(key) != self._config.get(key)):
+                print >> sys.stderr, ("Reload: the %s entry needs a restart "
+                                      "to change" % key)
+        resources = self._config_resources(config)
+        self._drains = [(thread, held) for thread, held in self._drains
+                        if thread.is_alive()]
+        for thread, held in self._drains:
+            shared = shared_resources(resources, held)
+            if shared:
+                raise CucoLoggerConfigException(
+                        "%s still used by savers being detached"
+                        % ", ".join(sorted(value for kind, value in shared)))
+
+        old_savers, old_resources = self._savers, self._resources
+        if shared_resources(resources, old_resources):
+            # made once the current savers let go
+            self._held = _HeldData()
+            self._reload_started = time.time()
+            self._pending_reload = (config, self._config, resources,
+                                    self._drain(old_savers, old_resources))
+            self._use_savers(config, [self._held], ["held"], resources)
+            print >> sys.stderr, ("Reload: holding the data until the "
+                                  "current savers are detached")
+            return
+        try:
+            savers, names = self._make_savers(config)
+        except Exception, e:
+            traceback.print_exc()
+            raise CucoLoggerConfigException("could not make the new savers: "
+                                            "%s" % e)
+        self._use_savers(config, savers, names, resources)
+        self._drain(old_savers, old_resources)
+        print >> sys.stderr, "Reload: now saving with %s" % ", ".join(names)
+
+    def _finish_reload(self):
+        """
+        Make the new savers of a reload waiting for the previous ones, if
+        they are detached, and give them the data held meanwhile.
+        """
+        config, previous_config, resources, drain = self._pending_reload
+        if (self._reload_retry_at is not None
+                and time.time() < self._reload_retry_at):
+            return
+        if drain.is_alive():
+            if (not self._reload_warned and time.time()
+                    - self._reload_started > self._shutdown_timeout):
+                self._reload_warned = True
+                print >> sys.stderr, ("Reload: the previous savers are still "
+                                      "busy after %ss, holding the data until "
+                                      "they are done" % self._shutdown_timeout)
+            return
+        try:
+            savers, names = self._make_savers(config)
+        except Exception:
+            print >> sys.stderr, "Reload failed, back to the previous savers:"
+            traceback.print_exc()
+            try:
+                savers, names = self._make_savers(previous_config)
+            except Exception:
+                print >> sys.stderr, ("Reload: could not make the previous "
+                                      "savers either, holding the data and "
+                                      "retrying in %ds:"
+                                      % self.RELOAD_RETRY_INTERVAL)
+                traceback.print_exc()
+                self._reload_retry_at = (time.time()
+                                         + self.RELOAD_RETRY_INTERVAL)
+                return
+            config = previous_config
+            resources = self._config_resources(config)
+        self._pending_reload = None
+        self._reload_warned = False
+        self._reload_retry_at = None
+        held, self._held = self._held, None
+        self._use_savers(config, savers, names, resources)
+        held.replay(savers)
+        print >> sys.stderr, "Reload: now saving with %s" % ", ".join(names)
+
+    def _reload_file(self):
+        self._reload_requested = False
+        print >> sys.stderr, "Reloading configuration from %s" % (
+                self._config_file)
+        try:
+            config = json.load(open(self._config_file))
+            self.reload(config)
+        except (IOError, ValueError, CucoLoggerConfigException), e:
+            print >> sys.stderr, "Reload: keeping the current savers: %s" % e
+
+    def _make_parser(self):
+        if self._parser_name == "stream":
+            return parser.CC128StreamLiveParser(
+                    sensors=self._sensors,
+                    history=self._backfiller is not None)
+        return parser.CC128LiveParser(sensors=self._sensors)
+
+    def _device_parser(self, device):
+        device_parser = self._parsers.get(device)
+        if device_parser is None:
+            device_parser = self._parsers[device] = self._make_parser()
+        return device_parser
+
+    def _on_terminate(self, signum, frame):
+        # left to the main loop, so that a message that was just read is
+        # still saved; a source that can stop does not wait for the next one
+        self._stop_requested = True
+        if hasattr(self._source, 'stop'):
+            self._source.stop()
+
+    def _on_reload(self, signum, frame):
+        # left to the main loop, between two batches
+        self._reload_requested = True
+
+    def _on_flush(self, signum, frame):
+        # flushing from here could happen in the middle of an update, so we
+        # leave it to the main loop
+        self._flush_requested = True
+
+    def install_signal_handlers(self, config_file=None):
+        """
+        SIGTERM stops the logger once the current batch is saved, SIGUSR1
+        flushes the savers and, given the file config was read from, SIGHUP
+        reads it again and reloads the savers.
+        """
+        signal.signal(signal.SIGTERM, self._on_terminate)
+        signal.signal(signal.SIGUSR1, self._on_flush)
+        if config_file is not None:
+            self._config_file = os.path.abspath(config_file)
+            signal.signal(signal.SIGHUP, self._on_reload)
+
+    def _flush(self):
+        self._flush_requested = False
+        for saver in self._savers:
+            saver.flush()
 
     def run(self):
+        # measuring only costs a few time() calls per message, but none at all
+        # when metrics are disabled
+        timing = self._metrics.enabled
+        if timing:
+            stage = "cucologger_stage_seconds"
+            read_wait = self._metrics.histogram(stage, stage="read_wait")
+            parse_time = self._metrics.histogram(stage, stage="parse")
+            save_time = self._metrics.histogram(stage, stage="save")
+            saver_names = self._saver_names
+            saver_times = self._saver_histograms()
+            message_count = self._metrics.counter("cucologger_messages")
+            data_point_count = self._metrics.counter("cucologger_data_points")
+            end = time.time()
         try:
             for line in self._source:
-                for data_point in self._parser.parse_msg(line):
-                    for saver in self._savers:
-                        saver.update(data_point)
+                if timing:
+                    start = time.time()
+                    read_wait.observe(start - end)
+                    message_count.inc()
+                if self._multi_device:
+                    device, line = line
+                    line_parser = self._device_parser(device)
+                    batch = line_parser.parse_batch(line)
+                    batch.device = device
+                    if timing:
+                        self._metrics.counter("cucologger_device_messages",
+                                              device=device).inc()
+                else:
+                    device = None
+                    line_parser = self._parser
+                    batch = line_parser.parse_batch(line)
+                if timing:
+                    parsed = time.time()
+                    parse_time.observe(parsed - start)
+                    data_point_count.inc(len(batch))
+                if len(batch):
+                    if timing:
+                        saver_start = parsed
+                        for saver, saver_time in zip(self._savers, saver_times):
+                            saver.update_many(batch)
+                            saver_end = time.time()
+                            saver_time.observe(saver_end - saver_start)
+                            saver_start = saver_end
+                        save_time.observe(saver_end - parsed)
+                    else:
+                        for saver in self._savers:
+                            saver.update_many(batch)
+                if self._backfiller is not None:
+                    self._backfiller.seen(batch, device)
+                    for record in line_parser.pop_history():
+                        self._backfiller.add(record, device)
+                if self._flush_requested:
+                    self._flush()
+                if self._reload_requested:
+                    self._reload_file()
+                if self._pending_reload is not None:
+                    self._finish_reload()
+                if timing and saver_names is not self._saver_names:
+                    saver_names = self._saver_names
+                    saver_times = self._saver_histograms()
+                if self._stop_requested:
+                    break
+                if timing:
+                    end = time.time()
         except KeyboardInterrupt:
             print >> sys.stderr, "\nCucoLogger stopping operations because of keyboard interrupt"
+        finally:
+            if self._stop_requested:
+                print >> sys.stderr, ("CucoLogger stopping operations "
+                                      "because of a signal")
+            deadline = time.time() + self._shutdown_timeout
+            if self._pending_reload is not None:
+                self._pending_reload[3].join(max(0, deadline - time.time()))
+                # a last attempt
+                self._reload_retry_at = None
+                self._finish_reload()
+                if self._pending_reload is not None:
+                    print >> sys.stderr, ("Reload not done, the data held "
+                                          "meanwhile is lost")
+            if self._stop_requested:
+                # make sure batched data is written, in bounded time, leaving
+                # the files for the next run to carry on with
+                self._drain(self._savers, self._resources)
+            else:
+                for saver in self._savers:
+                    saver.close()
+            self._wait_for_drains(deadline)
+            for exporter in self._exporters:
+                exporter.close()
 
-        for saver in self._savers:
-            saver.close()
+    def _saver_histograms(self):
+        return [self._metrics.histogram("cucologger_saver_seconds", saver=name)
+                for name in self._saver_names]
 
 if __name__ == '__main__':
-    import sys, os, json
-    config_file = "./cucologger.conf"
-    if len(sys.argv) > 1:
-        config_file = sys.argv[1]
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+            description="Log the data of a CC128 energy monitor")
+    arg_parser.add_argument("config", nargs="?", default="./cucologger.conf",
+            help="configuration file (default: ./cucologger.conf)")
+    arg_parser.add_argument("-d", "--daemon", action="store_true",
+            help="run in the background")
+    arg_parser.add_argument("--pidfile",
+            help="file to write the pid of the daemon to")
+    arg_parser.add_argument("--log-file",
+            help="file the daemon appends its output to")
+    args = arg_parser.parse_args()
+    config_file = args.config
 
     if not os.path.exists(config_file):
         print >> sys.stderr, "Could not find configuration file in %s, exiting" % config_file
@@ -66,5 +784,13 @@ if __name__ == '__main__':
     print "Loading configuration from %s" % config_file
     config = json.load(open(config_file))
 
+    if args.daemon:
+        # before the savers start their threads
+        try:
+            daemonize(args.pidfile, args.log_file)
+        except CucoLoggerAlreadyRunning, e:
+            print >> sys.stderr, "%s, exiting" % e
+            sys.exit(1)
     logger = CucoLogger(config)
+    logger.install_signal_handlers(config_file)
     logger.run()
@@ -15,24 +15,508 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, time, bz2
+import os, sys, time
 import socket, json
+import threading, collections, traceback, Queue
+import select, errno, fcntl
 
-import rrdtool
-
-from parser import DataPoint
+from parser import DataPoint, DataPointBatch, CsvTimeFormatter, CSVTimeParser
+from parser import CHANNELS
+from metrics import NULL_METRICS
+import compression
 
 class DataSaver(object):
+    # whether the saver keeps the sensors and channels of data points that
+    # have them apart, instead of only making sense of the ones of sensor 0
+    SENSORS = False
+
     def update(self, data_point):
         raise NotImplementedError()
 
+    def update_many(self, batch):
+        """
+        Save all the data points of a parser.DataPointBatch. Savers that can
+        do better than one update() per data point should override this.
+        """
+        for data_point in batch:
+            self.update(data_point)
+
+    def replay_many(self, batch):
+        """
+        Like update_many(), for data that must not be dropped to keep up,
+        such as what a spool gives again after a crash.
+        """
+        self.update_many(batch)
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        """
+        Write everything given so far and return once it is written, raising
+        if some of it could not be.
+        """
+        self.flush()
+
+    def sync_later(self, done):
+        """
+        Like sync(), but call done(error) instead of returning, error being
+        None once everything given so far is written, or what prevented it.
+        Savers with a thread of their own call it from that thread, without
+        making the caller wait.
+        """
+        try:
+            self.sync()
+        except Exception, e:
+            done(e)
+            return
+        done(None)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        """
+        Fill the gaps in the data held for the history.Interval intervals of
+        device (see history.missing_points()). Savers that cannot add data
+        older than what they have, such as RrdDataSaver, do nothing.
+        """
+        pass
+
     def close(self):
         pass
 
+    def detach(self):
+        """
+        Write everything given so far and let go of what the saver holds, for
+        another saver with the same configuration (after a reload, or in the
+        next run) to carry on with where this one stops. Unlike close(), this
+        does not finish anything off, such as compressing the current file.
+        """
+        self.close()
+
+    def set_metrics(self, metrics, name):
+        """
+        Report what happens inside this saver (pauses, backlogs...) to a
+        metrics.Metrics, with name as the "saver" label. The time spent in
+        update_many() itself is measured by the caller.
+        """
+        pass
+
+
+class _Backfill(object):
+    # a backfill() call waiting in the queue of a QueuedDataSaver
+    __slots__ = ('intervals', 'device', 'temperature')
+
+    def __init__(self, intervals, device, temperature):
+        self.intervals = intervals
+        self.device = device
+        self.temperature = temperature
+
+class _SyncLater(object):
+    # a sync_later() call waiting in the queue of a QueuedDataSaver
+    __slots__ = ('done',)
+
+    def __init__(self, done):
+        self.done = done
+
+class _Replay(object):
+    # a replay_many() batch waiting in the queue of a QueuedDataSaver
+    __slots__ = ('batch',)
+
+    def __init__(self, batch):
+        self.batch = batch
+
+# queue items that are never dropped
+_KEPT_ITEMS = (_Backfill, _SyncLater, _Replay)
+
+class QueuedDataSaver(DataSaver):
+    """
+    Runs another saver in its own thread behind a bounded queue, so that a
+    slow saver never holds up the caller.
+
+    size counts the data points and batches queued. overflow tells what to do
+    with a new one when the queue is full:
+     - "block": wait for the worker to make some room
+     - "drop-oldest": forget the oldest queued data point or batch
+     - "coalesce-latest": replace the newest queued data point or batch
+    dropped counts the data points lost that way. Backfills, sync_later()
+    calls and replay_many() batches are never dropped and do not count
+    towards the size, but replay_many() waits for the queue to have room.
+
+    close() waits at most close_timeout seconds for the queue to be saved,
+    leaving the rest behind if the saver is stuck.
+    """
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "coalesce-latest")
+
+    def __init__(self, saver, size=1000, overflow="block", close_timeout=60):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        if size < 1:
+            raise ValueError("Queue size must be at least 1")
+        self._saver = saver
+        self._size = size
+        self._overflow = overflow
+        self._close_timeout = close_timeout
+        self._queue = collections.deque()
+        # backfills and sync_later() calls in the queue
+        self._kept = 0
+        self._condition = threading.Condition()
+        self._flush_requested = False
+        self._closing = False
+        self._detaching = False
+        self.dropped = 0
+        # flushes asked for and done, for sync()
+        self._flushes_requested = 0
+        self._flushes_done = 0
+        self.errors = 0
+        self._errors_at_sync = 0
+        self._save_seconds = NULL_METRICS.histogram(None)
+
+        self._thread = threading.Thread(target=self._work,
+                name="%s worker" % saver.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def update(self, data_point):
+        self._put(data_point)
+
+    def update_many(self, batch):
+        # a batch counts as a single queue entry
+        if len(batch):
+            self._put(batch)
+
+    def replay_many(self, batch):
+        if not len(batch):
+            return
+        with self._condition:
+            # whatever the overflow policy
+            while len(self._queue) >= self._size:
+                self._condition.wait(1.0)
+            self._put_kept(_Replay(batch))
+
+    def backfill(self, intervals, device=None, temperature=None):
+        self._put_kept(_Backfill(intervals, device, temperature))
+
+    def sync_later(self, done):
+        self._put_kept(_SyncLater(done))
+
+    def _put_kept(self, item):
+        with self._condition:
+            self._queue.append(item)
+            self._kept += 1
+            self._condition.notify_all()
+
+    def _full(self):
+        return len(self._queue) - self._kept >= self._size
+
+    def _data_index(self, indices):
+        """
+        Return the first of indices in the queue that is a data point or a
+        batch.
+        """
+        for index in indices:
+            if not isinstance(self._queue[index], _KEPT_ITEMS):
+                return index
+
+    def _drop(self, index):
+        dropped = self._queue[index]
+        if isinstance(dropped, DataPointBatch):
+            self.dropped += len(dropped)
+        else:
+            self.dropped += 1
+
+    def _put(self, item):
+        with self._condition:
+            if self._full():
+                if self._overflow == "block":
+                    while self._full():
+                        # with a timeout so that we still get signals
+                        self._condition.wait(1.0)
+                elif self._overflow == "drop-oldest":
+                    index = self._data_index(xrange(len(self._queue)))
+                    self._drop(index)
+                    del self._queue[index]
+                else:
+                    index = self._data_index(
+                            xrange(len(self._queue) - 1, -1, -1))
+                    self._drop(index)
+                    self._queue[index] = item
+                    return
+            self._queue.append(item)
+            self._condition.notify_all()
+
+    def set_metrics(self, metrics, name):
+        metrics.gauge("cucologger_queue_depth", self.__len__, saver=name)
+        metrics.gauge("cucologger_queue_dropped", lambda: self.dropped,
+                      saver=name)
+        self._save_seconds = metrics.histogram(
+                "cucologger_queued_save_seconds", saver=name)
+        self._saver.set_metrics(metrics, name)
+
+    def flush(self):
+        with self._condition:
+            self._flush_requested = True
+            self._flushes_requested += 1
+            self._condition.notify_all()
+
+    def sync(self):
+        with self._condition:
+            self._flush_requested = True
+            self._flushes_requested += 1
+            target = self._flushes_requested
+            self._condition.notify_all()
+            while self._flushes_done < target and self._thread.is_alive():
+                self._condition.wait(1.0)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        """
+        Raise if there were errors since the last time we checked.
+        """
+        with self._condition:
+            errors = self.errors - self._errors_at_sync
+            self._errors_at_sync = self.errors
+        if errors:
+            raise RuntimeError("%d errors in %s" % (errors, self._thread.name))
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        deadline = time.time() + self._close_timeout
+        while self._thread.is_alive() and time.time() < deadline:
+            # in steps so that we still get signals
+            self._thread.join(min(1.0, max(0, deadline - time.time())))
+        if self._thread.is_alive():
+            print >> sys.stderr, ("%s still busy after %ss, leaving %d queued "
+                                  "entries behind" % (self._thread.name,
+                                  self._close_timeout, len(self._queue)))
+
+    def detach(self):
+        with self._condition:
+            self._detaching = True
+        self.close()
+
+    _FLUSH = object()
+
+    def _next_item(self):
+        """
+        Return the next data point or batch to save. Once the queue is empty, return
+        _FLUSH if a flush was requested, or None if we are closing.
+        """
+        with self._condition:
+            while not (self._queue or self._flush_requested or self._closing):
+                self._condition.wait()
+            if self._queue:
+                item = self._queue.popleft()
+                if isinstance(item, _KEPT_ITEMS):
+                    self._kept -= 1
+                self._condition.notify_all()
+                return item
+            if self._flush_requested:
+                self._flush_requested = False
+                # the flushes asked for so far are done by this one
+                self._flush_target = self._flushes_requested
+                return self._FLUSH
+            return None
+
+    def _flushed(self):
+        with self._condition:
+            self._flushes_done = self._flush_target
+            self._condition.notify_all()
+
+    def _sync_later(self, done):
+        try:
+            self._saver.sync()
+            self._raise_errors()
+        except Exception, e:
+            done(e)
+            return
+        done(None)
+
+    def _work(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                break
+            try:
+                if item is self._FLUSH:
+                    try:
+                        self._saver.flush()
+                    finally:
+                        self._flushed()
+                elif isinstance(item, DataPointBatch):
+                    with self._save_seconds.time():
+                        self._saver.update_many(item)
+                elif isinstance(item, _Replay):
+                    with self._save_seconds.time():
+                        self._saver.update_many(item.batch)
+                elif isinstance(item, _Backfill):
+                    self._saver.backfill(item.intervals, item.device,
+                                         item.temperature)
+                elif isinstance(item, _SyncLater):
+                    self._sync_later(item.done)
+                else:
+                    with self._save_seconds.time():
+                        self._saver.update(item)
+            except Exception:
+                self.errors += 1
+                print >> sys.stderr, "Error in %s:" % self._thread.name
+                traceback.print_exc()
+        try:
+            if self._detaching:
+                self._saver.detach()
+            else:
+                self._saver.close()
+        except Exception:
+            print >> sys.stderr, "Error closing %s:" % self._thread.name
+            traceback.print_exc()
+
+
+class PerDeviceSaver(DataSaver):
+    """
+    Gives the data of each device to a saver of its own, made by
+    factory(device) the first time the device is seen.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._savers = {}
+        self._metrics = None
+        self._name = None
+
+    def _saver(self, device):
+        saver = self._savers.get(device)
+        if saver is None:
+            saver = self._factory(device)
+            if self._metrics is not None:
+                saver.set_metrics(self._metrics, "%s:%s" % (self._name, device))
+            self._savers[device] = saver
+        return saver
+
+    def update(self, data_point):
+        self._saver(data_point.device).update(data_point)
+
+    def update_many(self, batch):
+        self._saver(batch.device).update_many(batch)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        self._saver(device).backfill(intervals, device, temperature)
+
+    def flush(self):
+        for saver in self._savers.itervalues():
+            saver.flush()
+
+    def sync(self):
+        for saver in self._savers.itervalues():
+            saver.sync()
+
+    def close(self):
+        for saver in self._savers.itervalues():
+            saver.close()
+
+    def detach(self):
+        for saver in self._savers.itervalues():
+            saver.detach()
+
+    def set_metrics(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+        for device, saver in self._savers.iteritems():
+            saver.set_metrics(metrics, "%s:%s" % (name, device))
+
+
+class DeviceFilterSaver(DataSaver):
+    """
+    Only gives saver the data of one device.
+    """
+    def __init__(self, saver, device):
+        self._saver = saver
+        self._device = device
+
+    def update(self, data_point):
+        if data_point.device == self._device:
+            self._saver.update(data_point)
+
+    def update_many(self, batch):
+        if batch.device == self._device:
+            self._saver.update_many(batch)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        if device == self._device:
+            self._saver.backfill(intervals, device, temperature)
+
+    def flush(self):
+        self._saver.flush()
+
+    def sync(self):
+        self._saver.sync()
+
+    def close(self):
+        self._saver.close()
+
+    def detach(self):
+        self._saver.detach()
+
+    def set_metrics(self, metrics, name):
+        self._saver.set_metrics(metrics, name)
+
+class SensorFilterSaver(DeviceFilterSaver):
+    """
+    Only gives saver the data of one sensor. Data points without a sensor are
+    from sensor 0.
+    """
+    def __init__(self, saver, sensor):
+        self._saver = saver
+        self._sensor = sensor
+
+    def update(self, data_point):
+        sensor = data_point.sensor
+        if sensor is None:
+            sensor = 0
+        if sensor == self._sensor:
+            self._saver.update(data_point)
+
+    def update_many(self, batch):
+        if batch.sensors is None:
+            if self._sensor == 0:
+                self._saver.update_many(batch)
+            return
+        batch = batch.by_sensor().get(self._sensor)
+        if batch is not None:
+            self._saver.update_many(batch)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        # the history is only used for sensor 0
+        if self._sensor == 0:
+            self._saver.backfill(intervals, device, temperature)
+
+
+class _SensorRrd(object):
+    """
+    State of the RRD file of a sensor.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.created = os.path.exists(path)
+        self.last_time = None
+        if self.created:
+            import rrdtool
+            self.last_time = rrdtool.last(path)
+
 
 class RrdDataSaver(DataSaver):
+    """
+    Saves the power and temperature in power.rrd and temperature.rrd. Data
+    points with a sensor also have the watts of each of their channels saved
+    in one file per sensor, sensor<number>.rrd, the power and temperature
+    files only getting the data of sensor 0.
+    """
+    SENSORS = True
     POWER_FILE = 'power.rrd'
     TEMPERATURE_FILE = 'temperature.rrd'
+    SENSOR_FILE_TEMPLATE = 'sensor%d.rrd'
 
     SAMPLING_RESOLUTION = 6 # in seconds
 
@@ -56,23 +540,52 @@ class RrdDataSaver(DataSaver):
             "RRA:AVERAGE:0.5:%d:%d" % (600/SAMPLING_RESOLUTION, 6*24*366*10)
             )
 
-    def __init__(self, directory):
+    SENSOR_DSS = tuple(["DS:ch%d:GAUGE:%d:0:U" % (number, SAMPLING_RESOLUTION)
+                        for number in xrange(1, CHANNELS + 1)])
+
+    def __init__(self, directory, batch_size=1, max_staleness=None):
+        """
+        Updates are sent to rrdtool by batches of up to batch_size samples,
+        each file being opened only once per batch. If max_staleness is set, a
+        batch is also sent as soon as its oldest sample is max_staleness
+        seconds older than the newest one, or has been waiting for
+        max_staleness seconds when no newer sample comes.
+        """
         self._dir = os.path.abspath(directory)
         if isinstance(self._dir, unicode):
             # rrdtool wants strings and raises if it gets a unicode object
             self._dir = self._dir.encode('UTF-8')
         print "rrdtool: will save in", self._dir
+        self._batch_size = batch_size
+        self._max_staleness = max_staleness
+        self._pending_temperature = []
+        self._pending_power = []
+        self._pending_since = None
+        # when the oldest pending sample was given to us
+        self._pending_clock = None
+        # sends stale batches when no sample comes to do it
+        self._stale_timer = None
+        # the timer flushes from its own thread
+        self._lock = threading.RLock()
+        # sensor -> _SensorRrd
+        self._sensor_rrds = {}
+        self._update_seconds = NULL_METRICS.histogram(None)
         self._power_file = os.path.join(self._dir, self.POWER_FILE)
         self._temperature_file = os.path.join(self._dir, self.TEMPERATURE_FILE)
 
         have_power_file = os.path.exists(self._power_file)
         have_temperature_file = os.path.exists(self._temperature_file)
 
+        # rrdtool refuses anything not newer than its last update
+        self._last_time = None
         if not (have_power_file or have_temperature_file):
             self._created = False
         else:
             assert(have_power_file and have_temperature_file)
             self._created = True
+            import rrdtool
+            self._last_time = min(rrdtool.last(self._power_file),
+                                  rrdtool.last(self._temperature_file))
 
     def _create_rrd_files(self, start_time):
         if not os.path.exists(self._dir):
@@ -81,6 +594,7 @@ class RrdDataSaver(DataSaver):
 
         print "Creating rrd files in", self._dir
 
+        import rrdtool
         rrdtool.create(self._temperature_file,
                 "--start", str(start_time),
                 "--step", str(self.SAMPLING_RESOLUTION),
@@ -95,88 +609,852 @@ class RrdDataSaver(DataSaver):
                 self.POWER_DS,
                 *self.POWER_RRAS
                 )
+
+    def _create_sensor_file(self, path, start_time):
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        print "Creating", path
+        import rrdtool
+        rrdtool.create(path,
+                "--start", str(start_time),
+                "--step", str(self.SAMPLING_RESOLUTION),
+                "--no-overwrite",
+                *(self.SENSOR_DSS + self.POWER_RRAS)
+                )
+
+    def _update_sensor(self, sensor, batch):
+        sensor_rrd = self._sensor_rrds.get(sensor)
+        if sensor_rrd is None:
+            sensor_rrd = self._sensor_rrds[sensor] = _SensorRrd(os.path.join(
+                    self._dir, self.SENSOR_FILE_TEMPLATE % sensor))
+        times = batch.times
+        first = 0
+        if sensor_rrd.last_time is not None:
+            while first < len(times) and times[first] <= sensor_rrd.last_time:
+                first += 1
+        if first == len(times):
+            return
+        if not sensor_rrd.created:
+            self._create_sensor_file(sensor_rrd.path, times[first] - 10)
+            sensor_rrd.created = True
+        sensor_rrd.last_time = times[-1]
+        self._batch_started(times[first])
+        template = ":".join(["%d"] * (CHANNELS + 1))
+        sensor_rrd.pending.extend(template % row for row in zip(
+                times[first:], *[channel[first:] for channel in batch.channels]))
+
+    def _pending_count(self):
+        # the temperature file may be behind the power file after a failure
+        return max(len(self._pending_power),
+                   len(self._pending_temperature)) + sum(
+                len(sensor_rrd.pending)
+                for sensor_rrd in self._sensor_rrds.itervalues())
+
+    def _batch_started(self, time_stamp):
+        if self._pending_since is not None:
+            return
+        self._pending_since = time_stamp
+        self._pending_clock = time.time()
+        if self._max_staleness is not None and self._stale_timer is None:
+            self._start_stale_timer(self._max_staleness)
+
+    def _start_stale_timer(self, delay):
+        self._stale_timer = threading.Timer(delay, self._flush_stale)
+        self._stale_timer.daemon = True
+        self._stale_timer.start()
+
+    def _flush_stale(self):
+        with self._lock:
+            if self._stale_timer is None:
+                # closed
+                return
+            self._stale_timer = None
+            if self._pending_clock is None:
+                return
+            waited = time.time() - self._pending_clock
+            if waited >= self._max_staleness:
+                try:
+                    self.flush()
+                except Exception:
+                    print >> sys.stderr, "Error sending stale rrdtool updates:"
+                    traceback.print_exc()
+                    waited = 0
+            if self._pending_clock is not None:
+                self._start_stale_timer(max(0, self._max_staleness - waited))
+
     def update(self, data_point):
+        with self._lock:
+            self._update(data_point)
+
+    def _update(self, data_point):
         # FIXME: use cache daemon (or have shell script for that?)
         assert(isinstance(data_point.time, int))
+        if data_point.sensor is not None:
+            self.update_many(DataPointBatch.from_data_points([data_point],
+                                                             data_point.device))
+            return
+        if self._last_time is not None and data_point.time <= self._last_time:
+            # already saved, e.g. replayed from a spool
+            return
+        self._last_time = data_point.time
 
         if not self._created:
             self._create_rrd_files(data_point.time - 10)
             self._created = True
 
-        rrdtool.update(self._temperature_file,
+        self._batch_started(data_point.time)
+        self._pending_temperature.append(
                 "%d:%.1f" % (data_point.time, data_point.temperature))
-
-        rrdtool.update(self._power_file,
+        self._pending_power.append(
                 "%d:%d" % (data_point.time, data_point.power))
 
+        if len(self._pending_power) >= self._batch_size:
+            self.flush()
+        elif (self._max_staleness is not None
+                and data_point.time - self._pending_since >= self._max_staleness):
+            self.flush()
+
+    def update_many(self, batch):
+        with self._lock:
+            self._update_many(batch)
+
+    def _update_many(self, batch):
+        if not len(batch):
+            return
+        newest = batch.times[-1]
+        if batch.sensors is not None:
+            batches = batch.by_sensor()
+            for sensor, sensor_batch in batches.iteritems():
+                self._update_sensor(sensor, sensor_batch)
+            batch = batches.get(0, DataPointBatch())
+        self._update_totals(batch)
+
+        if self._pending_count() >= self._batch_size:
+            self.flush()
+        elif (self._max_staleness is not None
+                and self._pending_since is not None
+                and newest - self._pending_since >= self._max_staleness):
+            self.flush()
+
+    def _update_totals(self, batch):
+        if len(batch) and self._last_time is not None:
+            # skip what is already saved, e.g. replayed from a spool
+            times = batch.times
+            first = 0
+            while first < len(times) and times[first] <= self._last_time:
+                first += 1
+            if first:
+                batch = batch[first:]
+        if not len(batch):
+            return
+        self._last_time = batch.times[-1]
+        if not self._created:
+            self._create_rrd_files(batch.times[0] - 10)
+            self._created = True
+
+        self._batch_started(batch.times[0])
+        self._pending_temperature.extend("%d:%.1f" % row for row in
+                                         zip(batch.times, batch.temperatures))
+        self._pending_power.extend("%d:%d" % row for row in
+                                   zip(batch.times, batch.powers))
+
+    def _update_file(self, path, updates):
+        """
+        Send updates to the RRD file at path. Return the updates rrdtool did
+        not take and the exc_info() of the error if it failed, or ([], None).
+        """
+        import rrdtool
+        try:
+            rrdtool.update(path, *updates)
+        except Exception:
+            error = sys.exc_info()
+            try:
+                last_time = rrdtool.last(path)
+            except Exception:
+                return updates, error
+            # it may have taken the first ones before failing on one
+            return [update for update in updates
+                    if int(update.split(":", 1)[0]) > last_time], error
+        return [], None
+
+    def flush(self):
+        """
+        Send the pending samples, one rrdtool call per file. The samples of a
+        file rrdtool fails to update stay pending, for the next flush to try
+        again, and the first error is raised once the other files are done.
+        """
+        with self._lock:
+            if not self._pending_count():
+                return
+            errors = []
+            with self._update_seconds.time():
+                if self._pending_temperature:
+                    self._pending_temperature, error = self._update_file(
+                            self._temperature_file, self._pending_temperature)
+                    errors.append(error)
+                if self._pending_power:
+                    self._pending_power, error = self._update_file(
+                            self._power_file, self._pending_power)
+                    errors.append(error)
+                for sensor_rrd in self._sensor_rrds.itervalues():
+                    if sensor_rrd.pending:
+                        sensor_rrd.pending, error = self._update_file(
+                                sensor_rrd.path, sensor_rrd.pending)
+                        errors.append(error)
+            if not self._pending_count():
+                self._pending_since = None
+                self._pending_clock = None
+            for error in errors:
+                if error is not None:
+                    raise error[0], error[1], error[2]
+
+    def close(self):
+        with self._lock:
+            if self._stale_timer is not None:
+                self._stale_timer.cancel()
+                self._stale_timer = None
+            self.flush()
+
+    def set_metrics(self, metrics, name):
+        metrics.gauge("cucologger_rrd_pending", self._pending_count,
+                      saver=name)
+        self._update_seconds = metrics.histogram("cucologger_rrd_update_seconds",
+                                                 saver=name)
+
+BZ2_CHUNK_SIZE = 1024*1024
+
+APPENDING_SUFFIX = ".appending"
+
+def _size(path):
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+def killed_append_sizes(compressed_path):
+    """
+    Return the sizes compressed_path and its index had before an
+    append_bz2_stream() that was killed, if its source is still there to be
+    compressed again, or None.
+    """
+    try:
+        appending = open(compressed_path + APPENDING_SUFFIX).read()
+    except IOError:
+        return None
+    try:
+        sizes, source_path = appending.split("\n")[:2]
+        start, index_start = [int(size) for size in sizes.split()]
+    except ValueError:
+        # killed while writing it, before appending anything
+        return None
+    if not source_path or not os.path.exists(source_path):
+        return None
+    return start, index_start
+
+def _recover_append(compressed_path, index_path):
+    """
+    Undo what an append_bz2_stream() that was killed left at the end of
+    compressed_path and index_path, if its source is still there to be
+    compressed again.
+    """
+    appending_path = compressed_path + APPENDING_SUFFIX
+    if not os.path.exists(appending_path):
+        return
+    sizes = killed_append_sizes(compressed_path)
+    if sizes is not None:
+        start, index_start = sizes
+        print >> sys.stderr, "Cutting %s back to %d bytes" % (compressed_path,
+                                                              start)
+        for path, size in ((compressed_path, start), (index_path, index_start)):
+            if path is not None and _size(path) > size:
+                truncated = open(path, "r+b")
+                truncated.truncate(size)
+                truncated.close()
+    os.remove(appending_path)
+
+def append_bz2_stream(source_path, compressed_path, index_path=None,
+                      block_size=None, remove_source=False):
+    """
+    Compress source_path as a new bz2 stream at the end of compressed_path.
+    Such concatenated streams are read as a single file by bzip2 and by
+    read_bz2_streams(), so existing data never needs to be decompressed.
+
+    If block_size is given, a new stream is started every block_size bytes or
+    so, at a line boundary. If index_path is given, source_path must be a CSV
+    file, and the time of the first line of each stream is appended to
+    index_path along with the offset of the stream in compressed_path.
+
+    The sizes of the files before appending are kept in a file next to
+    compressed_path until the append is done, including the removal of
+    source_path with remove_source. If we get killed meanwhile, the next
+    append to compressed_path cuts it back to them.
+    """
+    import bz2
+    _recover_append(compressed_path, index_path)
+    start = _size(compressed_path)
+    index_start = 0
+    if index_path is not None:
+        index_start = _size(index_path)
+    appending_path = compressed_path + APPENDING_SUFFIX
+    appending = open(appending_path, "w")
+    appending.write("%d %d\n%s\n" % (start, index_start,
+                                     os.path.abspath(source_path)))
+    appending.close()
+    offset = start
+    index_entries = []
+    time_parser = CSVTimeParser()
+    original = open(source_path, "rb")
+    destination = open(compressed_path, "ab")
+    try:
+        compressor = None
+        while True:
+            data = original.read(block_size or BZ2_CHUNK_SIZE)
+            if block_size and data and not data.endswith("\n"):
+                data += original.readline()
+            if not data:
+                break
+            if compressor is None:
+                compressor = bz2.BZ2Compressor()
+                if index_path is not None:
+                    try:
+                        time_stamp = time_parser.parse(data[:data.index(",")])
+                        index_entries.append("%d %d\n" % (time_stamp, offset))
+                    except ValueError:
+                        # not indexed, will be read from the previous stream
+                        pass
+            compressed = compressor.compress(data)
+            if block_size:
+                compressed += compressor.flush()
+                compressor = None
+            destination.write(compressed)
+            offset += len(compressed)
+        if compressor is not None:
+            destination.write(compressor.flush())
+    except:
+        # do not leave a broken stream behind
+        destination.truncate(start)
+        os.remove(appending_path)
+        raise
+    finally:
+        original.close()
+        destination.close()
+
+    if index_entries:
+        index_file = open(index_path, "a")
+        index_file.write("".join(index_entries))
+        index_file.close()
+    if remove_source:
+        os.remove(source_path)
+    os.remove(appending_path)
+
+def read_bz2_streams(path, offset=0, end=None):
+    """
+    Yield the decompressed content of all the bz2 streams in path, starting
+    with the one at offset and stopping at end if given. Python's BZ2File
+    stops after the first one.
+    """
+    import bz2
+    source = open(path, "rb")
+    try:
+        source.seek(offset)
+        decompressor = bz2.BZ2Decompressor()
+        while True:
+            chunk_size = BZ2_CHUNK_SIZE
+            if end is not None:
+                chunk_size = max(0, min(chunk_size, end - source.tell()))
+            data = source.read(chunk_size)
+            if not data:
+                break
+            while data:
+                try:
+                    output = decompressor.decompress(data)
+                except EOFError:
+                    # previous stream ended right at the end of a chunk
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                if output:
+                    yield output
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+    finally:
+        source.close()
+
+def read_gzip_members(path, offset=0):
+    """
+    Yield the decompressed content of all the gzip members in path (as written
+    by maintenance.py), starting with the one at offset.
+    """
+    import zlib
+    source = open(path, "rb")
+    try:
+        source.seek(offset)
+        # gzip header and trailer
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = source.read(BZ2_CHUNK_SIZE)
+            if not data:
+                break
+            while data:
+                output = decompressor.decompress(data)
+                if output:
+                    yield output
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    finally:
+        source.close()
+
+class BackgroundCompressor(object):
+    """
+    Compresses files in a separate thread, appending each of them as new bz2
+    streams to its destination and removing it once done. With index_suffix,
+    the files are CSV files and their streams are indexed in a file named
+    after the destination (see append_bz2_stream()).
+    """
+    PENDING_SUFFIX = ".pending"
+
+    def __init__(self, index_suffix=None, block_size=None):
+        self._index_suffix = index_suffix
+        self._block_size = block_size
+        self._queue = Queue.Queue()
+        self.compression_seconds = NULL_METRICS.histogram(None)
+        self._thread = threading.Thread(target=self._work,
+                                        name="BackgroundCompressor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def compress(self, path, compressed_path):
+        self._queue.put((path, compressed_path))
+
+    def wait(self):
+        self._queue.join()
+
+    def __len__(self):
+        # files waiting to be compressed, or being compressed
+        return self._queue.unfinished_tasks
+
+    def _work(self):
+        while True:
+            path, compressed_path = self._queue.get()
+            print >> sys.stderr, "Compressing %s to %s" % (path, compressed_path)
+            index_path = None
+            if self._index_suffix is not None:
+                index_path = compressed_path + self._index_suffix
+            try:
+                with self.compression_seconds.time():
+                    append_bz2_stream(path, compressed_path, index_path,
+                                      self._block_size, remove_source=True)
+            except Exception:
+                print >> sys.stderr, "Error compressing %s:" % path
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+def pending_paths(directory, file_name=None):
+    """
+    Return the paths of the files of directory waiting to be compressed, or
+    only those of file_name if given, in the order they were written.
+
+    They are named <file name>.<pid>-<count>.pending, count going up in each
+    process: pids do not tell which process came first, the modification
+    times do.
+    """
+    pending = []
+    for name in os.listdir(directory):
+        if not name.endswith(BackgroundCompressor.PENDING_SUFFIX):
+            continue
+        base, number = name.rsplit('.', 2)[:2]
+        if file_name is not None and base != file_name:
+            continue
+        try:
+            count = int(number.split('-')[-1])
+        except ValueError:
+            count = 0
+        path = os.path.join(directory, name)
+        try:
+            pending.append((os.path.getmtime(path), count, path))
+        except OSError:
+            # just compressed
+            continue
+    return [path for mtime, count, path in sorted(pending)]
+
+# longest time a file name template may not change for
+MAX_FILE_PERIOD = 4 * 366 * 86400
+
+def _find_path_change(path_template, time_stamp, direction):
+    """
+    Return the first time stamp after time_stamp (or the last one before it if
+    direction is -1) for which path_template gives a different path.
+    """
+    def make_path(time_stamp):
+        return time.strftime(path_template, time.localtime(time_stamp))
+    path = make_path(time_stamp)
+    # exponential search, then bisection
+    same, step = time_stamp, 1
+    while make_path(time_stamp + direction * step) == path:
+        same = time_stamp + direction * step
+        step *= 2
+        if step > MAX_FILE_PERIOD:
+            # the template does not depend on the time
+            return time_stamp + direction * step
+    different = time_stamp + direction * step
+    while abs(different - same) > 1:
+        middle = (same + different) // 2
+        if make_path(middle) == path:
+            same = middle
+        else:
+            different = middle
+    return different
+
+def file_period(path_template, time_stamp):
+    """
+    Return the path given by the strftime template path_template for
+    time_stamp (in local time), and the start and end time stamps of the
+    period for which the template gives that same path, end excluded.
+    """
+    time_stamp = int(time_stamp)
+    return (time.strftime(path_template, time.localtime(time_stamp)),
+            _find_path_change(path_template, time_stamp, -1) + 1,
+            _find_path_change(path_template, time_stamp, 1))
+
 class CsvDataSaver(DataSaver):
+    """
+    Writes "time,power,temperature" lines, or for data points with a sensor
+    "time,power,temperature,sensor,watts of each channel" lines, in one file
+    per day.
+    """
+    SENSORS = True
+    # time, power, temperature, sensor and the channels
+    SENSOR_LINE = ",".join(["%s"] * (4 + CHANNELS)) + "\n"
     FILE_NAME_TEMPLATE = "power.%Y-%m-%d.csv"
-    def __init__(self, directory, compress=False):
+    DURABILITY_MODES = ("os", "batch", "record")
+    BUFFER_SIZE = 64 * 1024
+    INDEX_SUFFIX = ".idx"
+    BACKFILL_SUFFIX = ".backfill"
+
+    SWING_DOOR_FIELDS = ("power", "temperature")
+
+    def __init__(self, directory, compress=False, durability="os",
+                 fsync_every=None, fsync_interval=None, index_interval=256,
+                 compressed_block_size=256*1024, swing_door=None,
+                 swing_door_interval=300, period=6):
+        """
+        durability tells when data is forced to the disk:
+         - "os": when the OS decides to
+         - "batch": every fsync_every records or fsync_interval seconds,
+           whichever comes first (every 100 records if neither is given)
+         - "record": after each record, or each batch given to update_many()
+
+        Unless index_interval is 0, the time and offset of one record every
+        index_interval is written to a sidecar index file (see query.py).
+        Compressed files are then made of one bz2 stream per
+        compressed_block_size bytes of CSV, each one being indexed.
+
+        swing_door is a mapping of "power" and/or "temperature" to their
+        tolerance, in which case only the data points needed to reconstruct
+        the others within tolerance are written (see compression.py), at
+        least every swing_door_interval seconds. Data points are expected
+        every period seconds. The last data point is only written when the
+        next one or a flush() tells whether it is needed, and a flush() makes
+        it needed.
+        """
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError("Unknown durability mode: %s" % durability)
+        self._swing_door = None
+        if swing_door is not None:
+            for field in swing_door:
+                if field not in self.SWING_DOOR_FIELDS:
+                    raise ValueError("Unknown swing door field: %s" % field)
+            tolerances = [swing_door.get(field, 0)
+                          for field in self.SWING_DOOR_FIELDS]
+            self._swing_door = compression.SwingDoorCompressor(
+                    tolerances, swing_door_interval)
+            self._swing_door_header = compression.format_header(period,
+                    swing_door_interval, zip(self.SWING_DOOR_FIELDS,
+                                             tolerances))
         self._directory = os.path.abspath(directory)
         print "CSV: will save in: %s, compress: %s" % (directory, compress)
         self._file = None
         self._file_path = None
+        # the current file is for time stamps in [_period_start, _period_end[
+        self._period_start = 0
+        self._period_end = 0
         self._compress = compress
+        self._compressor = None
+        self._pending_count = 0
+        self._time_formatter = CsvTimeFormatter()
+        self._index_interval = index_interval
+        self._index_file = None
+        self._unindexed_records = 0
+        self._offset = 0
+        self._rotation_seconds = NULL_METRICS.histogram(None)
+        self._sync_seconds = NULL_METRICS.histogram(None)
+
+        self._durability = durability
+        if durability == "batch" and fsync_every is None and fsync_interval is None:
+            fsync_every = 100
+        self._fsync_every = fsync_every
+        self._fsync_interval = fsync_interval
+        self._unsynced_records = 0
+        self._last_sync = time.time()
 
         if not os.path.isdir(directory):
             os.makedirs(directory)
 
-    def _make_file_path(self):
-        file_path_template = os.path.join(self._directory, self.FILE_NAME_TEMPLATE)
-        return time.strftime(file_path_template)
+        if compress:
+            if index_interval:
+                self._compressor = BackgroundCompressor(self.INDEX_SUFFIX,
+                                                        compressed_block_size)
+            else:
+                self._compressor = BackgroundCompressor()
+            # left over by a previous run that did not finish compressing
+            for pending_path in pending_paths(self._directory):
+                self._compressor.compress(pending_path,
+                        pending_path.rsplit('.', 2)[0] + '.bz2')
 
-    def _should_rotate(self):
-        return self._file_path != self._make_file_path()
+    def _path_template(self):
+        return os.path.join(self._directory, self.FILE_NAME_TEMPLATE)
 
-    def _compress_file(self, path):
-        compressed_path = path + '.bz2'
-        print >> sys.stderr, "Compressing %s to %s" % (path, compressed_path)
-        CHUNK_SIZE = 1024*1024
-        original = open(path)
-        destination = bz2.BZ2File(compressed_path, "w")
-        while True:
-            data = original.read(CHUNK_SIZE)
-            if not data:
-                break
-            destination.write(data)
-        original.close()
-        destination.close()
-        os.remove(path)
+    def _should_rotate(self, time_stamp):
+        return not (self._period_start <= time_stamp < self._period_end)
 
-    def _uncompress_file(self, source, target):
-        print >> sys.stderr, "Decompressing %s to %s" % (source, target)
-        CHUNK_SIZE = 1024*1024
-        original = bz2.BZ2File(source, "r")
-        destination = open(target, "a")
-        while True:
-            data = original.read(CHUNK_SIZE)
-            if not data:
-                break
-            destination.write(data)
-        original.close()
-        destination.close()
-        os.remove(source)
+    def set_metrics(self, metrics, name):
+        self._rotation_seconds = metrics.histogram(
+                "cucologger_csv_rotation_seconds", saver=name)
+        self._sync_seconds = metrics.histogram("cucologger_csv_sync_seconds",
+                                               saver=name)
+        if self._compressor:
+            self._compressor.compression_seconds = metrics.histogram(
+                    "cucologger_csv_compression_seconds", saver=name)
+            metrics.gauge("cucologger_csv_compression_backlog",
+                          self._compressor.__len__, saver=name)
 
-    def _rotate(self):
-        self.close()
-        self._file_path = self._make_file_path()
-        if os.path.exists (self._file_path + '.bz2'):
-            self._uncompress_file(self._file_path + '.bz2', self._file_path)
-        print >> sys.stderr, "Rotating: now outputting to file %s" % self._file_path
-        self._file = open(self._file_path, "a")
+    def _sync(self):
+        with self._sync_seconds.time():
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        if self._index_file:
+            self._index_file.flush()
+        self._unsynced_records = 0
+        self._last_sync = time.time()
 
-    def close(self):
+    def _close_file(self, compress=True):
         if self._file:
+            if self._swing_door is not None:
+                self._write_lines(self._format_points(
+                        self._swing_door.flush()))
+                # the next file is expanded on its own
+                self._swing_door.reset()
+            if self._durability != "os":
+                self._sync()
             self._file.close()
-            if self._compress:
-                self._compress_file(self._file_path)
+            compress = compress and self._compress
+            if self._index_file:
+                self._index_file.close()
+                self._index_file = None
+                if compress:
+                    # the compressed file has its own index
+                    os.remove(self._file_path + self.INDEX_SUFFIX)
+            if compress:
+                # renamed so that we can reopen the same path before the
+                # compression is done
+                self._pending_count += 1
+                pending_path = "%s.%d-%d%s" % (self._file_path, os.getpid(),
+                        self._pending_count, BackgroundCompressor.PENDING_SUFFIX)
+                os.rename(self._file_path, pending_path)
+                self._compressor.compress(pending_path,
+                                          self._file_path + '.bz2')
         self._file = None
         self._file_path = None
 
+    def _rotate(self, time_stamp):
+        with self._rotation_seconds.time():
+            self._close_file()
+            self._file_path, self._period_start, self._period_end = file_period(
+                    self._path_template(), time_stamp)
+            print >> sys.stderr, "Rotating: now outputting to file %s" % self._file_path
+            self._file = open(self._file_path, "a", self.BUFFER_SIZE)
+            if self._index_interval:
+                self._offset = os.path.getsize(self._file_path)
+                self._index_file = open(self._file_path + self.INDEX_SUFFIX, "a")
+                # index the first record
+                self._unindexed_records = self._index_interval
+            if self._swing_door is not None:
+                # also after a restart, so that readers do not draw lines
+                # across it
+                self._file.write(self._swing_door_header)
+                self._offset += len(self._swing_door_header)
+
+    def _index(self, time_stamp, line_length):
+        """
+        Account for a line about to be written, indexing it if it is time to.
+        """
+        if self._index_file and isinstance(time_stamp, (int, long)):
+            if self._unindexed_records >= self._index_interval:
+                self._index_file.write("%d %d\n" % (time_stamp, self._offset))
+                self._unindexed_records = 0
+            self._unindexed_records += 1
+        self._offset += line_length
+
+    def wait_for_compression(self):
+        if self._compressor:
+            self._compressor.wait()
+
+    def flush(self):
+        if self._file:
+            if self._swing_door is not None:
+                self._write_lines(self._format_points(
+                        self._swing_door.flush()))
+            if self._durability == "os":
+                self._file.flush()
+                if self._index_file:
+                    self._index_file.flush()
+            else:
+                self._sync()
+
+    def close(self):
+        self._close_file()
+        self.wait_for_compression()
+
+    def detach(self):
+        # the current file is reopened and carried on with, only compressed
+        # once its period is over
+        self._close_file(compress=False)
+        self.wait_for_compression()
+
     def update(self, data_point):
-        if self._should_rotate():
-            self._rotate()
-        print >> self._file, data_point.to_csv()
+        time_stamp = data_point.time
+        if not isinstance(time_stamp, (int, long)):
+            # not from a live parser, file goes by the current time
+            time_stamp = int(time.time())
+        if self._should_rotate(time_stamp):
+            self._rotate(time_stamp)
+
+        if data_point.sensor is not None:
+            self._check_sensors()
+            line = self.SENSOR_LINE % ((self._time_formatter.format(
+                    data_point.time), data_point.power, data_point.temperature,
+                    data_point.sensor) + tuple(data_point.channels))
+        elif (self._swing_door is not None
+                and isinstance(data_point.time, (int, long))):
+            self._write_lines(self._format_points(self._swing_door.add(
+                    time_stamp, (data_point.power, data_point.temperature))))
+            return
+        else:
+            line = "%s,%s,%s\n" % (self._time_formatter.format(
+                    data_point.time), data_point.power, data_point.temperature)
+        self._index(data_point.time, len(line))
+        self._file.write(line)
+        self._written(1)
+
+    def _check_sensors(self):
+        if self._swing_door is not None:
+            raise ValueError("Swing door compression does not support sensors")
+
+    def _update_sensors(self, batch):
+        format_time = self._time_formatter.format
+        line_template = self.SENSOR_LINE
+        lines = []
+        for row in zip(batch.times, batch.powers, batch.temperatures,
+                       batch.sensors, *batch.channels):
+            time_stamp = row[0]
+            if self._should_rotate(time_stamp):
+                self._write_lines(lines)
+                lines = []
+                self._rotate(time_stamp)
+            line = line_template % ((format_time(time_stamp),) + row[1:])
+            self._index(time_stamp, len(line))
+            lines.append(line)
+        self._write_lines(lines)
+
+    def update_many(self, batch):
+        if batch.sensors is not None:
+            self._check_sensors()
+            self._update_sensors(batch)
+            return
+        format_time = self._time_formatter.format
+        swing_door = self._swing_door
+        lines = []
+        for time_stamp, power, temperature in zip(batch.times, batch.powers,
+                                                  batch.temperatures):
+            if self._should_rotate(time_stamp):
+                self._write_lines(lines)
+                lines = []
+                self._rotate(time_stamp)
+            if swing_door is not None:
+                lines.extend(self._format_points(swing_door.add(time_stamp,
+                        (power, temperature))))
+                continue
+            line = "%s,%s,%s\n" % (format_time(time_stamp), power, temperature)
+            self._index(time_stamp, len(line))
+            lines.append(line)
+        self._write_lines(lines)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        """
+        The data points filling the gaps of a day go to a file of their own,
+        <day file>.backfill, kept in time order, that query.py reads and
+        maintenance.py merges into the day.
+        """
+        # imported here, query needs this module
+        import query, history
+        # what we hold has to be on the disk to be read back
+        self.flush()
+        archive = query.CsvArchive(self._directory, self.FILE_NAME_TEMPLATE)
+        batch = history.missing_points(intervals, archive.rows,
+                                       temperature=temperature)
+        format_time = self._time_formatter.format
+        days = []
+        period_end = None
+        for row in zip(batch.times, batch.powers, batch.temperatures):
+            if period_end is None or row[0] >= period_end:
+                path, period_start, period_end = file_period(
+                        self._path_template(), row[0])
+                lines = []
+                days.append((path, lines))
+            lines.append("%s,%s,%s\n" % ((format_time(row[0]),) + row[1:]))
+        for path, lines in days:
+            self._write_backfill(path + self.BACKFILL_SUFFIX, lines)
+
+    def _write_backfill(self, path, lines):
+        if os.path.exists(path):
+            lines = lines + open(path).readlines()
+        # time strings sort like the times
+        lines.sort(key=lambda line: line.split(',', 1)[0])
+        backfill_file = open(path + ".tmp", "w")
+        try:
+            backfill_file.write("".join(lines))
+            backfill_file.flush()
+            os.fsync(backfill_file.fileno())
+        finally:
+            backfill_file.close()
+        os.rename(path + ".tmp", path)
+
+    def _format_points(self, points):
+        lines = []
+        for time_stamp, (power, temperature) in points:
+            line = "%s,%s,%s\n" % (self._time_formatter.format(time_stamp),
+                                   power, temperature)
+            self._index(time_stamp, len(line))
+            lines.append(line)
+        return lines
+
+    def _write_lines(self, lines):
+        if lines:
+            self._file.write("".join(lines))
+            self._written(len(lines))
+
+    def _written(self, record_count):
+        if self._durability == "record":
+            self._sync()
+        elif self._durability == "batch":
+            self._unsynced_records += record_count
+            if (self._fsync_every is not None
+                    and self._unsynced_records >= self._fsync_every):
+                self._sync()
+            elif (self._fsync_interval is not None
+                    and time.time() - self._last_sync >= self._fsync_interval):
+                self._sync()
 
     def __delete__(self):
         self.close()
@@ -190,17 +1468,241 @@ class CurrentTemperature(object):
         return json.dumps({"current_temperature": temp_str})
 
 class ThermostatSaver(DataSaver):
-    def __init__(self, host='127.0.0.1', port=1234):
-        try:
-            self._socket = socket.create_connection((host,port))
-        except socket.error:
-            print >> sys.stderr, "Warning: Could not connect to thermostat"
-            self._socket = None
+    """
+    Sends the current temperature to a thermostat over TCP.
+
+    Sending happens in a separate thread with a non-blocking socket, so
+    update() never waits for the network. Only the latest temperature is
+    kept: it is sent if it differs by at least deadband from the last one
+    sent, at most once every min_interval seconds, and again every
+    max_interval seconds if set. The connection is retried with an
+    exponential backoff, between initial_backoff and max_backoff seconds.
+    close() waits at most close_timeout seconds for the thread to stop.
+    """
+    def __init__(self, host='127.0.0.1', port=1234, deadband=0.0,
+                 min_interval=0, max_interval=60, initial_backoff=1,
+                 max_backoff=60, close_timeout=5):
+        self._address = (host, port)
+        self._deadband = deadband
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._close_timeout = close_timeout
+
+        self._lock = threading.Lock()
+        self._latest = None
+        self._closing = False
+        self._stopped = False
+        # set when close() left the wake pipe to the thread to close
+        self._abandoned = False
+        self._wake_reader, self._wake_writer = os.pipe()
+        for fd in (self._wake_reader, self._wake_writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # only used by the sending thread
+        self._socket = None
+        self._connected = False
+        self._backoff = initial_backoff
+        self._next_attempt = 0
+        self._output = ""
+        self._last_sent = None
+        self._last_send_time = 0
+        self.connections = 0
+
+        self._thread = threading.Thread(target=self._work,
+                                        name="ThermostatSaver sender")
+        self._thread.daemon = True
+        self._thread.start()
 
     def update(self, data_point):
-        if self._socket:
-            temperature = CurrentTemperature(data_point.temperature)
-            self._socket.sendall(temperature.to_json() + "\n")
+        with self._lock:
+            self._latest = data_point.temperature
+        self._wake()
+
+    def update_many(self, batch):
+        # only the current temperature matters
+        if len(batch):
+            self.update(batch[-1])
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+        self._wake()
+        self._thread.join(self._close_timeout)
+        with self._lock:
+            if not self._stopped:
+                # the thread may still select on or read the wake pipe
+                self._abandoned = True
+                print >> sys.stderr, ("%s still running after %ss, leaving "
+                                      "it its wake pipe" % (self._thread.name,
+                                                            self._close_timeout))
+                return
+        self._close_wake_pipe()
+
+    def _close_wake_pipe(self):
+        os.close(self._wake_reader)
+        os.close(self._wake_writer)
+
+    def set_metrics(self, metrics, name):
+        metrics.gauge("cucologger_thermostat_connections",
+                      lambda: self.connections, saver=name)
+        metrics.gauge("cucologger_thermostat_connected",
+                      lambda: int(self._connected), saver=name)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_writer, "x")
+        except OSError:
+            # pipe full, the thread is going to wake up anyway
+            pass
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        error = self._socket.connect_ex(self._address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._disconnect(os.strerror(error))
+        else:
+            self._connected = error == 0
+            if self._connected:
+                self._on_connected()
+
+    def _on_connected(self):
+        self.connections += 1
+        self._backoff = self._initial_backoff
+        # the thermostat does not know anything yet
+        self._last_sent = None
+        self._output = ""
+
+    def _disconnect(self, reason):
+        if self._socket is not None:
+            if self._connected:
+                print >> sys.stderr, "Lost connection to thermostat:", reason
+            else:
+                print >> sys.stderr, "Could not connect to thermostat:", reason
+            self._socket.close()
+        self._socket = None
+        self._connected = False
+        self._output = ""
+        self._next_attempt = time.time() + self._backoff
+        self._backoff = min(self._backoff * 2, self._max_backoff)
+
+    def _should_send(self, temperature, now):
+        if temperature is None or self._output:
+            return False
+        if now - self._last_send_time < self._min_interval:
+            return False
+        if self._changed(temperature):
+            return True
+        return (self._max_interval is not None
+                and now - self._last_send_time >= self._max_interval)
+
+    def _changed(self, temperature):
+        """
+        Whether temperature is worth sending regardless of max_interval.
+        """
+        if self._last_sent is None:
+            return True
+        return (abs(temperature - self._last_sent) >= self._deadband
+                and temperature != self._last_sent)
+
+    def _timeout(self, latest, now):
+        """
+        Return how long we can wait for events, None meaning forever.
+        """
+        if self._socket is None:
+            return max(0, self._next_attempt - now)
+        if not self._connected or self._output:
+            return None
+        timeouts = []
+        # only wait for min_interval to pass if something is then to be sent,
+        # otherwise that deadline stays in the past and we would spin
+        if latest is not None and self._min_interval and \
+                self._changed(latest):
+            timeouts.append(self._last_send_time + self._min_interval - now)
+        if self._max_interval is not None and self._last_sent is not None:
+            timeouts.append(self._last_send_time + self._max_interval - now)
+        if timeouts:
+            return max(0, min(timeouts))
+        return None
+
+    def _work(self):
+        try:
+            self._run()
+        finally:
+            with self._lock:
+                self._stopped = True
+                abandoned = self._abandoned
+            if abandoned:
+                self._close_wake_pipe()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closing:
+                    break
+                latest = self._latest
+            now = time.time()
+
+            if self._socket is None and now >= self._next_attempt:
+                self._connect()
+            if self._connected and self._should_send(latest, now):
+                self._output = CurrentTemperature(latest).to_json() + "\n"
+                self._last_sent = latest
+                self._last_send_time = now
+
+            readers = [self._wake_reader]
+            writers = []
+            if self._socket is not None:
+                readers.append(self._socket)
+                if not self._connected or self._output:
+                    writers.append(self._socket)
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  self._timeout(latest, now))
+
+            if self._wake_reader in readable:
+                try:
+                    os.read(self._wake_reader, 4096)
+                except OSError:
+                    pass
+            if self._socket is not None and self._socket in writable:
+                self._on_writable()
+            if self._socket is not None and self._socket in readable:
+                self._on_readable()
+
+        if self._socket is not None:
+            self._socket.close()
+
+    def _on_writable(self):
+        if not self._connected:
+            error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._disconnect(os.strerror(error))
+                return
+            self._connected = True
+            self._on_connected()
+            return
+        try:
+            sent = self._socket.send(self._output)
+            self._output = self._output[sent:]
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._disconnect(str(e))
+
+    def _on_readable(self):
+        # the thermostat is not supposed to talk, we only watch for it going
+        # away
+        try:
+            data = self._socket.recv(4096)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._disconnect(str(e))
+            return
+        if not data:
+            self._disconnect("connection closed")
 
 if __name__ == '__main__':
     import sys
@@ -210,8 +1712,8 @@ if __name__ == '__main__':
         source = file(sys.argv[1], "r")
         _parser = parser.CSVParser()
     else: # live data
-        source = serial_tools.open_cc128()
-        _parser = parser.CC128LiveParser()
+        source = serial_tools.CC128Source()
+        _parser = parser.CC128StreamLiveParser()
 
     try:
         for line in source:
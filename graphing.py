@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Graphs of the files written by RrdDataSaver, rendered by rrdtool in a pool of
+worker processes and cached as PNG files.
+
+A graph is given by a named GraphDefinition (how long a time span it shows,
+its size...) and the end of its time span, rounded up to a bucket of the
+time one pixel stands for. A cached graph is used as long as no sample was
+added to the RRD files in its time span since it was rendered, so the graph of
+a past period is rendered only once, and the graph of the last day at most
+once per bucket and per new sample.
+
+Cached files are named <definition>-<end>.png, their modification time being
+the last update they show. A graph is rendered to a temporary file first,
+then renamed over the previous one, which requests may still be reading.
+
+    graphing.py RRD_DIRECTORY CACHE_DIRECTORY [PORT]
+
+serves them on http://127.0.0.1:PORT/<definition>.png[?end=<seconds since
+EPOCH>].
+"""
+
+import os, sys, errno, time, threading, multiprocessing, urlparse
+import BaseHTTPServer, SocketServer
+
+import rrdtool
+
+from data_save import RrdDataSaver
+
+class GraphDefinition(object):
+    def __init__(self, name, span, title=None, width=800, height=200,
+                 temperature_scale=0.013):
+        """
+        Power as an area with the temperature as a line, divided by
+        temperature_scale to fit on the same graph, with its own axis.
+        """
+        self.name = name
+        self.span = span
+        self.title = title or name
+        self.width = width
+        self.height = height
+        self.temperature_scale = temperature_scale
+
+    def bucket(self):
+        """
+        Return the time resolution of the graph, in seconds.
+        """
+        return max(RrdDataSaver.SAMPLING_RESOLUTION, self.span // self.width)
+
+    def arguments(self, rrd_directory, path, end):
+        power_file = os.path.join(rrd_directory, RrdDataSaver.POWER_FILE)
+        temperature_file = os.path.join(rrd_directory,
+                                        RrdDataSaver.TEMPERATURE_FILE)
+        return [path,
+                "--start", str(end - self.span),
+                "--end", str(end),
+                "--width", str(self.width),
+                "--height", str(self.height),
+                "--title", self.title,
+                "--vertical-label", "Watts",
+                "--right-axis", "%s:0" % self.temperature_scale,
+                "--right-axis-label", "Celsius",
+                "DEF:pow=%s:power:AVERAGE" % power_file,
+                "DEF:temp=%s:temperature:AVERAGE" % temperature_file,
+                "CDEF:tempscaled=temp,%s,/" % self.temperature_scale,
+                "AREA:pow#FF0000:Power",
+                "LINE:tempscaled#0000FF:Temperature"]
+
+DEFINITIONS = dict((definition.name, definition) for definition in (
+        GraphDefinition("day", 86400, "Last day"),
+        GraphDefinition("week", 7 * 86400, "Last week"),
+        GraphDefinition("month", 31 * 86400, "Last month"),
+        GraphDefinition("year", 366 * 86400, "Last year"),
+        ))
+
+TEMPORARY_SUFFIX = ".tmp"
+
+def _render(arguments):
+    # run in the worker processes
+    rrdtool.graph(*[str(argument) for argument in arguments])
+
+class GraphCache(object):
+    def __init__(self, rrd_directory, cache_directory, definitions=DEFINITIONS,
+                 workers=2, keep=10):
+        """
+        Graphs are rendered by workers processes, or in the calling thread if
+        workers is 0. At most keep graphs are cached per definition.
+        """
+        self._rrd_directory = os.path.abspath(rrd_directory)
+        self._cache_directory = os.path.abspath(cache_directory)
+        self._definitions = definitions
+        self._keep = keep
+        self._pool = None
+        if workers:
+            self._pool = multiprocessing.Pool(workers)
+        self._lock = threading.Lock()
+        # path -> AsyncResult of the renders in progress
+        self._pending = {}
+        # (definition name, end) -> (path, last update)
+        self._cache = {}
+        self.renders = 0
+
+        if not os.path.isdir(self._cache_directory):
+            os.makedirs(self._cache_directory)
+        for file_name in os.listdir(self._cache_directory):
+            path = os.path.join(self._cache_directory, file_name)
+            if file_name.endswith(TEMPORARY_SUFFIX):
+                # render of a previous run that did not finish
+                os.remove(path)
+                continue
+            if not file_name.endswith(".png"):
+                continue
+            try:
+                name, end = file_name[:-len(".png")].rsplit("-", 1)
+                key = name, int(end)
+            except ValueError:
+                continue
+            self._cache[key] = path, int(os.path.getmtime(path))
+
+    def available(self):
+        """
+        Return whether the RRD files the graphs are drawn from exist.
+        """
+        return all(os.path.exists(os.path.join(self._rrd_directory, file_name))
+                   for file_name in (RrdDataSaver.POWER_FILE,
+                                     RrdDataSaver.TEMPERATURE_FILE))
+
+    def _last_update(self):
+        return rrdtool.last(os.path.join(self._rrd_directory,
+                                         RrdDataSaver.POWER_FILE))
+
+    def graph(self, name, end=None):
+        """
+        Return the path of an up to date PNG of the graph name, for the time
+        span ending at end (now by default), rendering it if needed.
+        """
+        try:
+            definition = self._definitions[name]
+        except KeyError:
+            raise ValueError("Unknown graph: %s" % name)
+        if end is None:
+            end = time.time()
+        bucket = definition.bucket()
+        end = (int(end) // bucket + 1) * bucket
+        key = name, end
+        # only the samples in the time span matter
+        last_update = min(self._last_update(), end)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[1] >= last_update:
+                return cached[0]
+            path = os.path.join(self._cache_directory, "%s-%d.png" % (name,
+                                                                       end))
+            rendered_path = "%s.%d%s" % (path, last_update, TEMPORARY_SUFFIX)
+            result = self._pending.get(rendered_path)
+            if result is None:
+                arguments = definition.arguments(self._rrd_directory,
+                                                 rendered_path, end)
+                if self._pool is not None:
+                    result = self._pool.apply_async(_render, (arguments,))
+                    self._pending[rendered_path] = result
+                else:
+                    _render(arguments)
+                self.renders += 1
+
+        if result is not None:
+            try:
+                result.get()
+            finally:
+                with self._lock:
+                    self._pending.pop(rendered_path, None)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None or cached[1] < last_update:
+                os.utime(rendered_path, (last_update, last_update))
+                # requests reading the previous one keep reading it
+                os.rename(rendered_path, path)
+                self._cache[key] = path, last_update
+                self._evict(name)
+            elif os.path.exists(rendered_path):
+                # a newer one was rendered meanwhile
+                os.remove(rendered_path)
+        return path
+
+    def _evict(self, name):
+        keys = sorted(key for key in self._cache if key[0] == name)
+        for key in keys[:-self._keep]:
+            path, last_update = self._cache.pop(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+class _GraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        name = url.path.strip("/")
+        if not name.endswith(".png"):
+            self.send_error(404)
+            return
+        end = urlparse.parse_qs(url.query).get('end')
+        try:
+            end = end and int(end[0])
+        except ValueError:
+            self.send_error(400, "end is seconds since EPOCH")
+            return
+        graphs = self.server.graphs
+        for attempt in xrange(2):
+            try:
+                path = graphs.graph(name[:-len(".png")], end)
+            except ValueError, e:
+                self.send_error(404, str(e))
+                return
+            except rrdtool.error, e:
+                # no data yet, or a time span rrdtool cannot draw
+                self.send_error(400 if graphs.available() else 404, str(e))
+                return
+            try:
+                png = open(path, "rb").read()
+                break
+            except IOError, e:
+                # evicted meanwhile, rendered again on the next attempt
+                if e.errno != errno.ENOENT or attempt:
+                    raise
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.end_headers()
+        self.wfile.write(png)
+
+class GraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, graphs, port=8080, address='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), _GraphHandler)
+        self.graphs = graphs
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print >> sys.stderr, ("Usage: %s RRD_DIRECTORY CACHE_DIRECTORY [PORT]"
+                              % sys.argv[0])
+        sys.exit(1)
+    graphs = GraphCache(sys.argv[1], sys.argv[2])
+    port = 8080
+    if len(sys.argv) > 3:
+        port = int(sys.argv[3])
+    server = GraphServer(graphs, port)
+    print "Serving graphs on http://127.0.0.1:%d/<%s>.png" % (
+            port, "|".join(sorted(DEFINITIONS)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print >> sys.stderr, "\nBye!"
+    finally:
+        graphs.close()
@@ -0,0 +1,190 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Filling the gaps left by downtime from the energy history of the CC128.
+
+Every now and then, the CC128 sends the kWh used by each sensor over the last
+two hour periods ("h" entries), days ("d") and months ("m"). Each of them is
+turned into an Interval, and a saver that can add past data compares it with
+what it holds: where it has no data for more than max_gap seconds, it adds
+one data point every period seconds, with the power that accounts for the
+energy of the interval missing from what it holds. Intervals are handled
+from the shortest to the longest, so that a day only spreads what its two
+hour periods did not explain, and data points already there are never
+touched. Nothing is added where there is no gap, so the same history can be
+given again.
+
+Only the whole house (sensor 0) is filled in: the history does not tell the
+channels apart.
+"""
+
+import time
+
+from parser import DataPoint, DataPointBatch
+
+UNITS = ("h", "d", "m")
+PERIOD = 6
+MAX_GAP = 60
+
+class Interval(object):
+    __slots__ = ('sensor', 'unit', 'start', 'end', 'energy')
+
+    def __init__(self, sensor, unit, start, end, energy):
+        """
+        energy is in Wh, used between start and end, in seconds since EPOCH.
+        """
+        self.sensor = sensor
+        self.unit = unit
+        self.start = start
+        self.end = end
+        self.energy = energy
+
+    def __repr__(self):
+        return "Interval(sensor=%d, %s, start=%d, end=%d, energy=%s)" % (
+                self.sensor, self.unit, self.start, self.end, self.energy)
+
+def _local_time(year, month, day, hour=0):
+    # mktime() normalizes days out of range, and -1 lets it find out about
+    # daylight saving time
+    return int(time.mktime((year, month, day, hour, 0, 0, 0, 0, -1)))
+
+def _bounds(time_stamp, unit, age):
+    # the CC128 keeps its history in local time
+    now = time.localtime(time_stamp)
+    if unit == "h":
+        end = _local_time(now.tm_year, now.tm_mon, now.tm_mday,
+                          now.tm_hour - (age - 2))
+        return end - 7200, end
+    if unit == "d":
+        return (_local_time(now.tm_year, now.tm_mon, now.tm_mday - age),
+                _local_time(now.tm_year, now.tm_mon, now.tm_mday - age + 1))
+    months = now.tm_year * 12 + now.tm_mon - 1 - age
+    year, month = divmod(months, 12)
+    start = _local_time(year, month + 1, 1)
+    year, month = divmod(months + 1, 12)
+    return start, _local_time(year, month + 1, 1)
+
+def intervals(record, units=UNITS):
+    """
+    Return the Intervals of a parser.HistoryRecord whose time is in seconds
+    since EPOCH, for the given units. The current periods are left out.
+    """
+    result = []
+    for sensor, unit, age, kwh in record.entries:
+        if unit not in units:
+            continue
+        start, end = _bounds(record.time, unit, age)
+        if end <= record.time:
+            result.append(Interval(sensor, unit, start, end, kwh * 1000))
+    return result
+
+def missing_points(intervals, held, period=PERIOD, max_gap=MAX_GAP,
+                   temperature=None):
+    """
+    Return a DataPointBatch, in time order, of the data points filling the
+    gaps in each interval. held(start, end) gives the (time, power,
+    temperature) of the data held between start and end. The data points
+    added take the temperature of the data held before or after them, or
+    temperature.
+    """
+    added = []
+    for interval in sorted(intervals, key=lambda interval: (
+            interval.end - interval.start, interval.start)):
+        start, end = interval.start, interval.end
+        rows = list(held(start, end))
+        rows.extend(row for row in added if start <= row[0] < end)
+        rows.sort()
+        held_energy = sum(row[1] for row in rows) * period / 3600.
+
+        # the gaps, as lists of times, and the temperature to use
+        gaps = []
+        previous_time = start - period
+        previous_temperature = None
+        for next_time, power, next_temperature in rows + [(end, None, None)]:
+            if next_time - previous_time > max_gap:
+                gap_temperature = previous_temperature
+                if gap_temperature is None:
+                    gap_temperature = next_temperature
+                if gap_temperature is None:
+                    gap_temperature = temperature
+                gaps.append((range(previous_time + period,
+                                   next_time - period + 1, period),
+                             gap_temperature))
+            previous_time = next_time
+            previous_temperature = next_temperature
+        count = sum(len(times) for times, gap_temperature in gaps)
+        if not count:
+            continue
+        if any(gap_temperature is None for times, gap_temperature in gaps):
+            # nothing to go by
+            continue
+        power = max(0, int(round((interval.energy - held_energy) * 3600.
+                                 / (count * period))))
+        for times, gap_temperature in gaps:
+            added.extend((time_stamp, power, gap_temperature)
+                         for time_stamp in times)
+    added.sort()
+    return DataPointBatch.from_data_points(
+            [DataPoint(*row) for row in added])
+
+class Backfiller(object):
+    """
+    Gives the intervals of the history the savers have not seen yet to their
+    backfill() method.
+    """
+    def __init__(self, savers, units=("h", "d"), max_age=7 * 86400):
+        """
+        Only intervals less than max_age seconds old are filled in, so that
+        the first start does not make up years of data.
+        """
+        for unit in units:
+            if unit not in UNITS:
+                raise ValueError("Unknown history unit: %s" % unit)
+        self.savers = savers
+        self._units = tuple(units)
+        self._max_age = max_age
+        # (device, start, end) of the intervals given to the savers
+        self._done = set()
+        # device -> last temperature
+        self._temperatures = {}
+        self.intervals = 0
+
+    def seen(self, batch, device=None):
+        """
+        Keep the latest temperature of device, for the data points added in
+        gaps with no data around.
+        """
+        if len(batch):
+            self._temperatures[device] = batch.temperatures[-1]
+
+    def add(self, record, device=None):
+        limit = record.time - self._max_age
+        fresh = [interval for interval in intervals(record, self._units)
+                 if interval.sensor == 0 and interval.start >= limit
+                 and (device, interval.start, interval.end) not in self._done]
+        temperature = self._temperatures.get(device)
+        if not fresh or temperature is None:
+            # the history comes again, by when we have seen some data
+            return
+        for saver in self.savers:
+            saver.backfill(fresh, device, temperature)
+        self.intervals += len(fresh)
+        self._done = set(key for key in self._done if key[1] >= limit)
+        self._done.update((device, interval.start, interval.end)
+                          for interval in fresh)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The latest data points, kept in memory and served over HTTP to any number of
+local clients, without reading anything from the disk:
+
+    GET /latest
+        {"time": ..., "power": ..., "temperature": ...}, 404 if there is no
+        data yet
+    GET /range?start=...&end=...
+        [[time, power, temperature], ...] with start <= time < end, in
+        seconds since EPOCH, the whole buffer by default
+    GET /stream
+        Server-sent events, one "data: {...}" event per data point as they
+        come. Clients give the last event id they saw in a Last-Event-ID
+        header when reconnecting, and get what they missed if it is still in
+        the buffer.
+
+    live.py [PORT]
+
+serves simulated data, for trying out a dashboard.
+"""
+
+import sys, time, json, array, threading, urlparse
+import BaseHTTPServer, SocketServer
+
+from data_save import DataSaver
+
+class RingBuffer(object):
+    """
+    The last capacity data points, in arrays allocated once. Data points are
+    numbered from 1 as they are added; out of order ones are left out, so
+    that times only go up.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("A ring buffer needs some room")
+        self._capacity = capacity
+        self._times = array.array('l', [0] * capacity)
+        self._powers = array.array('l', [0] * capacity)
+        self._temperatures = array.array('d', [0.0] * capacity)
+        # physical index of the oldest data point
+        self._start = 0
+        self._count = 0
+        # number of the newest data point
+        self.sequence = 0
+        # notified when data points are added
+        self.changed = threading.Condition()
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, time_stamp, power, temperature):
+        if self._count and time_stamp <= self._times[
+                (self._start + self._count - 1) % self._capacity]:
+            return
+        if self._count < self._capacity:
+            index = (self._start + self._count) % self._capacity
+            self._count += 1
+        else:
+            index = self._start
+            self._start = (self._start + 1) % self._capacity
+        self._times[index] = time_stamp
+        self._powers[index] = power
+        self._temperatures[index] = temperature
+        self.sequence += 1
+
+    def extend(self, times, powers, temperatures):
+        with self.changed:
+            append = self._append
+            for row in zip(times, powers, temperatures):
+                append(*row)
+            # woken up once per batch, however many clients
+            self.changed.notify_all()
+
+    def _row(self, position):
+        index = (self._start + position) % self._capacity
+        return self._times[index], self._powers[index], self._temperatures[index]
+
+    def latest(self):
+        """
+        Return the newest (time, power, temperature), None if empty.
+        """
+        with self.changed:
+            if not self._count:
+                return None
+            return self._row(self._count - 1)
+
+    def _position(self, time_stamp):
+        # first position with a time >= time_stamp
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._times[(self._start + middle) % self._capacity] < time_stamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start=None, end=None):
+        """
+        Return the (time, power, temperature) tuples with start <= time < end.
+        """
+        with self.changed:
+            first = 0
+            if start is not None:
+                first = self._position(start)
+            last = self._count
+            if end is not None:
+                last = self._position(end)
+            return [self._row(position) for position in xrange(first, last)]
+
+    def since(self, sequence):
+        """
+        Return the number of the newest data point and the data points
+        numbered after sequence that are still in the buffer.
+        """
+        with self.changed:
+            missing = min(self.sequence - sequence, self._count)
+            return self.sequence, [self._row(position) for position in
+                                   xrange(self._count - missing, self._count)]
+
+    def wait(self, sequence, timeout):
+        """
+        Wait up to timeout seconds for data points numbered after sequence.
+        """
+        with self.changed:
+            if self.sequence <= sequence:
+                self.changed.wait(timeout)
+
+def _point_json(row):
+    return json.dumps({'time': row[0], 'power': row[1],
+                       'temperature': row[2]})
+
+class _LiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # a comment line every so often, so that we notice gone clients
+    KEEP_ALIVE_INTERVAL = 15
+
+    def _send_json(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        ring = self.server.buffer
+        if url.path == "/latest":
+            row = ring.latest()
+            if row is None:
+                self.send_error(404, "No data yet")
+                return
+            self._send_json(_point_json(row))
+        elif url.path == "/range":
+            query = urlparse.parse_qs(url.query)
+            try:
+                start, end = [int(query[name][0]) if name in query else None
+                              for name in ('start', 'end')]
+            except ValueError:
+                self.send_error(400, "start and end are seconds since EPOCH")
+                return
+            self._send_json(json.dumps([list(row) for row in
+                                        ring.range(start, end)]))
+        elif url.path == "/stream":
+            self._stream()
+        else:
+            self.send_error(404)
+
+    def _stream(self):
+        sequence = buffer_sequence = self.server.buffer.sequence
+        try:
+            sequence = min(int(self.headers.get('Last-Event-ID')),
+                           buffer_sequence)
+        except (TypeError, ValueError):
+            pass
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.server.add_client()
+        try:
+            last_write = time.time()
+            while not self.server.closing:
+                self.server.buffer.wait(sequence, 1)
+                sequence, rows = self.server.buffer.since(sequence)
+                if rows:
+                    first = sequence - len(rows) + 1
+                    self.wfile.write("".join(
+                            "id: %d\ndata: %s\n\n" % (first + i, _point_json(row))
+                            for i, row in enumerate(rows)))
+                elif time.time() - last_write >= self.KEEP_ALIVE_INTERVAL:
+                    self.wfile.write(":\n\n")
+                else:
+                    continue
+                self.wfile.flush()
+                last_write = time.time()
+        except IOError:
+            # the client went away
+            pass
+        finally:
+            self.server.remove_client()
+
+    def log_message(self, format, *args):
+        # dashboards poll, not worth logging
+        pass
+
+class LiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, ring, port=8081, address='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), _LiveHandler)
+        self.buffer = ring
+        self.closing = False
+        self.clients = 0
+        self._clients_lock = threading.Lock()
+
+    def add_client(self):
+        with self._clients_lock:
+            self.clients += 1
+
+    def remove_client(self):
+        with self._clients_lock:
+            self.clients -= 1
+
+class LiveDataSaver(DataSaver):
+    def __init__(self, retention=3600, period=6, port=8081,
+                 address='127.0.0.1'):
+        """
+        Keeps about retention seconds of data points, received every period
+        seconds, and serves them on http://address:port/ from a separate
+        thread.
+        """
+        self.buffer = RingBuffer(int(retention / period) + 1)
+        self._server = LiveServer(self.buffer, port, address)
+        self.port = self._server.server_address[1]
+        print "Live data: serving on http://%s:%d/" % (address, self.port)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="live endpoint")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, data_point):
+        assert(isinstance(data_point.time, (int, long)))
+        self.buffer.extend((data_point.time,), (data_point.power,),
+                           (data_point.temperature,))
+
+    def update_many(self, batch):
+        self.buffer.extend(batch.times, batch.powers, batch.temperatures)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._server.closing = True
+        with self.buffer.changed:
+            self.buffer.changed.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._thread = None
+
+    def set_metrics(self, metrics, name):
+        metrics.gauge("cucologger_live_clients", lambda: self._server.clients,
+                      saver=name)
+
+if __name__ == '__main__':
+    from simulator import SimulatedCC128
+    from parser import CC128StreamLiveParser
+    port = 8081
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    saver = LiveDataSaver(port=port)
+    parser = CC128StreamLiveParser()
+    try:
+        for message in SimulatedCC128():
+            saver.update_many(parser.parse_batch(message))
+    except KeyboardInterrupt:
+        print >> sys.stderr, "\nBye!"
+    finally:
+        saver.close()
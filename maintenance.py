@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Maintenance of a CsvDataSaver directory:
+
+    maintenance.py [-j JOBS] [--verify] DIRECTORY
+
+Everything left for each past day (the .csv.bz2 file, uncompressed .csv
+files, .pending files that a killed logger did not finish compressing, the
+.backfill file of data filled in from the CC128 history) is
+merged into one .csv.gz file, in parallel. Rows found twice (a .pending file
+that was compressed but not removed...) are only kept once, what a killed
+compression left at the end of the .bz2 file is left out (its .pending file
+has it), and rows are sorted by time, after the swing-door header if there
+is one. The gzip file is made
+of one member per block of CSV, each member being indexed in a .csv.gz.idx
+file like the .bz2 ones, and decodes several times faster than bzip2.
+
+The new file is decompressed and checked against the row count and the SHA-1
+of the merged data before anything is removed. The row count, SHA-1, size
+and modification time of each .csv.gz file are kept in maintenance.state.json,
+so that later runs only look at days that got new files or whose .csv.gz file
+changed; --verify checks all of them again.
+"""
+
+import os, sys, time, json, zlib, hashlib, argparse, multiprocessing
+import traceback
+
+from parser import CSVTimeParser
+from data_save import (CsvDataSaver, BackgroundCompressor, file_period,
+                       pending_paths, read_bz2_streams, read_gzip_members,
+                       killed_append_sizes, APPENDING_SUFFIX)
+
+STATE_FILE = "maintenance.state.json"
+GZIP_SUFFIX = ".gz"
+BZ2_SUFFIX = ".bz2"
+TEMPORARY_SUFFIX = ".tmp"
+# not before, in case the logger is still compressing the day
+GRACE_PERIOD = 3600
+
+def _day_file(file_name, template=CsvDataSaver.FILE_NAME_TEMPLATE):
+    """
+    Return the name of the uncompressed file of the day file_name is about,
+    None if file_name is not a data file.
+    """
+    if file_name.endswith(BackgroundCompressor.PENDING_SUFFIX):
+        # <day file>.<pid>-<count>.pending
+        base = file_name.rsplit('.', 2)[0]
+    elif file_name.endswith(CsvDataSaver.INDEX_SUFFIX):
+        return None
+    elif file_name.endswith(CsvDataSaver.BACKFILL_SUFFIX):
+        base = file_name[:-len(CsvDataSaver.BACKFILL_SUFFIX)]
+    elif file_name.endswith(GZIP_SUFFIX):
+        base = file_name[:-len(GZIP_SUFFIX)]
+    elif file_name.endswith(BZ2_SUFFIX):
+        base = file_name[:-len(BZ2_SUFFIX)]
+    else:
+        base = file_name
+    try:
+        time.strptime(base, template)
+    except ValueError:
+        return None
+    return base
+
+def _day_end(day_file, template=CsvDataSaver.FILE_NAME_TEMPLATE):
+    start = int(time.mktime(time.strptime(day_file, template)))
+    return file_period(template, start)[2]
+
+def _sources(directory, day_file, file_names):
+    """
+    Return the paths of the files holding the data of day_file, older data
+    first.
+    """
+    pending = [os.path.basename(path)
+               for path in pending_paths(directory, day_file)]
+    candidates = ([day_file + GZIP_SUFFIX, day_file + BZ2_SUFFIX] + pending +
+                  [day_file, day_file + CsvDataSaver.BACKFILL_SUFFIX])
+    return [os.path.join(directory, file_name) for file_name in candidates
+            if file_name in file_names]
+
+def read_data(path):
+    if path.endswith(GZIP_SUFFIX):
+        return "".join(read_gzip_members(path))
+    if path.endswith(BZ2_SUFFIX):
+        end = None
+        sizes = killed_append_sizes(path)
+        if sizes is not None:
+            # the rest is in the .pending file it was compressing
+            end = sizes[0]
+        return "".join(read_bz2_streams(path, end=end))
+    data_file = open(path)
+    try:
+        return data_file.read()
+    finally:
+        data_file.close()
+
+def merge(datas):
+    """
+    Return the merged CSV data, its number of rows and the number of
+    duplicate rows left out.
+    """
+    headers = []
+    rows = []
+    seen = set()
+    duplicates = 0
+    for data in datas:
+        for line in data.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                # the swing-door header of each file, the same for all
+                if line not in headers:
+                    headers.append(line)
+                continue
+            if line in seen:
+                duplicates += 1
+                continue
+            seen.add(line)
+            rows.append(line)
+    # time strings sort like the times
+    rows.sort(key=lambda line: line.split(',', 1)[0])
+    return ("".join(line + "\n" for line in headers + rows), len(seen),
+            duplicates)
+
+def write_gzip(data, path, index_path, block_size=256*1024, level=6):
+    """
+    Write data as one gzip member per block_size bytes or so, cut at line
+    boundaries, indexing the time of the first row of each member.
+    """
+    time_parser = CSVTimeParser()
+    index_entries = []
+    offset = 0
+    position = 0
+    destination = open(path, "wb")
+    try:
+        while position < len(data):
+            end = data.find("\n", position + block_size)
+            if end < 0:
+                end = len(data)
+            else:
+                end += 1
+            block = data[position:end]
+            for line in block.split("\n", 3)[:3]:
+                if line and not line.startswith('#'):
+                    try:
+                        time_stamp = time_parser.parse(line[:line.index(",")])
+                        index_entries.append("%d %d\n" % (time_stamp, offset))
+                    except ValueError:
+                        pass
+                    break
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            member = compressor.compress(block) + compressor.flush()
+            destination.write(member)
+            offset += len(member)
+            position = end
+        destination.flush()
+        os.fsync(destination.fileno())
+    finally:
+        destination.close()
+    index_file = open(index_path, "w")
+    try:
+        index_file.write("".join(index_entries))
+    finally:
+        index_file.close()
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _rows(data):
+    return sum(1 for line in data.splitlines()
+               if line and not line.startswith('#'))
+
+def process_day(task):
+    """
+    Merge the sources of a day into its .csv.gz file. Run in the worker
+    processes, return a dictionary describing the result.
+    """
+    directory, day_file, sources, block_size, level = task
+    result = {'day': day_file, 'sources': [os.path.basename(path)
+                                           for path in sources]}
+    try:
+        data, rows, duplicates = merge([read_data(path) for path in sources])
+        digest = _digest(data)
+        gzip_path = os.path.join(directory, day_file + GZIP_SUFFIX)
+        index_path = gzip_path + CsvDataSaver.INDEX_SUFFIX
+        write_gzip(data, gzip_path + TEMPORARY_SUFFIX,
+                   index_path + TEMPORARY_SUFFIX, block_size, level)
+
+        written = "".join(read_gzip_members(gzip_path + TEMPORARY_SUFFIX))
+        if _digest(written) != digest or _rows(written) != rows:
+            os.remove(gzip_path + TEMPORARY_SUFFIX)
+            os.remove(index_path + TEMPORARY_SUFFIX)
+            raise ValueError("%s does not match its sources" % gzip_path)
+
+        os.rename(index_path + TEMPORARY_SUFFIX, index_path)
+        os.rename(gzip_path + TEMPORARY_SUFFIX, gzip_path)
+        # only now that their data is safe elsewhere
+        for path in sources:
+            if path == gzip_path:
+                continue
+            os.remove(path)
+            for suffix in (CsvDataSaver.INDEX_SUFFIX, APPENDING_SUFFIX):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        stat = os.stat(gzip_path)
+        result.update(rows=rows, duplicates=duplicates, sha1=digest,
+                      size=stat.st_size, mtime=stat.st_mtime)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+def verify_day(task):
+    """
+    Check a .csv.gz file against its state.
+    """
+    path, state = task
+    result = {'day': os.path.basename(path)[:-len(GZIP_SUFFIX)]}
+    try:
+        data = read_data(path)
+        if _digest(data) != state['sha1'] or _rows(data) != state['rows']:
+            result['error'] = "%s does not match its recorded SHA-1 and rows" % (
+                    path)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+class Maintenance(object):
+    def __init__(self, directory, jobs=None, block_size=256*1024, level=6,
+                 grace_period=GRACE_PERIOD):
+        self._directory = os.path.abspath(directory)
+        self._jobs = jobs
+        self._block_size = block_size
+        self._level = level
+        self._grace_period = grace_period
+        self._state_path = os.path.join(self._directory, STATE_FILE)
+        self.state = {}
+        if os.path.exists(self._state_path):
+            self.state = json.load(open(self._state_path))
+
+    def _save_state(self):
+        state_file = open(self._state_path + TEMPORARY_SUFFIX, "w")
+        try:
+            json.dump(self.state, state_file, indent=1, sort_keys=True)
+        finally:
+            state_file.close()
+        os.rename(self._state_path + TEMPORARY_SUFFIX, self._state_path)
+
+    def _up_to_date(self, day_file, file_names):
+        gzip_name = day_file + GZIP_SUFFIX
+        state = self.state.get(day_file)
+        if state is None or gzip_name not in file_names:
+            return False
+        if gzip_name + CsvDataSaver.INDEX_SUFFIX not in file_names:
+            return False
+        stat = os.stat(os.path.join(self._directory, gzip_name))
+        return (stat.st_size == state['size']
+                and stat.st_mtime == state['mtime'])
+
+    def tasks(self, now=None):
+        """
+        Return the tasks for process_day() for the days that need it.
+        """
+        if now is None:
+            now = time.time()
+        file_names = set(os.listdir(self._directory))
+        days = {}
+        for file_name in file_names:
+            day_file = _day_file(file_name)
+            if day_file is not None:
+                days.setdefault(day_file, []).append(file_name)
+        tasks = []
+        for day_file in sorted(days):
+            if _day_end(day_file) + self._grace_period > now:
+                continue
+            if all(file_name == day_file + GZIP_SUFFIX
+                   for file_name in days[day_file]) and self._up_to_date(
+                           day_file, file_names):
+                continue
+            tasks.append((self._directory, day_file,
+                          _sources(self._directory, day_file, file_names),
+                          self._block_size, self._level))
+        return tasks
+
+    def _run(self, function, tasks):
+        pool = multiprocessing.Pool(self._jobs)
+        try:
+            for result in pool.imap_unordered(function, tasks):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def run(self, now=None):
+        """
+        Process the days that need it, return the results of process_day().
+        """
+        results = []
+        for result in self._run(process_day, self.tasks(now)):
+            results.append(result)
+            if 'error' in result:
+                print >> sys.stderr, "%s: failed:\n%s" % (result['day'],
+                                                          result['error'])
+                continue
+            print >> sys.stderr, "%s: %d rows from %s, %d duplicates" % (
+                    result['day'], result['rows'], ", ".join(result['sources']),
+                    result['duplicates'])
+            self.state[result['day']] = dict((key, result[key]) for key in
+                    ('rows', 'sha1', 'size', 'mtime'))
+            # a later run does not redo what was done if we get killed
+            self._save_state()
+        return results
+
+    def verify(self):
+        """
+        Check all the .csv.gz files against the state, return the results of
+        verify_day().
+        """
+        tasks = [(os.path.join(self._directory, day_file + GZIP_SUFFIX), state)
+                 for day_file, state in sorted(self.state.iteritems())]
+        results = list(self._run(verify_day, tasks))
+        for result in results:
+            if 'error' in result:
+                print >> sys.stderr, "%s: %s" % (result['day'],
+                                                 result['error'])
+        return results
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+            description="Recompress, merge and index CsvDataSaver files")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="number of worker processes (default: number of CPUs)")
+    arg_parser.add_argument("--verify", action="store_true",
+            help="also check all the already processed days")
+    arg_parser.add_argument("directory", help="CsvDataSaver directory")
+    args = arg_parser.parse_args()
+
+    maintenance = Maintenance(args.directory, args.jobs)
+    results = maintenance.run()
+    if args.verify:
+        results += maintenance.verify()
+    if any('error' in result for result in results):
+        sys.exit(1)
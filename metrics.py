@@ -0,0 +1,308 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counters, gauges and latency histograms, exported as a JSON stats file
+rewritten periodically and/or on a local HTTP endpoint in the Prometheus text
+format.
+
+Metrics are identified by a name and optional labels. Counters and
+histograms are updated in place; gauges are functions called at export time,
+so that existing counters such as QueuedDataSaver.dropped cost nothing more.
+When metrics are disabled, NULL_METRICS hands out objects that do nothing.
+"""
+
+import os, time, json, bisect, threading, traceback
+import BaseHTTPServer
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram(object):
+    """
+    Counts observed values (durations in seconds) in fixed buckets.
+    """
+    # upper bounds, from 50us to 10s
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        # the last one is for anything above the last bound
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """
+        Return a context manager observing the time spent in its block.
+        """
+        return Timer(self)
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the given fraction of the
+        values, None if there are none (or infinity).
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.iteritems()))
+
+def _format_name(name, labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (label, str(value)
+            .replace('\\', '\\\\').replace('"', '\\"'))
+            for label, value in labels))
+
+class Metrics(object):
+    enabled = True
+    BUCKET_LABELS = tuple(repr(bound) for bound in Histogram.BUCKETS) + ("+Inf",)
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.setdefault(_key(name, labels), Counter())
+
+    def histogram(self, name, **labels):
+        with self._lock:
+            return self._histograms.setdefault(_key(name, labels), Histogram())
+
+    def gauge(self, name, function, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = function
+
+    def _gauge_values(self):
+        with self._lock:
+            gauges = self._gauges.items()
+        values = []
+        for key, function in sorted(gauges):
+            try:
+                values.append((key, function()))
+            except Exception:
+                traceback.print_exc()
+        return values
+
+    def to_dict(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        result = {'time': time.time(), 'counters': {}, 'gauges': {},
+                  'histograms': {}}
+        for (name, labels), counter in counters:
+            result['counters'][_format_name(name, labels)] = counter.value
+        for (name, labels), value in self._gauge_values():
+            result['gauges'][_format_name(name, labels)] = value
+        for (name, labels), histogram in histograms:
+            result['histograms'][_format_name(name, labels)] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.percentile(.5),
+                    'p90': histogram.percentile(.9),
+                    'p99': histogram.percentile(.99),
+                    }
+        return result
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        lines = []
+        typed = set()
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, metric_type))
+        for (name, labels), counter in counters:
+            add_type(name, "counter")
+            lines.append("%s %s" % (_format_name(name, labels), counter.value))
+        for (name, labels), value in self._gauge_values():
+            add_type(name, "gauge")
+            lines.append("%s %s" % (_format_name(name, labels), value))
+        for (name, labels), histogram in histograms:
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKET_LABELS, histogram.counts):
+                cumulative += count
+                lines.append("%s %d" % (_format_name(name + "_bucket", labels,
+                        (("le", bound),)), cumulative))
+            lines.append("%s %r" % (_format_name(name + "_sum", labels),
+                                    histogram.sum))
+            lines.append("%s %d" % (_format_name(name + "_count", labels),
+                                    histogram.count))
+        return "\n".join(lines) + "\n"
+
+class _NullCounter(object):
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+class _NullHistogram(object):
+    count = 0
+    # not even reading the clock
+    _timer = _NullTimer()
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return self._timer
+
+class NullMetrics(object):
+    """
+    What savers and the logger report to when metrics are disabled.
+    """
+    enabled = False
+    _counter = _NullCounter()
+    _histogram = _NullHistogram()
+
+    def counter(self, name, **labels):
+        return self._counter
+
+    def histogram(self, name, **labels):
+        return self._histogram
+
+    def gauge(self, name, function, **labels):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+class StatsFileWriter(object):
+    """
+    Rewrites path with the JSON of metrics every interval seconds, and a last
+    time on close().
+    """
+    def __init__(self, metrics, path, interval=10):
+        self._metrics = metrics
+        self._path = os.path.abspath(path)
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._work,
+                                        name="stats file writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self):
+        # readers never see a partial file
+        temporary_path = self._path + ".tmp"
+        stats_file = open(temporary_path, "w")
+        try:
+            json.dump(self._metrics.to_dict(), stats_file, indent=1,
+                      sort_keys=True)
+        finally:
+            stats_file.close()
+        os.rename(temporary_path, self._path)
+
+    def _work(self):
+        while not self._stop.is_set():
+            self._stop.wait(self._interval)
+            try:
+                self.write()
+            except EnvironmentError:
+                traceback.print_exc()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+class _PrometheusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.to_prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scraped every few seconds, not worth logging
+        pass
+
+class PrometheusServer(object):
+    """
+    Serves metrics on http://address:port/metrics from a separate thread.
+    """
+    def __init__(self, metrics, port=9108, address='127.0.0.1'):
+        self._server = BaseHTTPServer.HTTPServer((address, port),
+                                                 _PrometheusHandler)
+        self._server.metrics = metrics
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="prometheus endpoint")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+class Timer(object):
+    """
+    Context manager observing the time spent in its block in histogram.
+    """
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._histogram.observe(time.time() - self._start)
@@ -16,30 +16,219 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time, calendar
-from bs4 import BeautifulSoup
-import serial
+import time, calendar, array
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
-import serial_tools
+import compression
 
 CSV_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# clamps of a CC128 sensor
+CHANNELS = 3
+
 class DataPoint(object):
-    def __init__(self, time, power, temperature):
+    # device is the name of the CC128 the data comes from, None when there is
+    # only one. sensor is the CC128 sensor number (0 for the whole house, 1 to
+    # 9 for appliance monitors) and channels the watts of each of its
+    # CHANNELS clamps, power being their sum. Both are None unless the parser
+    # reads the sensors, power being then the first channel of any sensor.
+    __slots__ = ('time', 'power', 'temperature', 'device', 'sensor',
+                 'channels')
+
+    def __init__(self, time, power, temperature, device=None, sensor=None,
+                 channels=None):
         self.time = time
         self.power = power
         self.temperature = temperature
+        self.device = device
+        self.sensor = sensor
+        self.channels = channels
 
     def __repr__(self):
-        return "DataPoint(time=%s, power=%s, temperature=%s)" % (self.time,
-                self.power, self.temperature)
+        extra = ""
+        if self.device is not None:
+            extra += ", device=%s" % self.device
+        if self.sensor is not None:
+            extra += ", sensor=%s, channels=%s" % (self.sensor, self.channels)
+        return "DataPoint(time=%s, power=%s, temperature=%s%s)" % (
+                self.time, self.power, self.temperature, extra)
 
     def to_csv(self):
         try:
             time_string = time.strftime(CSV_TIME_FORMAT, time.gmtime(self.time))
         except TypeError:
             time_string = self.time
-        return "%s,%s,%s" % (time_string, self.power, self.temperature)
+        if self.sensor is None:
+            return "%s,%s,%s" % (time_string, self.power, self.temperature)
+        return "%s,%s,%s,%s,%s" % (time_string, self.power, self.temperature,
+                                   self.sensor,
+                                   ",".join(str(watts) for watts in self.channels))
+
+class HistoryRecord(object):
+    """
+    The energy history sent by the CC128 every now and then: entries are
+    (sensor, unit, age, kWh) tuples, unit being "h" (the two hours starting
+    age hours before the current hour, so that age 2 ends when the current
+    hour starts), "d" (age days ago) or "m" (age months ago). See history.py.
+    """
+    __slots__ = ('time', 'entries')
+
+    def __init__(self, time, entries):
+        self.time = time
+        self.entries = entries
+
+    def __repr__(self):
+        return "HistoryRecord(time=%s, %d entries)" % (self.time,
+                                                      len(self.entries))
+
+class DataPointBatch(object):
+    """
+    Many data points from the same device stored as arrays of times (in
+    seconds since EPOCH), powers and temperatures. Iterating over it gives
+    DataPoints.
+
+    Data points with a sensor have their sensors in an array too, and their
+    channels in CHANNELS arrays; sensors and channels are None otherwise. A
+    batch only holds one kind: adding the other kind raises ValueError.
+    """
+    def __init__(self, times=None, powers=None, temperatures=None,
+                 device=None, sensors=None, channels=None):
+        if times is None:
+            times, powers, temperatures = (array.array('l'), array.array('l'),
+                                           array.array('d'))
+        assert len(times) == len(powers) == len(temperatures)
+        self.times = times
+        self.powers = powers
+        self.temperatures = temperatures
+        self.device = device
+        self.sensors = sensors
+        self.channels = channels
+
+    @classmethod
+    def from_data_points(cls, data_points, device=None):
+        batch = cls(device=device)
+        for data_point in data_points:
+            batch.append(data_point)
+        return batch
+
+    def append(self, data_point):
+        if not self.times:
+            if data_point.sensor is None:
+                self.sensors = self.channels = None
+            else:
+                self.sensors = array.array('B')
+                self.channels = tuple(array.array('l')
+                                      for i in xrange(CHANNELS))
+        elif (data_point.sensor is None) != (self.sensors is None):
+            raise ValueError("sensor and non-sensor data points in one batch")
+        # raises TypeError if the time is not a number
+        self.times.append(data_point.time)
+        self.powers.append(data_point.power)
+        self.temperatures.append(data_point.temperature)
+        if self.sensors is not None:
+            self.sensors.append(data_point.sensor)
+            for column, watts in zip(self.channels, data_point.channels):
+                column.append(watts)
+
+    def extend(self, batch):
+        if (batch.sensors is None) != (self.sensors is None):
+            raise ValueError("sensor and non-sensor data points in one batch")
+        self.times.extend(batch.times)
+        self.powers.extend(batch.powers)
+        self.temperatures.extend(batch.temperatures)
+        if self.sensors is not None:
+            self.sensors.extend(batch.sensors)
+            for column, other in zip(self.channels, batch.channels):
+                column.extend(other)
+
+    def by_sensor(self):
+        """
+        Return a dictionary of the sensors of the batch to batches of their
+        data points.
+        """
+        if self.sensors is None:
+            return {None: self}
+        indexes = {}
+        for index, sensor in enumerate(self.sensors):
+            indexes.setdefault(sensor, []).append(index)
+        if len(indexes) == 1:
+            return {self.sensors[0]: self}
+        batches = {}
+        for sensor, sensor_indexes in indexes.iteritems():
+            def column(values):
+                return array.array(values.typecode,
+                                   [values[index] for index in sensor_indexes])
+            batches[sensor] = DataPointBatch(column(self.times),
+                    column(self.powers), column(self.temperatures),
+                    self.device, column(self.sensors),
+                    tuple(column(channel) for channel in self.channels))
+        return batches
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        device = self.device
+        if self.sensors is not None:
+            for row in zip(self.times, self.powers, self.temperatures,
+                           self.sensors, *self.channels):
+                yield DataPoint(row[0], row[1], row[2], device, row[3],
+                                row[4:])
+            return
+        for time_stamp, power, temperature in zip(self.times, self.powers,
+                                                  self.temperatures):
+            yield DataPoint(time_stamp, power, temperature, device)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if self.sensors is None:
+                return DataPointBatch(self.times[index], self.powers[index],
+                                      self.temperatures[index], self.device)
+            return DataPointBatch(self.times[index], self.powers[index],
+                                  self.temperatures[index], self.device,
+                                  self.sensors[index],
+                                  tuple(channel[index]
+                                        for channel in self.channels))
+        if self.sensors is None:
+            return DataPoint(self.times[index], self.powers[index],
+                             self.temperatures[index], self.device)
+        return DataPoint(self.times[index], self.powers[index],
+                         self.temperatures[index], self.device,
+                         self.sensors[index],
+                         tuple(channel[index] for channel in self.channels))
+
+    def __repr__(self):
+        return "DataPointBatch(%d data points)" % len(self)
+
+class CsvTimeFormatter(object):
+    """
+    Formats time stamps like DataPoint.to_csv(), but only calls strftime once
+    per minute for increasing time stamps.
+    """
+    # CSV_TIME_FORMAT without the seconds
+    MINUTE_FORMAT = CSV_TIME_FORMAT[:-len("%S")]
+    assert CSV_TIME_FORMAT.endswith("%S")
+
+    def __init__(self):
+        self._minute = None
+        self._minute_string = None
+
+    def format(self, time_stamp):
+        if not isinstance(time_stamp, (int, long)):
+            try:
+                return time.strftime(CSV_TIME_FORMAT, time.gmtime(time_stamp))
+            except TypeError:
+                return time_stamp
+        seconds = time_stamp % 60
+        minute = time_stamp - seconds
+        if minute != self._minute:
+            self._minute_string = time.strftime(self.MINUTE_FORMAT,
+                                                time.gmtime(minute))
+            self._minute = minute
+        return "%s%02d" % (self._minute_string, seconds)
 
 class IteratorLogger(object):
     def __init__(self, iterator, log_file_name):
@@ -51,11 +240,37 @@ class IteratorLogger(object):
             print >> self._log_file, "%s: %s" % (time.strftime(CSV_TIME_FORMAT), item)
             yield item
 
-class CC128Parser(object):
+class Parser(object):
+    def parse_msg(self, data):
+        """
+        Yield the DataPoints found in data.
+        """
+        raise NotImplementedError()
+
+    def parse_batch(self, data):
+        """
+        Return the data points found in data as a DataPointBatch. Only works
+        for parsers that give time stamps in seconds since EPOCH.
+        """
+        return DataPointBatch.from_data_points(self.parse_msg(data))
+
+class CC128Parser(Parser):
+    def __init__(self, sensors=False):
+        """
+        With sensors, data points have the sensor and the watts of all the
+        channels of each message.
+        """
+        self._sensors = sensors
+
     def parse_msg(self, xml_data):
+        # imported here so that users of the streaming parser do not pay for it
+        from bs4 import BeautifulSoup
         root = BeautifulSoup(xml_data)
         for xml_message in root.find_all('msg'):
             try:
+                if self._sensors:
+                    yield self._sensor_data_point(xml_message)
+                    continue
                 yield DataPoint(
                     time=xml_message.time.text,
                     power=int(xml_message.ch1.watts.text),
@@ -65,6 +280,24 @@ class CC128Parser(object):
                 # badly formatted/empty entry (hist?), we just ignore it
                 pass
 
+    def _sensor_data_point(self, xml_message):
+        if xml_message.find('hist') is not None:
+            raise ValueError("history data")
+        channels = [0] * CHANNELS
+        has_channel = False
+        for number in xrange(CHANNELS):
+            channel = xml_message.find('ch%d' % (number + 1))
+            if channel is not None:
+                channels[number] = int(channel.watts.text)
+                has_channel = True
+        if not has_channel:
+            raise ValueError("no channel")
+        sensor = xml_message.find('sensor')
+        return DataPoint(time=xml_message.time.text, power=sum(channels),
+                         temperature=float(xml_message.tmpr.text),
+                         sensor=int(sensor.text) if sensor is not None else 0,
+                         channels=tuple(channels))
+
 class CC128LiveParser(CC128Parser):
     def parse_msg(self, xml_data):
         # Time stamp from the CC128 does not have the date and its time may not
@@ -76,24 +309,305 @@ class CC128LiveParser(CC128Parser):
             entry.time = time_stamp
             yield entry
 
-class CSVParser(object):
+def _first_text(element, tag):
+    # Same semantics as BeautifulSoup's element.tag.text: first descendant in
+    # document order, empty string if it has no text.
+    for child in element.iter(tag):
+        return unicode(child.text or u'')
+    raise AttributeError(tag)
+
+def _first_child(element, tag):
+    for child in element.iter(tag):
+        return child
+    raise AttributeError(tag)
+
+class CC128StreamParser(Parser):
+    """
+    Incremental parser for the CC128 output.
+
+    Data can be fed in arbitrary chunks, a DataPoint is yielded as soon as the
+    closing </msg> of a message has been seen. It yields the same data points
+    as CC128Parser, but without building a BeautifulSoup tree per line.
+    """
+    MSG_START = '<msg>'
+    MSG_END = '</msg>'
+    # anything longer than that without a </msg> is garbage
+    MAX_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, sensors=False, history=False):
+        """
+        With sensors, data points have the sensor and the watts of all the
+        channels of each message.
+
+        With history, the history messages are kept as HistoryRecords, to be
+        taken with pop_history(). They are ignored otherwise.
+        """
+        self._buffer = ''
+        self._sensors = sensors
+        self._history = history
+        self.history = []
+        # messages we could not make sense of
+        self.malformed = 0
+
+    def parse_msg(self, xml_data):
+        if isinstance(xml_data, unicode):
+            xml_data = xml_data.encode('UTF-8')
+        self._buffer += xml_data
+        for fragment in self._split_messages():
+            data_point = self._parse_fragment(fragment)
+            if data_point is not None:
+                yield data_point
+
+    def _split_messages(self):
+        buf = self._buffer
+        fragments = []
+        position = 0
+        while True:
+            end = buf.find(self.MSG_END, position)
+            if end < 0:
+                break
+            end += len(self.MSG_END)
+            start = buf.rfind(self.MSG_START, position, end)
+            if start >= 0:
+                fragments.append(buf[start:end])
+            position = end
+
+        # keep the beginning of the next message, drop the rest
+        start = buf.find(self.MSG_START, position)
+        if start < 0:
+            # we may be in the middle of an opening tag
+            start = max(position, len(buf) - len(self.MSG_START))
+        if len(buf) - start > self.MAX_BUFFER_SIZE:
+            start = len(buf)
+        self._buffer = buf[start:]
+        return fragments
+
+    def pop_history(self):
+        """
+        Return the HistoryRecords parsed since the last call.
+        """
+        history = self.history
+        self.history = []
+        return history
+
+    def _parse_fragment(self, fragment):
+        if '<hist>' in fragment:
+            if self._history:
+                self._parse_history(fragment)
+            return None
+        try:
+            xml_message = ElementTree.fromstring(fragment)
+            if self._sensors:
+                return self._sensor_data_point(xml_message)
+            return DataPoint(
+                    time=_first_text(xml_message, 'time'),
+                    power=int(_first_text(_first_child(xml_message, 'ch1'),
+                                          'watts')),
+                    temperature=float(_first_text(xml_message, 'tmpr'))
+                    )
+        except (ElementTree.ParseError, SyntaxError, ValueError, TypeError,
+                AttributeError, IndexError):
+            # malformed or incomplete entry, we just ignore it
+            self.malformed += 1
+            return None
+
+    def _parse_history(self, fragment):
+        try:
+            xml_message = ElementTree.fromstring(fragment)
+            hist = _first_child(xml_message, 'hist')
+            if _first_text(hist, 'units') != 'kwhr':
+                # gas or water meters, not ours
+                return
+            entries = []
+            for data in hist.iter('data'):
+                sensor = int(_first_text(data, 'sensor'))
+                for child in data:
+                    tag = child.tag
+                    if tag[0] in 'hdm' and tag[1:].isdigit():
+                        entries.append((sensor, tag[0], int(tag[1:]),
+                                        float(child.text)))
+            self.history.append(HistoryRecord(_first_text(xml_message, 'time'),
+                                              entries))
+        except (ElementTree.ParseError, SyntaxError, ValueError, TypeError,
+                AttributeError):
+            self.malformed += 1
+
+    def _sensor_data_point(self, xml_message):
+        # everything in one pass over the children of <msg>
+        time_string = temperature = None
+        sensor = 0
+        channels = [0] * CHANNELS
+        has_channel = False
+        for child in xml_message:
+            tag = child.tag
+            if tag == 'time':
+                time_string = unicode(child.text or u'')
+            elif tag == 'tmpr':
+                temperature = float(child.text)
+            elif tag == 'sensor':
+                sensor = int(child.text)
+            elif tag.startswith('ch'):
+                number = int(tag[2:])
+                if not 1 <= number <= CHANNELS:
+                    # ch0 would end up in the last channel
+                    raise ValueError("no channel %d" % number)
+                channels[number - 1] = int(_first_text(child, 'watts'))
+                has_channel = True
+        if time_string is None or temperature is None or not has_channel:
+            raise ValueError("incomplete message")
+        return DataPoint(time=time_string, power=sum(channels),
+                         temperature=temperature, sensor=sensor,
+                         channels=tuple(channels))
+
+class CC128StreamLiveParser(CC128StreamParser):
+    def parse_msg(self, xml_data):
+        # see CC128LiveParser
+        time_stamp = int(time.time())
+        history_count = len(self.history)
+        for entry in CC128StreamParser.parse_msg(self, xml_data):
+            entry.time = time_stamp
+            yield entry
+        for record in self.history[history_count:]:
+            record.time = time_stamp
+
+class CSVTimeParser(object):
+    """
+    Parses CSV_TIME_FORMAT time stamps into seconds since EPOCH. The date part
+    is only parsed once per day, the rest is sliced directly, falling back to
+    strptime for anything that does not have the expected layout.
+    """
+    DATE_FORMAT = "%Y-%m-%d"
+
+    def __init__(self):
+        self._day = None
+        self._day_start = None
+
+    def parse(self, time_string):
+        if (len(time_string) == 19 and time_string[10] == ' '
+                and time_string[13] == ':' and time_string[16] == ':'):
+            day = time_string[:10]
+            if day != self._day:
+                day_start = calendar.timegm(time.strptime(day,
+                                                          self.DATE_FORMAT))
+                self._day, self._day_start = day, day_start
+            hours = int(time_string[11:13])
+            minutes = int(time_string[14:16])
+            seconds = int(time_string[17:19])
+            if hours < 24 and minutes < 60 and seconds < 62:
+                return self._day_start + hours * 3600 + minutes * 60 + seconds
+        return calendar.timegm(time.strptime(time_string, CSV_TIME_FORMAT))
+
+class CSVParser(Parser):
+    """
+    Data written with swing-door compression (see compression.py) is expanded
+    back, from its header line on. Rows with a sensor and channels (as
+    written from a parser reading the sensors) give data points with them.
+    """
+    def __init__(self):
+        self._time_parser = CSVTimeParser()
+        self._expander = None
+
+    def _header(self, data_line):
+        if compression.is_header(data_line):
+            self._expander = compression.parse_header(data_line)
+
     def parse_msg(self, data):
         for data_line in data.split('\n'):
             if not data_line:
                 continue
-            time_s, power_s, temp_s = data_line.split(',')
-            yield DataPoint(
-                    time=self._parse_time(time_s),
-                    power=int(power_s),
-                    temperature=float(temp_s)
-                    )
+            if data_line[0] == '#':
+                self._header(data_line)
+                continue
+            fields = data_line.split(',')
+            time_stamp = self._parse_time(fields[0])
+            power = int(fields[1])
+            temperature = float(fields[2])
+            if len(fields) > 3:
+                yield DataPoint(time=time_stamp, power=power,
+                                temperature=temperature, sensor=int(fields[3]),
+                                channels=tuple(int(field)
+                                               for field in fields[4:]))
+                continue
+            if self._expander is None:
+                yield DataPoint(time=time_stamp, power=power,
+                                temperature=temperature)
+                continue
+            for time_stamp, (power, temperature) in self._expander.add(
+                    time_stamp, (power, temperature)):
+                yield DataPoint(time=time_stamp, power=power,
+                                temperature=temperature)
+
+    def parse_columns(self, data):
+        """
+        Parse a whole file worth of CSV data in one go, returning arrays of
+        times, powers and temperatures instead of DataPoints. The rows of all
+        the sensors are included.
+        """
+        return self._parse_columns(data)[:3]
+
+    def _parse_columns(self, data):
+        """
+        Also return the arrays of the sensors and the tuple of the arrays of
+        the channels, None if there are no rows with a sensor. Rows without
+        one are then from sensor 0, with all their power on the first channel.
+        """
+        times = array.array('l')
+        powers = array.array('l')
+        temperatures = array.array('d')
+        sensors = channels = None
+        parse_time = self._time_parser.parse
+        for data_line in data.split('\n'):
+            if not data_line:
+                continue
+            if data_line[0] == '#':
+                self._header(data_line)
+                continue
+            fields = data_line.split(',')
+            if len(fields) > 3:
+                if sensors is None:
+                    sensors = array.array('B', [0] * len(times))
+                    channels = (array.array('l', powers),) + tuple(
+                            array.array('l', [0] * len(times))
+                            for i in xrange(CHANNELS - 1))
+                times.append(parse_time(fields[0]))
+                powers.append(int(fields[1]))
+                temperatures.append(float(fields[2]))
+                sensors.append(int(fields[3]))
+                for column, field in zip(channels, fields[4:]):
+                    column.append(int(field))
+                continue
+            start = len(times)
+            time_s, power_s, temp_s = fields
+            if self._expander is None:
+                times.append(parse_time(time_s))
+                powers.append(int(power_s))
+                temperatures.append(float(temp_s))
+            else:
+                for time_stamp, (power, temperature) in self._expander.add(
+                        parse_time(time_s), (int(power_s), float(temp_s))):
+                    times.append(time_stamp)
+                    powers.append(power)
+                    temperatures.append(temperature)
+            if sensors is not None:
+                for index in xrange(start, len(times)):
+                    sensors.append(0)
+                    channels[0].append(powers[index])
+                    for column in channels[1:]:
+                        column.append(0)
+        return times, powers, temperatures, sensors, channels
+
+    def parse_batch(self, data):
+        times, powers, temperatures, sensors, channels = self._parse_columns(
+                data)
+        return DataPointBatch(times, powers, temperatures, sensors=sensors,
+                              channels=channels)
 
     def _parse_time(self, time_string):
-        time_struct = time.strptime(time_string, CSV_TIME_FORMAT)
-        return calendar.timegm(time_struct)
+        return self._time_parser.parse(time_string)
 
 if __name__ == '__main__':
     import sys
+    import serial_tools
     file_name = None
     if len(sys.argv) > 1:
         file_name = sys.argv[1]
@@ -103,11 +617,11 @@ if __name__ == '__main__':
         log_file_name = None
 
     if file_name is None or serial_tools.is_serial(file_name):
-        data = serial_tools.open_cc128(file_name)
-        parser = CC128LiveParser()
+        data = serial_tools.CC128Source(file_name)
+        parser = CC128StreamLiveParser()
     else:
         data = file(file_name, "r")
-        parser = CC128Parser();
+        parser = CC128StreamParser()
 
     if log_file_name is not None:
         data = IteratorLogger(data, log_file_name)
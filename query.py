@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time range queries over the files written by CsvDataSaver.
+
+The sidecar index files (.idx) hold "<time> <offset>" lines, the offset being
+in bytes in the CSV file, or the offset of a bz2 stream or gzip member in a
+compressed file (see maintenance.py for the latter).
+They let us start reading close to the beginning of the range instead of at
+the beginning of the file. Rows are expected to be in time order in a file,
+but not across the files of a day: the rows filled in by history.py are
+given after the others.
+Files written with swing-door compression are expanded back (see
+compression.py).
+
+Rows with a sensor have more than three fields. By default, the rows of
+sensor 0 are the ones queried, which is the whole house.
+"""
+
+import os, sys, time, errno, bisect
+
+from parser import CSV_TIME_FORMAT, CSVTimeParser, CsvTimeFormatter
+from data_save import CsvDataSaver, file_period, read_bz2_streams
+from data_save import read_gzip_members, pending_paths, BackgroundCompressor
+import compression
+
+def read_index(index_path):
+    """
+    Return the list of times and the list of offsets of an index file.
+    """
+    times, offsets = [], []
+    if not os.path.exists(index_path):
+        return times, offsets
+    index_file = open(index_path)
+    try:
+        for line in index_file:
+            if not line.endswith("\n"):
+                # being written
+                break
+            time_stamp, offset = line.split()
+            times.append(int(time_stamp))
+            offsets.append(int(offset))
+    finally:
+        index_file.close()
+    return times, offsets
+
+def _start_offset(index_path, start):
+    times, offsets = read_index(index_path)
+    position = bisect.bisect_right(times, start) - 1
+    if position < 0:
+        return 0
+    return offsets[position]
+
+def _lines_from_chunks(chunks):
+    remainder = ""
+    for chunk in chunks:
+        lines = (remainder + chunk).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    # an incomplete last line is being written, we leave it out
+
+class Aggregate(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return None
+        return float(self.sum) / self.count
+
+    def __repr__(self):
+        return "Aggregate(count=%d, min=%s, max=%s, avg=%s, sum=%s)" % (
+                self.count, self.min, self.max, self.avg, self.sum)
+
+class CsvArchive(object):
+    def __init__(self, directory,
+                 file_name_template=CsvDataSaver.FILE_NAME_TEMPLATE, sensor=0):
+        """
+        Only the rows of sensor are given, rows without a sensor being from
+        sensor 0. With sensor None, all of them are.
+        """
+        self._path_template = os.path.join(os.path.abspath(directory),
+                                           file_name_template)
+        self._sensor = sensor
+
+    def _paths(self, start, end):
+        """
+        Yield the paths of the existing files that may hold data between start
+        and end, in time order.
+        """
+        time_stamp = start
+        while time_stamp < end:
+            path, period_start, period_end = file_period(self._path_template,
+                                                         time_stamp)
+            # older data first, with the files still being compressed, then
+            # what history.py filled in
+            for candidate in (path + '.gz', path + '.bz2'):
+                if os.path.exists(candidate):
+                    yield candidate
+            directory, file_name = os.path.split(path)
+            if os.path.isdir(directory):
+                for pending_path in pending_paths(directory, file_name):
+                    yield pending_path
+            for candidate in (path, path + CsvDataSaver.BACKFILL_SUFFIX):
+                if os.path.exists(candidate):
+                    yield candidate
+            time_stamp = period_end
+
+    def _lines(self, path, start):
+        index_path = path + CsvDataSaver.INDEX_SUFFIX
+        offset = _start_offset(index_path, start)
+        if offset:
+            # we skip the header line, if any
+            for line in self._lines(path, 0):
+                if compression.is_header(line):
+                    yield line
+                break
+        if path.endswith('.bz2'):
+            for line in _lines_from_chunks(read_bz2_streams(path, offset)):
+                yield line
+            return
+        if path.endswith('.gz'):
+            for line in _lines_from_chunks(read_gzip_members(path, offset)):
+                yield line
+            return
+        try:
+            csv_file = open(path)
+        except IOError, e:
+            if (e.errno == errno.ENOENT
+                    and path.endswith(BackgroundCompressor.PENDING_SUFFIX)):
+                # compressed in the meantime
+                return
+            raise
+        try:
+            csv_file.seek(offset)
+            chunks = iter(lambda: csv_file.read(64 * 1024), "")
+            for line in _lines_from_chunks(chunks):
+                yield line
+        finally:
+            csv_file.close()
+
+    def _expanded_lines(self, path, start):
+        expander = None
+        time_parser = CSVTimeParser()
+        time_formatter = CsvTimeFormatter()
+        for line in self._lines(path, start):
+            if line.startswith('#'):
+                if compression.is_header(line):
+                    expander = compression.parse_header(line)
+                continue
+            if expander is None:
+                yield line
+                continue
+            time_s, power_s, temp_s = line.split(',')
+            for time_stamp, (power, temperature) in expander.add(
+                    time_parser.parse(time_s), (int(power_s), float(temp_s))):
+                yield "%s,%s,%s" % (time_formatter.format(time_stamp), power,
+                                    temperature)
+
+    def lines(self, start, end):
+        """
+        Yield the CSV lines with start <= time < end.
+        """
+        # time strings sort like the times, no need to parse them
+        start_s = time.strftime(CSV_TIME_FORMAT, time.gmtime(start))
+        end_s = time.strftime(CSV_TIME_FORMAT, time.gmtime(end))
+        time_length = len(start_s)
+        sensor_s = None
+        if self._sensor is not None:
+            sensor_s = str(self._sensor)
+        for path in self._paths(start, end):
+            for line in self._expanded_lines(path, start):
+                time_s = line[:time_length]
+                if time_s < start_s:
+                    continue
+                if time_s >= end_s:
+                    break
+                if sensor_s is not None:
+                    if line.count(',') > 2:
+                        if line.split(',', 4)[3] != sensor_s:
+                            continue
+                    elif sensor_s != "0":
+                        continue
+                yield line
+
+    def rows(self, start, end):
+        """
+        Yield (time, power, temperature) tuples with start <= time < end.
+        """
+        time_parser = CSVTimeParser()
+        for line in self.lines(start, end):
+            time_s, power_s, temp_s = line.split(',')[:3]
+            yield time_parser.parse(time_s), int(power_s), float(temp_s)
+
+    def aggregate(self, start, end):
+        """
+        Return a dictionary with the Aggregate of the power and of the
+        temperature between start and end.
+        """
+        power = Aggregate()
+        temperature = Aggregate()
+        for line in self.lines(start, end):
+            time_s, power_s, temp_s = line.split(',')[:3]
+            power.add(int(power_s))
+            temperature.add(float(temp_s))
+        return {'power': power, 'temperature': temperature}
+
+if __name__ == '__main__':
+    # aggregates between two local times
+    QUERY_TIME_FORMAT = "%Y-%m-%d %H:%M"
+    if len(sys.argv) != 4:
+        print >> sys.stderr, ('Usage: %s DIRECTORY "YYYY-MM-DD HH:MM" '
+                              '"YYYY-MM-DD HH:MM"' % sys.argv[0])
+        sys.exit(1)
+    start, end = [int(time.mktime(time.strptime(argument, QUERY_TIME_FORMAT)))
+                  for argument in sys.argv[2:4]]
+    aggregates = CsvArchive(sys.argv[1]).aggregate(start, end)
+    for name in ('power', 'temperature'):
+        print name, aggregates[name]
@@ -0,0 +1,105 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Names of the savers and sources that can be used in the configuration, and
+where to find them.
+
+They are given as "module:Class" strings, and the module is only imported
+when the class is needed, so that a configuration using the CSV saver does
+not import rrdtool, nor pyserial when reading from the simulator. Other
+savers and sources can be added with register_saver() and register_source(),
+or used directly from the configuration by giving their "module:Class" as
+their name.
+"""
+
+import importlib
+
+SAVERS = {
+    "CsvDataSaver": "data_save:CsvDataSaver",
+    "RrdDataSaver": "data_save:RrdDataSaver",
+    "ThermostatSaver": "data_save:ThermostatSaver",
+    "ArchiveDataSaver": "archive:ArchiveDataSaver",
+    "RollupDataSaver": "rollup:RollupDataSaver",
+    "LiveDataSaver": "live:LiveDataSaver",
+    }
+
+SOURCES = {
+    "serial": "serial_tools:CC128Source",
+    "devices": "serial_tools:MultiCC128Source",
+    "simulator": "simulator:SimulatedCC128",
+    "replay": "simulator:ReplaySource",
+    }
+
+class RegistryError(Exception):
+    pass
+
+def _check_target(target):
+    if isinstance(target, basestring):
+        module, separator, name = target.partition(":")
+        if not (module and separator and name):
+            raise RegistryError("Not a module:Class: %s" % target)
+
+def register_saver(name, target):
+    """
+    Make a saver available as name, target being its class or a
+    "module:Class" string.
+    """
+    _check_target(target)
+    SAVERS[name] = target
+
+def register_source(name, target):
+    _check_target(target)
+    SOURCES[name] = target
+
+def _resolve(kind, table, name):
+    if name in table:
+        return table[name]
+    if ":" in name:
+        # given directly as module:Class
+        _check_target(name)
+        return name
+    raise RegistryError("Unknown %s: %s" % (kind, name))
+
+def check_saver(name):
+    """
+    Raise RegistryError if name is not a known saver, without importing
+    anything.
+    """
+    _resolve("saver", SAVERS, name)
+
+def check_source(name):
+    _resolve("source", SOURCES, name)
+
+def _load(target):
+    if not isinstance(target, basestring):
+        return target
+    module_name, name = target.split(":")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError, e:
+        raise RegistryError("Could not import %s: %s" % (target, e))
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise RegistryError("No %s in %s" % (name, module_name))
+
+def saver_class(name):
+    return _load(_resolve("saver", SAVERS, name))
+
+def source_class(name):
+    return _load(_resolve("source", SOURCES, name))
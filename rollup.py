@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streaming rollups of the data points: count, minimum, maximum and mean of the
+power and the temperature, and energy, per minute, 10 minutes, hour and day
+(UTC), computed as the data comes.
+
+Each window only keeps a handful of numbers. It is written to the sinks once
+no more data is expected for it, that is when data allowed_lateness seconds
+past its end has been seen; anything arriving later than that is counted and
+ignored. Open windows are saved in a state file on flush() and close(), and
+whenever windows are written, and reloaded on startup. Data no later than
+the last one in the state, such as what a spool gives again after a crash,
+is then left out, being already counted. The sinks tell which windows they
+hold already, from what they wrote, so that a crash between writing windows
+and saving the state does not write them twice.
+
+RollupCsvSink writes one file per resolution, rollup.<name>.csv, with lines:
+    start,count,power min,power max,power mean,energy (Wh),
+    temperature min,temperature max,temperature mean
+the start being in the same format as the CsvDataSaver times.
+"""
+
+import os, sys, time, json
+
+from parser import CSV_TIME_FORMAT, CsvTimeFormatter, CSVTimeParser
+from data_save import DataSaver
+
+RESOLUTIONS = (
+    # name, length in seconds
+    ("1m", 60),
+    ("10m", 600),
+    ("1h", 3600),
+    ("1d", 86400),
+    )
+
+class Window(object):
+    __slots__ = ('start', 'count', 'power_min', 'power_max', 'power_sum',
+                 'temperature_min', 'temperature_max', 'temperature_sum',
+                 'energy')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.power_min = self.power_max = None
+        self.temperature_min = self.temperature_max = None
+        self.power_sum = 0
+        self.temperature_sum = 0.0
+        # in Wh
+        self.energy = 0.0
+
+    def add(self, power, temperature, energy):
+        if self.count == 0:
+            self.power_min = self.power_max = power
+            self.temperature_min = self.temperature_max = temperature
+        else:
+            if power < self.power_min:
+                self.power_min = power
+            elif power > self.power_max:
+                self.power_max = power
+            if temperature < self.temperature_min:
+                self.temperature_min = temperature
+            elif temperature > self.temperature_max:
+                self.temperature_max = temperature
+        self.count += 1
+        self.power_sum += power
+        self.temperature_sum += temperature
+        self.energy += energy
+
+    @property
+    def power_mean(self):
+        return float(self.power_sum) / self.count
+
+    @property
+    def temperature_mean(self):
+        return self.temperature_sum / self.count
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, values):
+        window = cls(values['start'])
+        for name in cls.__slots__:
+            setattr(window, name, values[name])
+        return window
+
+class RollupCsvSink(object):
+    FILE_NAME_TEMPLATE = "rollup.%s.csv"
+
+    def __init__(self, directory):
+        self._directory = os.path.abspath(directory)
+        self._files = {}
+        self._time_formatter = CsvTimeFormatter()
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+    def _path(self, name):
+        return os.path.join(self._directory, self.FILE_NAME_TEMPLATE % name)
+
+    def last_start(self, name):
+        """
+        Return the start of the last window of resolution name written, None
+        if there is none. A line we were killed in the middle of writing is
+        removed.
+        """
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        rollup_file = open(path, "r+b")
+        try:
+            rollup_file.seek(0, os.SEEK_END)
+            size = rollup_file.tell()
+            tail_start = max(0, size - 4096)
+            rollup_file.seek(tail_start)
+            tail = rollup_file.read()
+            if tail and not tail.endswith("\n"):
+                rollup_file.truncate(tail_start + tail.rfind("\n") + 1)
+                tail = tail[:tail.rfind("\n") + 1]
+        finally:
+            rollup_file.close()
+        lines = tail.splitlines()
+        if not lines:
+            return None
+        return CSVTimeParser().parse(lines[-1].split(",")[0])
+
+    def emit(self, name, window):
+        rollup_file = self._files.get(name)
+        if rollup_file is None:
+            rollup_file = self._files[name] = open(self._path(name), "a")
+        rollup_file.write("%s,%d,%d,%d,%.1f,%.3f,%.1f,%.1f,%.2f\n" % (
+                self._time_formatter.format(window.start), window.count,
+                window.power_min, window.power_max, window.power_mean,
+                window.energy, window.temperature_min, window.temperature_max,
+                window.temperature_mean))
+
+    def flush(self):
+        for rollup_file in self._files.itervalues():
+            rollup_file.flush()
+
+    def close(self):
+        for rollup_file in self._files.itervalues():
+            rollup_file.close()
+        self._files = {}
+
+class RollupDataSaver(DataSaver):
+    STATE_FILE = "rollup.state.json"
+
+    def __init__(self, directory, resolutions=None, allowed_lateness=60,
+                 period=6, max_gap=60, sinks=None):
+        """
+        resolutions is a list of names from RESOLUTIONS, all of them by
+        default. The energy of a data point is its power over the time since
+        the previous one, or over period if that is more than max_gap seconds
+        or if the data point is out of order. Closed windows go to the sinks,
+        a RollupCsvSink writing in directory by default.
+        """
+        self._directory = os.path.abspath(directory)
+        print "Rollups: will save in", self._directory
+        known = dict(RESOLUTIONS)
+        if resolutions is None:
+            resolutions = [name for name, length in RESOLUTIONS]
+        for name in resolutions:
+            if name not in known:
+                raise ValueError("Unknown rollup resolution: %s" % name)
+        self._resolutions = [(name, known[name]) for name in resolutions]
+        self._allowed_lateness = allowed_lateness
+        self._period = period
+        self._max_gap = max_gap
+        if sinks is None:
+            sinks = [RollupCsvSink(directory)]
+        self._sinks = sinks
+        self._state_path = os.path.join(self._directory, self.STATE_FILE)
+
+        # name -> {start: Window}
+        self._windows = dict((name, {}) for name, length in self._resolutions)
+        # name -> end of the last closed window
+        self._closed_until = dict((name, 0) for name, length in self._resolutions)
+        self._watermark = 0
+        self._last_time = None
+        # data up to then is in the state we started from
+        self._counted_until = None
+        self.late = 0
+        self._load_state()
+
+    def _load_state(self):
+        if os.path.exists(self._state_path):
+            state = json.load(open(self._state_path))
+            self._watermark = state['watermark']
+            self._last_time = self._counted_until = state['last_time']
+            self.late = state['late']
+            for name, length in self._resolutions:
+                self._closed_until[name] = state['closed_until'].get(name, 0)
+                for values in state['windows'].get(name, []):
+                    window = Window.from_dict(values)
+                    self._windows[name][window.start] = window
+        for name, length in self._resolutions:
+            # written, but we were killed before saving the state
+            for sink in self._sinks:
+                last_start = getattr(sink, 'last_start', lambda name: None)(name)
+                if last_start is not None:
+                    self._closed_until[name] = max(self._closed_until[name],
+                                                   last_start + length)
+            windows = self._windows[name]
+            for start in windows.keys():
+                if start < self._closed_until[name]:
+                    del windows[start]
+
+    def _save_state(self):
+        state = {
+            'watermark': self._watermark,
+            'last_time': self._last_time,
+            'late': self.late,
+            'closed_until': self._closed_until,
+            'windows': dict((name, [window.to_dict()
+                                    for window in windows.itervalues()])
+                            for name, windows in self._windows.iteritems()),
+            }
+        # never leave a partial state behind
+        state_file = open(self._state_path + ".tmp", "w")
+        try:
+            json.dump(state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        finally:
+            state_file.close()
+        os.rename(self._state_path + ".tmp", self._state_path)
+
+    def _add(self, time_stamp, power, temperature):
+        if self._counted_until is not None:
+            if time_stamp <= self._counted_until:
+                return
+            self._counted_until = None
+        if self._last_time is not None:
+            gap = time_stamp - self._last_time
+        else:
+            gap = None
+        if gap is None or gap <= 0 or gap > self._max_gap:
+            gap = self._period
+        energy = power * gap / 3600.
+        if self._last_time is None or time_stamp > self._last_time:
+            self._last_time = time_stamp
+        if time_stamp > self._watermark:
+            self._watermark = time_stamp
+
+        for name, length in self._resolutions:
+            start = time_stamp - time_stamp % length
+            windows = self._windows[name]
+            window = windows.get(start)
+            if window is None:
+                if start < self._closed_until[name]:
+                    # that window was written already
+                    self.late += 1
+                    continue
+                window = windows[start] = Window(start)
+            window.add(power, temperature, energy)
+
+    def _close_windows(self):
+        limit = self._watermark - self._allowed_lateness
+        emitted = False
+        for name, length in self._resolutions:
+            windows = self._windows[name]
+            for start in sorted(windows):
+                if start + length > limit:
+                    break
+                window = windows.pop(start)
+                for sink in self._sinks:
+                    sink.emit(name, window)
+                self._closed_until[name] = start + length
+                emitted = True
+        if emitted:
+            # the windows first: the sinks tell what they hold on startup
+            self.flush()
+
+    def update(self, data_point):
+        assert(isinstance(data_point.time, (int, long)))
+        self._add(data_point.time, data_point.power, data_point.temperature)
+        self._close_windows()
+
+    def update_many(self, batch):
+        add = self._add
+        for row in zip(batch.times, batch.powers, batch.temperatures):
+            add(*row)
+        self._close_windows()
+
+    def flush(self):
+        for sink in self._sinks:
+            sink.flush()
+        self._save_state()
+
+    def close(self):
+        self.flush()
+        for sink in self._sinks:
+            sink.close()
+
+    def set_metrics(self, metrics, name):
+        metrics.gauge("cucologger_rollup_late", lambda: self.late, saver=name)
+        metrics.gauge("cucologger_rollup_open_windows",
+                      lambda: sum(len(windows)
+                                  for windows in self._windows.itervalues()),
+                      saver=name)
+
+def read_rollups(directory, name, start, end):
+    """
+    Yield (start, count, power min, power max, power mean, energy,
+    temperature min, temperature max, temperature mean) tuples of the windows
+    of resolution name starting between start and end.
+    """
+    path = os.path.join(directory, RollupCsvSink.FILE_NAME_TEMPLATE % name)
+    if not os.path.exists(path):
+        return
+    # time strings sort like the times
+    start_s = time.strftime(CSV_TIME_FORMAT, time.gmtime(start))
+    end_s = time.strftime(CSV_TIME_FORMAT, time.gmtime(end))
+    time_parser = CSVTimeParser()
+    rollup_file = open(path)
+    try:
+        for line in rollup_file:
+            fields = line.rstrip("\n").split(",")
+            if len(fields) != 9 or not start_s <= fields[0] < end_s:
+                continue
+            yield ((time_parser.parse(fields[0]), int(fields[1]),
+                    int(fields[2]), int(fields[3])) +
+                   tuple(float(field) for field in fields[4:]))
+    finally:
+        rollup_file.close()
+
+if __name__ == '__main__':
+    # energy and average power per window between two local times
+    QUERY_TIME_FORMAT = "%Y-%m-%d %H:%M"
+    if len(sys.argv) != 5:
+        print >> sys.stderr, ('Usage: %s DIRECTORY 1m|10m|1h|1d '
+                              '"YYYY-MM-DD HH:MM" "YYYY-MM-DD HH:MM"'
+                              % sys.argv[0])
+        sys.exit(1)
+    start, end = [int(time.mktime(time.strptime(argument, QUERY_TIME_FORMAT)))
+                  for argument in sys.argv[3:5]]
+    total = 0.0
+    for row in read_rollups(sys.argv[1], sys.argv[2], start, end):
+        print "%s %8.1f W %10.3f Wh" % (time.strftime(QUERY_TIME_FORMAT,
+                time.localtime(row[0])), row[4], row[5])
+        total += row[5]
+    print "total: %.3f kWh" % (total / 1000)
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import platform, os, stat, termios
+import platform, os, sys, stat, termios, time, select, errno
 
 import serial
 
@@ -36,20 +36,30 @@ CC128_PORT_CONFIGURATION = {
     'stopbits': serial.STOPBITS_ONE
 }
 
-def linux_find_pl2303():
+def linux_find_all_pl2303():
     """
-    Return the first serial usb device handled by the pl2303 driver.
+    Return the sorted list of the serial usb devices handled by the pl2303
+    driver.
     """
     # might be a bit fragile, but works for me
     DRIVER_PATH='/sys/bus/usb-serial/drivers/pl2303'
-    
+
+    devices = []
     if os.path.exists(DRIVER_PATH):
-        for file_name in os.listdir(DRIVER_PATH):
+        for file_name in sorted(os.listdir(DRIVER_PATH)):
             dev_path = os.path.join('/dev/', file_name)
             if os.path.exists(dev_path) and is_serial(dev_path):
-                return dev_path
+                devices.append(dev_path)
+    return devices
 
-    raise RuntimeError("Could not find device, is it plugged in?")
+def linux_find_pl2303():
+    """
+    Return the first serial usb device handled by the pl2303 driver.
+    """
+    devices = linux_find_all_pl2303()
+    if not devices:
+        raise RuntimeError("Could not find device, is it plugged in?")
+    return devices[0]
 
 def open_cc128(file_name=None):
     if file_name is None:
@@ -58,5 +68,273 @@ def open_cc128(file_name=None):
     return serial.Serial(port=file_name,
             **CC128_PORT_CONFIGURATION)
 
+class CC128Source(object):
+    """
+    Iterates over the <msg> frames sent by a CC128.
+
+    Data is read by large chunks whenever select() says there is some. If the
+    device goes away (unplugged, re-enumerated by the pl2303 driver...) or is
+    silent for silence_timeout seconds, it is reopened, looking for it every
+    reconnect_interval seconds. opener is a function returning a new file-like
+    object with a fileno() to read from, by default the serial port given or
+    found with linux_find_pl2303().
+
+    stop() ends the iteration, at the latest STOP_CHECK_INTERVAL seconds
+    later, without losing any frame.
+    """
+    MSG_END = '</msg>'
+    # anything longer than that without a </msg> is garbage
+    MAX_BUFFER_SIZE = 64 * 1024
+    STOP_CHECK_INTERVAL = 1
+
+    def __init__(self, port=None, read_size=4096, silence_timeout=60,
+                 reconnect_interval=1, opener=None):
+        self._port = port
+        self._read_size = read_size
+        self._silence_timeout = silence_timeout
+        self._reconnect_interval = reconnect_interval
+        self._opener = opener or self._open_serial
+        self._device = None
+        self._buffer = ''
+        self._stopping = False
+        self.reconnections = 0
+
+    def stop(self):
+        # only sets a flag, so that it can be called from a signal handler
+        self._stopping = True
+
+    def _open_serial(self):
+        return open_cc128(self._port)
+
+    def _open(self):
+        while not self._stopping:
+            try:
+                self._device = self._opener()
+                return
+            except (EnvironmentError, RuntimeError), e:
+                print >> sys.stderr, "Could not open CC128 (%s), retrying" % e
+                time.sleep(self._reconnect_interval)
+
+    def close(self):
+        if self._device is not None:
+            try:
+                self._device.close()
+            except EnvironmentError:
+                pass
+        self._device = None
+        self._buffer = ''
+
+    def _reconnect(self, reason):
+        print >> sys.stderr, "Lost CC128 (%s), reopening" % reason
+        self.close()
+        self.reconnections += 1
+        time.sleep(self._reconnect_interval)
+
+    def _read(self):
+        """
+        Return the next chunk of data, waiting at most silence_timeout, or
+        None once stopped.
+        """
+        fd = self._device.fileno()
+        deadline = time.time() + self._silence_timeout
+        while True:
+            if self._stopping:
+                return None
+            timeout = min(deadline - time.time(), self.STOP_CHECK_INTERVAL)
+            try:
+                readable, _, _ = select.select([fd], [], [], max(0, timeout))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise EnvironmentError(*e.args)
+            if not readable:
+                if time.time() < deadline:
+                    continue
+                # the CC128 talks every 6 seconds
+                raise EnvironmentError("no data for %d seconds" %
+                                       self._silence_timeout)
+            try:
+                data = os.read(fd, self._read_size)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                raise EnvironmentError("end of file")
+            return data
+
+    def _frames(self, data):
+        frames = (self._buffer + data).split(self.MSG_END)
+        self._buffer = frames.pop()
+        if len(self._buffer) > self.MAX_BUFFER_SIZE:
+            self._buffer = ''
+        return [frame.strip() + self.MSG_END for frame in frames]
+
+    def __iter__(self):
+        while not self._stopping:
+            if self._device is None:
+                self._open()
+                if self._device is None:
+                    return
+            try:
+                data = self._read()
+            except EnvironmentError, e:
+                self._reconnect(e)
+                continue
+            if data is None:
+                return
+            for frame in self._frames(data):
+                yield frame
+
+class MultiCC128Source(object):
+    """
+    Iterates over (device, frame) tuples from several CC128s, all read from a
+    single poll() loop.
+
+    devices maps device names to serial ports. If it is None, every pl2303
+    device is used, named after its device file, and the devices are looked
+    for again every rescan_interval seconds so that new ones are picked up. A
+    device that goes away or is silent for silence_timeout seconds is
+    reopened every reconnect_interval seconds, without holding up the others.
+    opener is a function returning a new file-like object with a fileno() for
+    a port, open_cc128() by default. stop() works like CC128Source.stop().
+    """
+    def __init__(self, devices=None, read_size=4096, silence_timeout=60,
+                 reconnect_interval=1, rescan_interval=10, opener=None):
+        self._discover = devices is None
+        self._read_size = read_size
+        self._silence_timeout = silence_timeout
+        self._reconnect_interval = reconnect_interval
+        self._rescan_interval = rescan_interval
+        self._port_opener = opener or open_cc128
+        # name -> CC128Source, only used for its device and buffer
+        self._sources = {}
+        self._ports = {}
+        self._by_fd = {}
+        self._last_data = {}
+        self._retry_at = {}
+        self._next_rescan = 0
+        self._stopping = False
+        self._poll = select.poll()
+        for name, port in (devices or {}).iteritems():
+            self._add(name, port)
+
+    def stop(self):
+        self._stopping = True
+
+    @property
+    def reconnections(self):
+        return sum(source.reconnections for source in self._sources.itervalues())
+
+    def devices(self):
+        return sorted(self._sources)
+
+    def _add(self, name, port):
+        opener = lambda: self._port_opener(port)
+        self._sources[name] = CC128Source(port, opener=opener)
+        self._ports[name] = port
+        self._retry_at[name] = 0
+
+    def _rescan(self, now):
+        self._next_rescan = now + self._rescan_interval
+        ports = linux_find_all_pl2303()
+        for port in ports:
+            name = os.path.basename(port)
+            if name not in self._sources:
+                print >> sys.stderr, "Found CC128 %s" % port
+                self._add(name, port)
+        for name, source in self._sources.items():
+            if source._device is None and self._ports[name] not in ports:
+                # unplugged, it will be found again if it comes back
+                del self._sources[name]
+                del self._ports[name]
+                del self._retry_at[name]
+
+    def _open(self, name, now):
+        source = self._sources[name]
+        try:
+            source._device = source._opener()
+        except (EnvironmentError, RuntimeError), e:
+            print >> sys.stderr, "Could not open CC128 %s (%s)" % (name, e)
+            self._retry_at[name] = now + self._reconnect_interval
+            return
+        fd = source._device.fileno()
+        self._by_fd[fd] = name
+        self._poll.register(fd, select.POLLIN)
+        self._last_data[name] = now
+
+    def _lost(self, name, reason, now):
+        print >> sys.stderr, "Lost CC128 %s (%s), reopening" % (name, reason)
+        source = self._sources[name]
+        fd = source._device.fileno()
+        self._poll.unregister(fd)
+        del self._by_fd[fd]
+        del self._last_data[name]
+        source.close()
+        source.reconnections += 1
+        self._retry_at[name] = now + self._reconnect_interval
+
+    def _timeout(self, now):
+        """
+        Return how long poll() may wait, in milliseconds.
+        """
+        deadlines = [last_data + self._silence_timeout
+                     for last_data in self._last_data.itervalues()]
+        deadlines.append(now + CC128Source.STOP_CHECK_INTERVAL)
+        deadlines.extend(retry_at for name, retry_at in self._retry_at.iteritems()
+                         if self._sources[name]._device is None)
+        if self._discover:
+            deadlines.append(self._next_rescan)
+        return max(0, int((min(deadlines) - now) * 1000) + 1)
+
+    def close(self):
+        for name, source in self._sources.iteritems():
+            if source._device is not None:
+                self._poll.unregister(source._device.fileno())
+            source.close()
+        self._by_fd = {}
+        self._last_data = {}
+
+    def __iter__(self):
+        while not self._stopping:
+            now = time.time()
+            if self._discover and now >= self._next_rescan:
+                self._rescan(now)
+            for name, source in self._sources.items():
+                if source._device is None and now >= self._retry_at[name]:
+                    self._open(name, now)
+
+            try:
+                events = self._poll.poll(self._timeout(now))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for fd, event in events:
+                name = self._by_fd.get(fd)
+                if name is None:
+                    continue
+                try:
+                    data = os.read(fd, self._read_size)
+                except OSError, e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    self._lost(name, e, now)
+                    continue
+                if not data:
+                    self._lost(name, "end of file", now)
+                    continue
+                self._last_data[name] = now
+                for frame in self._sources[name]._frames(data):
+                    yield name, frame
+
+            for name, last_data in self._last_data.items():
+                if now - last_data > self._silence_timeout:
+                    # the CC128 talks every 6 seconds
+                    self._lost(name, "no data for %d seconds"
+                               % self._silence_timeout, now)
+
 if __name__ == '__main__':
-    print linux_find_pl2303()
+    for device in linux_find_all_pl2303():
+        print device
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stand-ins for a real CC128, to test and benchmark without the hardware.
+
+SimulatedCC128 makes up a realistic stream of messages, ReplaySource plays
+back a capture such as the log written by parser.IteratorLogger. Both can be
+iterated over like serial_tools.CC128Source, or served on a pty with
+serve_on_pty() so that a CC128Source (or the whole logger, through the
+"source" configuration entry) reads them like a serial port.
+"""
+
+import os, sys, time, math, random, threading, tty
+
+from parser import CSV_TIME_FORMAT
+
+MESSAGE_TEMPLATE = ("<msg><src>CC128-v0.11</src><dsb>%05d</dsb>"
+        "<time>%s</time><tmpr>%.1f</tmpr><sensor>%d</sensor>"
+        "<id>00077</id><type>1</type><ch1><watts>%05d</watts></ch1></msg>")
+
+HIST_TEMPLATE = ("<msg><src>CC128-v0.11</src><dsb>%05d</dsb>"
+        "<time>%s</time><hist><dsw>%05d</dsw><type>1</type>"
+        "<units>kwhr</units><data><sensor>0</sensor><h004>%05.3f</h004>"
+        "<h002>%05.3f</h002></data></hist></msg>")
+
+def make_message(time_stamp, power, temperature, sensor=0, days=1):
+    """
+    Return the message the CC128 sends for a reading at time_stamp (seconds
+    since EPOCH), without the line ending.
+    """
+    time_string = time.strftime("%H:%M:%S", time.localtime(time_stamp))
+    return MESSAGE_TEMPLATE % (days, time_string, temperature, sensor, power)
+
+class _Pacer(object):
+    """
+    Sleeps so that events with the given time stamps are spread like in real
+    time, divided by speed. A speed of 0 means as fast as possible.
+    """
+    def __init__(self, speed):
+        self._speed = float(speed)
+        self._start = None
+
+    def wait(self, time_stamp):
+        if not self._speed:
+            return
+        now = time.time()
+        if self._start is None:
+            self._start = (now, time_stamp)
+        wall_start, stamp_start = self._start
+        delay = wall_start + (time_stamp - stamp_start) / self._speed - now
+        if delay > 0:
+            time.sleep(delay)
+
+class SimulatedCC128(object):
+    """
+    Iterates over made up CC128 messages, one every period seconds (divided by
+    speed), count of them or forever. The power is a base load with
+    appliances going on and off, the temperature slowly follows the time of
+    the day. Every hist_every messages, a history message is sent as well.
+    """
+    def __init__(self, speed=1.0, count=None, period=6, start=None,
+                 seed=None, hist_every=600):
+        self._speed = speed
+        self._count = count
+        self._period = period
+        self._start = start
+        self._random = random.Random(seed)
+        self._hist_every = hist_every
+
+    def _readings(self):
+        time_stamp = self._start or int(time.time())
+        appliances = []
+        while True:
+            if self._random.random() < 0.02:
+                # kettle, oven, washing machine...
+                appliances.append([self._random.choice((800, 1200, 2000, 3000)),
+                                   self._random.randint(5, 300)])
+            power = 150 + self._random.randint(0, 30)
+            for appliance in appliances:
+                power += appliance[0]
+                appliance[1] -= 1
+            appliances = [appliance for appliance in appliances
+                          if appliance[1] > 0]
+            hour = (time_stamp % 86400) / 3600.
+            temperature = (19 + 2 * math.sin((hour - 9) * math.pi / 12)
+                           + self._random.gauss(0, 0.05))
+            yield time_stamp, power, temperature
+            time_stamp += self._period
+
+    def __iter__(self):
+        pacer = _Pacer(self._speed)
+        days = 1
+        for i, (time_stamp, power, temperature) in enumerate(self._readings()):
+            if self._count is not None and i >= self._count:
+                break
+            pacer.wait(time_stamp)
+            yield make_message(time_stamp, power, temperature, days=days)
+            if self._hist_every and i % self._hist_every == self._hist_every - 1:
+                time_string = time.strftime("%H:%M:%S",
+                                            time.localtime(time_stamp))
+                yield HIST_TEMPLATE % (days, time_string, 32,
+                                       self._random.uniform(0, 5),
+                                       self._random.uniform(0, 5))
+
+class ReplaySource(object):
+    """
+    Iterates over the messages of a capture file, at speed times the
+    original pace (0 for as fast as possible). Lines written by
+    parser.IteratorLogger ("<time>: <message>") are paced by their time
+    stamps, bare message lines one every period seconds. Empty lines are
+    skipped.
+    """
+    def __init__(self, path, speed=1.0, period=6, loop=False):
+        self._path = path
+        self._speed = speed
+        self._period = period
+        self._loop = loop
+
+    def _lines(self):
+        time_length = len(time.strftime(CSV_TIME_FORMAT))
+        capture = open(self._path)
+        try:
+            for i, line in enumerate(capture):
+                line = line.strip()
+                if not line:
+                    continue
+                prefix = line[:time_length]
+                if line[time_length:time_length + 2] == ": ":
+                    try:
+                        time_stamp = time.mktime(time.strptime(
+                                prefix, CSV_TIME_FORMAT))
+                        yield time_stamp, line[time_length + 2:]
+                        continue
+                    except ValueError:
+                        pass
+                yield i * self._period, line
+        finally:
+            capture.close()
+
+    def __iter__(self):
+        while True:
+            pacer = _Pacer(self._speed)
+            for time_stamp, line in self._lines():
+                pacer.wait(time_stamp)
+                yield line
+            if not self._loop:
+                break
+
+def serve_on_pty(messages):
+    """
+    Write messages to a new pty from a separate thread, each followed by a
+    line ending like the CC128 does. Return the path of the slave side, to be
+    opened like a serial port, and the thread.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    def write_messages():
+        try:
+            for message in messages:
+                os.write(master, message + "\r\n")
+        finally:
+            # let the reader see the end before the master goes away
+            time.sleep(0.5)
+            os.close(master)
+            os.close(slave)
+    thread = threading.Thread(target=write_messages, name="pty writer")
+    thread.daemon = True
+    thread.start()
+    return path, thread
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+            description="Simulate a CC128, on the standard output or a pty")
+    arg_parser.add_argument("-s", "--speed", type=float, default=1.0,
+            help="how many times faster than real time, 0 for no pauses")
+    arg_parser.add_argument("-n", "--count", type=int, default=None,
+            help="number of messages (default: forever)")
+    arg_parser.add_argument("-r", "--replay", metavar="CAPTURE",
+            help="replay a capture instead of making up data")
+    arg_parser.add_argument("-p", "--pty", action="store_true",
+            help="serve on a pty and print its path")
+    args = arg_parser.parse_args()
+
+    if args.replay:
+        messages = ReplaySource(args.replay, args.speed)
+    else:
+        messages = SimulatedCC128(args.speed, args.count)
+
+    try:
+        if args.pty:
+            path, thread = serve_on_pty(messages)
+            print path
+            sys.stdout.flush()
+            while thread.is_alive():
+                thread.join(1)
+        else:
+            for message in messages:
+                print message
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print >> sys.stderr, "\nBye!"
@@ -0,0 +1,460 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Write-ahead spool in front of the savers, so that no data point is lost if
+we get killed or if a saver fails (rrdtool error, full disk...).
+
+Every batch of data points is appended to the spool before being given to
+the savers. The spool is a sequence of segment files named after the offset
+of their first byte (spool.<offset>), holding records made of a header (length
+and crc32 of the payload) and a payload:
+    number of data points, length of the device name (native "=IH")
+    device name (UTF-8)
+    times, powers, temperatures (native arrays of "I", "i" and "d")
+    only for data points with a sensor: sensors, and the watts of each channel
+    (native arrays of "B" and "i")
+Each saver has an acknowledged offset in an ack.<name> file: everything
+before it has been flushed by the saver. Unacknowledged records are given
+again to the saver when we start, or when it recovers from a failure, and
+segments are removed once every saver has acknowledged them. A saver may thus
+get a few data points twice after a crash, never none.
+"""
+
+import os, sys, time, array, struct, zlib, collections, traceback
+
+from parser import DataPointBatch, CHANNELS
+from data_save import DataSaver
+from metrics import NULL_METRICS
+
+RECORD_HEADER = struct.Struct("=II")
+BATCH_HEADER = struct.Struct("=IH")
+COLUMN_TYPES = ('I', 'i', 'd')
+SENSOR_COLUMN_TYPES = ('B',) + ('i',) * CHANNELS
+ROW_SIZE = sum(array.array(typecode).itemsize for typecode in COLUMN_TYPES)
+
+def pack_batch(batch):
+    device = (batch.device or u'').encode('UTF-8')
+    columns = zip(COLUMN_TYPES, (batch.times, batch.powers,
+                                 batch.temperatures))
+    if batch.sensors is not None:
+        columns += zip(SENSOR_COLUMN_TYPES, (batch.sensors,) + batch.channels)
+    payload = "".join([BATCH_HEADER.pack(len(batch), len(device)), device] +
+                      [array.array(typecode, column.tolist()).tostring()
+                       for typecode, column in columns])
+    return RECORD_HEADER.pack(len(payload),
+                              zlib.crc32(payload) & 0xffffffff) + payload
+
+def unpack_batch(payload):
+    count, device_length = BATCH_HEADER.unpack_from(payload)
+    position = BATCH_HEADER.size
+    device = payload[position:position + device_length].decode('UTF-8') or None
+    position += device_length
+    column_types = COLUMN_TYPES
+    if position + count * ROW_SIZE < len(payload):
+        # it has sensors
+        column_types += SENSOR_COLUMN_TYPES
+    columns = []
+    for typecode in column_types:
+        column = array.array(typecode)
+        size = count * column.itemsize
+        column.fromstring(payload[position:position + size])
+        position += size
+        columns.append(column)
+    times, powers, temperatures = columns[:3]
+    sensors = channels = None
+    if len(columns) > 3:
+        sensors = columns[3]
+        channels = tuple(array.array('l', channel) for channel in columns[4:])
+    return DataPointBatch(array.array('l', times), array.array('l', powers),
+                          temperatures, device, sensors, channels)
+
+def _read_records(data):
+    """
+    Yield the end position and payload of each valid record of data, stopping
+    at the first incomplete or corrupted one.
+    """
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        position = start + length
+        yield position, payload
+
+class Spool(object):
+    SEGMENT_PREFIX = "spool."
+    ACK_PREFIX = "ack."
+
+    def __init__(self, directory, segment_size=16*1024*1024, fsync_every=None,
+                 fsync_interval=1):
+        """
+        A new segment is started once the current one is segment_size bytes
+        long. Appended records are forced to the disk every fsync_every
+        records and/or fsync_interval seconds (every record if both are 0).
+        """
+        self._directory = os.path.abspath(directory)
+        self._segment_size = segment_size
+        self._fsync_every = fsync_every
+        self._fsync_interval = fsync_interval
+        self._unsynced_records = 0
+        self._last_sync = time.time()
+        self.sync_seconds = NULL_METRICS.histogram(None)
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        # the offsets of the segments, only we add or remove any
+        self._bases = self.segments()
+        if self._bases:
+            self._base = self._bases[-1]
+            self._recover_segment()
+        else:
+            self._base = 0
+            self._bases.append(0)
+        self._open_segment()
+
+    def _segment_path(self, base):
+        return os.path.join(self._directory, "%s%020d" % (self.SEGMENT_PREFIX,
+                                                           base))
+
+    def segments(self):
+        """
+        Return the sorted offsets of the existing segments.
+        """
+        return sorted(int(file_name[len(self.SEGMENT_PREFIX):])
+                      for file_name in os.listdir(self._directory)
+                      if file_name.startswith(self.SEGMENT_PREFIX))
+
+    def _recover_segment(self):
+        # we may have been killed in the middle of a write
+        path = self._segment_path(self._base)
+        segment = open(path, "r+b")
+        try:
+            valid = 0
+            for valid, payload in _read_records(segment.read()):
+                pass
+            if valid != os.fstat(segment.fileno()).st_size:
+                print >> sys.stderr, "Spool: truncating %s to %d bytes" % (
+                        path, valid)
+                segment.truncate(valid)
+        finally:
+            segment.close()
+
+    def _open_segment(self):
+        path = self._segment_path(self._base)
+        # unbuffered: a record is with the OS as soon as append() returns
+        self._file = open(path, "ab", 0)
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    @property
+    def end(self):
+        return self._base + self._size
+
+    def append(self, batch):
+        """
+        Append batch, return the offset of the end of its record.
+        """
+        if self._size >= self._segment_size:
+            self.sync()
+            self._file.close()
+            self._base += self._size
+            self._bases.append(self._base)
+            self._open_segment()
+        record = pack_batch(batch)
+        self._file.write(record)
+        self._size += len(record)
+        self._unsynced_records += 1
+        if ((self._fsync_every is not None
+                and self._unsynced_records >= self._fsync_every)
+                or (self._fsync_interval is not None
+                    and time.time() - self._last_sync >= self._fsync_interval)):
+            self.sync()
+        return self.end
+
+    def sync(self):
+        if self._unsynced_records:
+            with self.sync_seconds.time():
+                os.fsync(self._file.fileno())
+        self._unsynced_records = 0
+        self._last_sync = time.time()
+
+    def read(self, offset, batch_size=10000):
+        """
+        Yield (end offset, batch) tuples for the records from offset to the
+        end. Consecutive records of the same device are merged into batches of
+        up to batch_size data points.
+        """
+        pending = None
+        pending_end = None
+        for base in list(self._bases):
+            if base + os.path.getsize(self._segment_path(base)) <= offset:
+                continue
+            segment = open(self._segment_path(base), "rb")
+            try:
+                segment.seek(max(0, offset - base))
+                data = segment.read()
+            finally:
+                segment.close()
+            start = max(base, offset)
+            for end, payload in _read_records(data):
+                batch = unpack_batch(payload)
+                if pending is not None and (pending.device != batch.device or
+                        (pending.sensors is None) != (batch.sensors is None) or
+                        len(pending) + len(batch) > batch_size):
+                    yield pending_end, pending
+                    pending = None
+                if pending is None:
+                    pending = batch
+                else:
+                    pending.extend(batch)
+                pending_end = start + end
+        if pending is not None:
+            yield pending_end, pending
+
+    def _ack_path(self, name):
+        return os.path.join(self._directory, self.ACK_PREFIX + name)
+
+    def acked(self, name):
+        """
+        Return the acknowledged offset of name, None if it has none.
+        """
+        try:
+            ack_file = open(self._ack_path(name))
+        except IOError:
+            return None
+        try:
+            return int(ack_file.read())
+        finally:
+            ack_file.close()
+
+    def ack(self, name, offset):
+        path = self._ack_path(name)
+        ack_file = open(path + ".tmp", "w")
+        try:
+            ack_file.write("%d\n" % offset)
+            ack_file.flush()
+            os.fsync(ack_file.fileno())
+        finally:
+            ack_file.close()
+        os.rename(path + ".tmp", path)
+
+    def truncate(self, offset):
+        """
+        Remove the segments that only hold data before offset.
+        """
+        # never the current one, the last
+        while len(self._bases) > 1 and self._bases[1] <= offset:
+            os.remove(self._segment_path(self._bases.pop(0)))
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class _SaverState(object):
+    def __init__(self, name, saver, delivered):
+        self.name = name
+        self.saver = saver
+        # everything before that offset was given to the saver
+        self.delivered = delivered
+        # what its ack file says
+        self.acked = delivered
+        self.failed = False
+        self.retry_at = 0
+        # waiting for a sync_later() to be done
+        self.syncing = False
+
+class SpoolingDataSaver(DataSaver):
+    """
+    Appends data to a Spool before giving it to named savers, and keeps
+    track of what each of them has flushed.
+
+    A saver that raises is left alone for retry_interval seconds, after
+    which everything it missed is given to it again with replay_many(), by
+    batches of up to replay_batch_size data points, as is what it had not
+    acknowledged when we start. Every ack_interval seconds, savers are
+    asked to write what they were given, and the offsets they were at are
+    acknowledged once they are done, without waiting for them.
+    """
+    def __init__(self, spool, savers, ack_interval=10, retry_interval=30,
+                 replay_batch_size=10000):
+        self._spool = spool
+        self._ack_interval = ack_interval
+        self._retry_interval = retry_interval
+        self._replay_batch_size = replay_batch_size
+        self._last_ack = time.time()
+        self._saver_seconds = {}
+        # (state, offset, error) of the sync_later() calls done, from the
+        # threads of the savers
+        self._synced = collections.deque()
+        self._states = []
+        for name, saver in savers:
+            delivered = spool.acked(name)
+            if delivered is None:
+                # new saver, it does not need what was there before
+                delivered = spool.end
+                spool.ack(name, delivered)
+            self._states.append(_SaverState(name, saver, delivered))
+        for state in self._states:
+            if state.delivered < spool.end:
+                print >> sys.stderr, "Spool: replaying %d bytes to %s" % (
+                        spool.end - state.delivered, state.name)
+                self._replay(state)
+
+    def _failed(self, state, action, error=None):
+        print >> sys.stderr, "Spool: %s failed in %s, retrying in %ds:" % (
+                state.name, action, self._retry_interval)
+        if error is None:
+            traceback.print_exc()
+        else:
+            print >> sys.stderr, error
+        state.failed = True
+        state.retry_at = time.time() + self._retry_interval
+        # what was given since the last acknowledgement may not have been
+        # written
+        state.delivered = state.acked
+
+    def _replay(self, state):
+        try:
+            for end, batch in self._spool.read(state.delivered,
+                                               self._replay_batch_size):
+                # not to be dropped by a queue, it would be acknowledged
+                state.saver.replay_many(batch)
+                state.delivered = end
+        except Exception:
+            self._failed(state, "replay")
+            return
+        state.failed = False
+
+    def update_many(self, batch):
+        start = self._spool.end
+        end = self._spool.append(batch)
+        now = time.time()
+        for state in self._states:
+            if state.failed:
+                if now >= state.retry_at:
+                    self._replay(state)
+                continue
+            if state.delivered != start:
+                continue
+            try:
+                with self._saver_seconds.get(
+                        state.name, NULL_METRICS.histogram(None)).time():
+                    state.saver.update_many(batch)
+            except Exception:
+                self._failed(state, "update")
+                continue
+            state.delivered = end
+        if now - self._last_ack >= self._ack_interval:
+            self._ack()
+        elif self._synced:
+            self._take_acks()
+
+    def update(self, data_point):
+        self.update_many(DataPointBatch.from_data_points([data_point],
+                                                         data_point.device))
+
+    def backfill(self, intervals, device=None, temperature=None):
+        # not spooled: the CC128 sends its history again
+        for state in self._states:
+            if state.failed:
+                continue
+            try:
+                state.saver.backfill(intervals, device, temperature)
+            except Exception:
+                self._failed(state, "backfill")
+
+    def _ack(self):
+        self._last_ack = time.time()
+        for state in self._states:
+            if state.failed or state.syncing:
+                continue
+            state.syncing = True
+            def done(error, state=state, delivered=state.delivered):
+                self._synced.append((state, delivered, error))
+            state.saver.sync_later(done)
+        self._take_acks()
+
+    def _take_acks(self):
+        while self._synced:
+            state, delivered, error = self._synced.popleft()
+            state.syncing = False
+            if state.failed:
+                continue
+            if error is not None:
+                self._failed(state, "flush", error)
+                continue
+            self._acked(state, delivered)
+        self._spool.truncate(min(state.acked for state in self._states))
+
+    def _acked(self, state, delivered):
+        self._spool.ack(state.name, delivered)
+        state.acked = delivered
+
+    def _ack_now(self):
+        """
+        Acknowledge what the savers were given, waiting for them to write it.
+        """
+        self._take_acks()
+        for state in self._states:
+            if state.failed:
+                continue
+            delivered = state.delivered
+            try:
+                state.saver.sync()
+            except Exception:
+                self._failed(state, "flush")
+                continue
+            self._acked(state, delivered)
+        self._spool.truncate(min(state.acked for state in self._states))
+
+    def flush(self):
+        self._spool.sync()
+        self._ack()
+
+    def close(self):
+        self._close(False)
+
+    def detach(self):
+        self._close(True)
+
+    def _close(self, detach):
+        self._spool.sync()
+        self._ack_now()
+        for state in self._states:
+            try:
+                if detach:
+                    state.saver.detach()
+                else:
+                    state.saver.close()
+            except Exception:
+                print >> sys.stderr, "Spool: error closing %s:" % state.name
+                traceback.print_exc()
+        self._spool.close()
+
+    def set_metrics(self, metrics, name):
+        self._spool.sync_seconds = metrics.histogram(
+                "cucologger_spool_sync_seconds")
+        for state in self._states:
+            self._saver_seconds[state.name] = metrics.histogram(
+                    "cucologger_saver_seconds", saver=state.name)
+            metrics.gauge("cucologger_spool_backlog_bytes",
+                          lambda state=state: self._spool.end - state.delivered,
+                          saver=state.name)
+            state.saver.set_metrics(metrics, state.name)
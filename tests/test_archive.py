@@ -0,0 +1,121 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile, shutil, calendar
+
+from archive import ArchiveDataSaver, ArchiveReader
+from parser import DataPoint, DataPointBatch
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _save(self, points, batch_size=7):
+        saver = ArchiveDataSaver(self._tempdir, batch_size=batch_size)
+        for point in points:
+            saver.update(point)
+        saver.close()
+
+    def _points(self, start, count, step=6):
+        return [DataPoint(time=start + i * step, power=300 + i % 500,
+                          temperature=18.5 + (i % 30) / 10.)
+                for i in xrange(count)]
+
+    def _as_tuples(self, points):
+        return [(p.time, p.power, p.temperature) for p in points]
+
+    def test_range(self):
+        # spans two monthly segments
+        start = calendar.timegm((2013, 1, 31, 23, 0, 0))
+        points = self._points(start, 1000)
+        self._save(points)
+
+        reader = ArchiveReader(self._tempdir)
+        self.assertEqual(reader.segment_names(), ["2013-01", "2013-02"])
+        query_start, query_end = start + 600, start + 4000
+        expected = [p for p in points if query_start <= p.time < query_end]
+        result = list(reader.data_points(query_start, query_end))
+        self.assertEqual(self._as_tuples(result), self._as_tuples(expected))
+
+        # boundaries between samples
+        result = list(reader.data_points(query_start + 1, query_end + 1))
+        self.assertEqual(self._as_tuples(result), self._as_tuples(expected[1:] +
+                         [p for p in points if p.time == query_end]))
+        self.assertEqual(list(reader.data_points(0, start)), [])
+        reader.close()
+
+    def test_views(self):
+        start = calendar.timegm((2013, 3, 1, 0, 0, 0))
+        points = self._points(start, 100)
+        self._save(points)
+        reader = ArchiveReader(self._tempdir)
+        (times, powers, temperatures), = reader.query(start, start + 60)
+        self.assertEqual(len(times), 10)
+        self.assertEqual(times[-1], start + 54)
+        self.assertEqual(list(powers[2:4]), [302, 303])
+        self.assertEqual(temperatures.to_array().tolist(),
+                         [p.temperature for p in points[:10]])
+        reader.close()
+
+    def test_append(self):
+        start = calendar.timegm((2013, 3, 1, 0, 0, 0))
+        points = self._points(start, 100)
+        self._save(points[:50])
+        reader = ArchiveReader(self._tempdir)
+        self.assertEqual(len(list(reader.data_points(start, start + 1000))), 50)
+        # out of order point is ignored
+        self._save(points[50:] + points[:1])
+        self.assertEqual(self._as_tuples(reader.data_points(start, start + 1000)),
+                         self._as_tuples(points))
+        reader.close()
+
+    def test_update_many(self):
+        start = calendar.timegm((2013, 1, 31, 23, 0, 0))
+        points = self._points(start, 1000)
+        saver = ArchiveDataSaver(self._tempdir)
+        for i in xrange(0, 1000, 300):
+            saver.update_many(DataPointBatch.from_data_points(points[i:i+300]))
+        # out of order batch is ignored
+        saver.update_many(DataPointBatch.from_data_points(points[:2]))
+        saver.close()
+        reader = ArchiveReader(self._tempdir)
+        self.assertEqual(self._as_tuples(reader.data_points(0, 2**32 - 1)),
+                         self._as_tuples(points))
+        reader.close()
+
+    def test_replayed(self):
+        start = calendar.timegm((2013, 3, 1, 0, 0, 0))
+        points = self._points(start, 20)
+        saver = ArchiveDataSaver(self._tempdir)
+        saver.update_many(DataPointBatch.from_data_points(points[:10]))
+        # given again from the last one saved, e.g. by a spool
+        saver.update(points[9])
+        saver.update_many(DataPointBatch.from_data_points(points[9:]))
+        saver.close()
+        self._save(points[19:])
+        reader = ArchiveReader(self._tempdir)
+        self.assertEqual(self._as_tuples(reader.data_points(0, 2**32 - 1)),
+                         self._as_tuples(points))
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile, shutil, os
+
+from bulk_import import BulkImporter
+from data_save import DataSaver, append_bz2_stream, APPENDING_SUFFIX
+
+class ListSaver(DataSaver):
+    def __init__(self):
+        self.data_points = []
+
+    def update(self, data_point):
+        self.data_points.append(data_point)
+
+class BulkImportTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _write(self, name, lines, compress=False):
+        path = os.path.join(self._tempdir, name)
+        csv_file = open(path, "w")
+        csv_file.write("".join(line + "\n" for line in lines))
+        csv_file.close()
+        if compress:
+            append_bz2_stream(path, path + ".bz2")
+            os.remove(path)
+            path += ".bz2"
+        return path
+
+    def test_import(self):
+        day1 = ["2013-03-01 23:59:54,350,18.3", "2013-03-01 23:59:59,351,18.4"]
+        day2 = ["2013-03-02 00:00:05,420,18.5"]
+        day3 = ["2013-03-03 00:00:05,430,18.6"]
+        paths = [self._write("power.2013-03-03.csv", day3),
+                 self._write("power.2013-03-02.csv", day2, compress=True),
+                 self._write("power.2013-03-01.csv", day1, compress=True)]
+
+        saver = ListSaver()
+        importer = BulkImporter([saver], jobs=2, batch_size=2)
+        rows, elapsed = importer.run(paths)
+        self.assertEqual(rows, 4)
+        self.assertEqual([p.to_csv() for p in saver.data_points],
+                         day1 + day2 + day3)
+
+    def test_day_files(self):
+        compressed = ["2013-03-01 00:00:05,350,18.3"]
+        pending1 = ["2013-03-01 08:00:05,351,18.4"]
+        pending2 = ["2013-03-01 12:00:05,352,18.5"]
+        written = ["2013-03-01 16:00:05,353,18.6"]
+        backfill = ["2013-03-01 04:00:00,200,18.3"]
+        name = "power.2013-03-01.csv"
+        compressed_path = self._write(name, compressed, compress=True)
+        pending1_path = self._write(name + ".123-1.pending", pending1)
+        pending2_path = self._write(name + ".99-2.pending", pending2)
+        os.utime(pending1_path, (1000, 1000))
+        os.utime(pending2_path, (2000, 2000))
+        # killed while compressing the first pending file
+        size = os.path.getsize(compressed_path)
+        append_bz2_stream(pending1_path, compressed_path)
+        appending = open(compressed_path + APPENDING_SUFFIX, "w")
+        appending.write("%d 0\n%s\n" % (size, pending1_path))
+        appending.close()
+        paths = [self._write(name, written),
+                 self._write(name + ".backfill", backfill),
+                 self._write(name + ".bz2.idx", ["1362096005 0"]),
+                 compressed_path + APPENDING_SUFFIX,
+                 pending2_path, pending1_path, compressed_path]
+
+        saver = ListSaver()
+        importer = BulkImporter([saver], jobs=2)
+        rows, elapsed = importer.run(paths)
+        self.assertEqual([p.to_csv() for p in saver.data_points],
+                         compressed + pending1 + pending2 + written)
+        self.assertEqual(rows, 4)
+
+if __name__ == '__main__':
+    unittest.main()
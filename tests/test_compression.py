@@ -0,0 +1,181 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile, shutil, os, random
+
+from compression import SwingDoorCompressor, Expander
+from data_save import CsvDataSaver
+from parser import CSVParser, DataPoint, DataPointBatch
+from query import CsvArchive
+
+POWER_TOLERANCE = 5
+TEMPERATURE_TOLERANCE = 0.1
+
+def make_points(count, start=1365000000, period=6, seed=4):
+    """
+    Power going from plateau to plateau with some noise, slowly changing
+    temperature.
+    """
+    rng = random.Random(seed)
+    points = []
+    power = 300
+    temperature = 18.0
+    for i in xrange(count):
+        if rng.random() < 0.01:
+            power = rng.choice((150, 300, 1200, 2500))
+        temperature += rng.choice((-0.1, 0, 0, 0, 0, 0.1))
+        points.append((start + i * period,
+                       (power + rng.randint(-2, 2), round(temperature, 1))))
+    return points
+
+def check_within_tolerance(test, points, expanded):
+    test.assertEqual([time_stamp for time_stamp, values in expanded],
+                     [time_stamp for time_stamp, values in points])
+    for (time_stamp, (power, temperature)), (_, (expanded_power,
+            expanded_temperature)) in zip(points, expanded):
+        # and the rounding
+        test.assertTrue(abs(power - expanded_power) <= POWER_TOLERANCE + .5,
+                        (time_stamp, power, expanded_power))
+        test.assertTrue(abs(temperature - expanded_temperature)
+                        <= TEMPERATURE_TOLERANCE + .0051,
+                        (time_stamp, temperature, expanded_temperature))
+
+class SwingDoorTest(unittest.TestCase):
+    def _compress(self, points, max_interval=300):
+        compressor = SwingDoorCompressor((POWER_TOLERANCE,
+                                          TEMPERATURE_TOLERANCE), max_interval)
+        stored = []
+        for time_stamp, values in points:
+            stored.extend(compressor.add(time_stamp, values))
+        stored.extend(compressor.flush())
+        return stored
+
+    def _expand(self, stored, max_interval=300):
+        expander = Expander(6, max_interval)
+        expanded = []
+        for time_stamp, values in stored:
+            expanded.extend(expander.add(time_stamp, values))
+        return expanded
+
+    def test_tolerance(self):
+        points = make_points(20000)
+        stored = self._compress(points)
+        self.assertTrue(len(stored) < len(points) / 4,
+                        (len(stored), len(points)))
+        self.assertEqual(stored[0], points[0])
+        self.assertEqual(stored[-1], points[-1])
+        check_within_tolerance(self, points, self._expand(stored))
+
+    def test_flat(self):
+        points = [(1365000000 + 6 * i, (300, 18.0)) for i in xrange(1000)]
+        stored = self._compress(points, max_interval=300)
+        # no more than max_interval between stored points
+        self.assertEqual(len(stored), 1 + (len(points) * 6 - 6) // 300 + 1)
+        check_within_tolerance(self, points, self._expand(stored))
+
+    def test_gap(self):
+        points = make_points(200) + make_points(200, start=1365010000)
+        stored = self._compress(points)
+        self.assertTrue(points[199] in stored)
+        self.assertTrue(points[200] in stored)
+        # nothing made up in the gap
+        check_within_tolerance(self, points, self._expand(stored))
+
+    def test_out_of_order(self):
+        points = make_points(10)
+        points[5], points[6] = points[6], points[5]
+        stored = self._compress(points)
+        self.assertTrue(points[5] in stored)
+        self.assertTrue(points[6] in stored)
+
+class CsvSwingDoorTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._points = make_points(3 * 14400, start=1365033600)
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _save(self, **options):
+        saver = CsvDataSaver(self._tempdir, index_interval=16,
+                             swing_door={"power": POWER_TOLERANCE,
+                                         "temperature": TEMPERATURE_TOLERANCE},
+                             **options)
+        times, values = zip(*self._points)
+        powers, temperatures = zip(*values)
+        for start in xrange(0, len(times), 1000):
+            saver.update_many(DataPointBatch(times[start:start + 1000],
+                                             powers[start:start + 1000],
+                                             temperatures[start:start + 1000]))
+        saver.close()
+
+    def _check(self, rows, start=0, end=2**31):
+        points = [point for point in self._points if start <= point[0] < end]
+        self.assertEqual(len(rows), len(points))
+        check_within_tolerance(self, points, rows)
+
+    def test_parser(self):
+        self._save()
+        rows = []
+        lines = 0
+        for file_name in sorted(os.listdir(self._tempdir)):
+            if not file_name.endswith(".csv"):
+                continue
+            data = open(os.path.join(self._tempdir, file_name)).read()
+            lines += data.count("\n")
+            times, powers, temperatures = CSVParser().parse_columns(data)
+            rows.extend(zip(times, zip(powers, temperatures)))
+        self.assertTrue(lines < len(self._points) / 4)
+        self._check(rows)
+
+        # line by line
+        csv_parser = CSVParser()
+        path = os.path.join(self._tempdir, sorted(os.listdir(self._tempdir))[0])
+        points = [(point.time, (point.power, point.temperature))
+                  for line in open(path)
+                  for point in csv_parser.parse_msg(line)]
+        self.assertEqual(points, rows[:len(points)])
+
+    def test_flush(self):
+        saver = CsvDataSaver(self._tempdir, swing_door={"power": 50})
+        for time_stamp in (1365033600, 1365033606, 1365033612):
+            saver.update(DataPoint(time=time_stamp, power=300,
+                                   temperature=18.0))
+        saver.flush()
+        path = os.path.join(self._tempdir, "power.2013-04-04.csv")
+        lines = open(path).read().splitlines()
+        self.assertTrue(lines[0].startswith("# swing-door "))
+        self.assertEqual(lines[1:], ["2013-04-04 00:00:00,300,18.0",
+                                     "2013-04-04 00:00:12,300,18.0"])
+        saver.close()
+
+    def test_query(self):
+        self._save(compress=True, compressed_block_size=4096)
+        archive = CsvArchive(self._tempdir)
+        start = self._points[0][0]
+        for range_start, range_end in ((start, start + 86400 * 3),
+                                       (start + 3600 * 14 + 7,
+                                        start + 3600 * 30)):
+            self._check([(time_stamp, (power, temperature))
+                         for time_stamp, power, temperature
+                         in archive.rows(range_start, range_end)],
+                        range_start, range_end)
+
+if __name__ == '__main__':
+    unittest.main()
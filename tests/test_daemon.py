@@ -0,0 +1,322 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, time, json, signal, threading
+
+from parser import DataPoint, DataPointBatch
+from data_save import DataSaver, CsvDataSaver, QueuedDataSaver
+from cucologger import CucoLogger, CucoLoggerConfigException, _running_pid
+from cucologger import saver_resources, _HeldData
+from simulator import make_message
+
+class StuckSaver(DataSaver):
+    """
+    Never done detaching.
+    """
+    release = threading.Event()
+
+    def __init__(self):
+        pass
+
+    def update(self, data_point):
+        pass
+
+    def detach(self):
+        self.release.wait()
+
+class BusySaver(DataSaver):
+    """
+    Not done detaching until released.
+    """
+    release = None
+
+    def __init__(self, directory=None):
+        pass
+
+    def update(self, data_point):
+        pass
+
+    def detach(self):
+        self.release.wait()
+
+class FlakySaver(DataSaver):
+    """
+    Cannot be made while broken.
+    """
+    broken = False
+    saved = []
+
+    def __init__(self, directory=None):
+        if self.broken:
+            raise IOError("device busy")
+
+    def update(self, data_point):
+        self.saved.append(data_point.power)
+
+class DetachingSaver(DataSaver):
+    def __init__(self):
+        self.detached = False
+        self.closed = False
+
+    def update(self, data_point):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def detach(self):
+        self.detached = True
+
+def powers(directory):
+    return [int(line.split(",")[1])
+            for file_name in sorted(os.listdir(directory))
+            if file_name.endswith(".csv")
+            for line in open(os.path.join(directory, file_name))]
+
+class DetachTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_csv(self):
+        now = int(time.time())
+        saver = CsvDataSaver(self._tempdir, compress=True)
+        saver.update(DataPoint(now, 300, 18.0))
+        saver.detach()
+        # left as it is, no compression
+        self.assertEqual([file_name for file_name in os.listdir(self._tempdir)
+                          if not file_name.endswith(".idx")],
+                         [time.strftime(CsvDataSaver.FILE_NAME_TEMPLATE,
+                                        time.gmtime(now))])
+        saver = CsvDataSaver(self._tempdir, compress=True)
+        saver.update(DataPoint(now + 6, 310, 18.0))
+        saver.detach()
+        self.assertEqual(powers(self._tempdir), [300, 310])
+
+    def test_queued(self):
+        inner = DetachingSaver()
+        QueuedDataSaver(inner).detach()
+        self.assertTrue(inner.detached)
+        self.assertFalse(inner.closed)
+
+class ResourcesTest(unittest.TestCase):
+    def test_saver_resources(self):
+        self.assertEqual(saver_resources("CsvDataSaver", {"directory": "data"}),
+                         set([("directory", os.path.abspath("data"))]))
+        # connecting to a thermostat holds nothing here
+        self.assertEqual(saver_resources("ThermostatSaver", {"port": 4000}),
+                         set())
+        self.assertEqual(saver_resources("LiveDataSaver", {}),
+                         set([("listen", "127.0.0.1:8081")]))
+        self.assertEqual(saver_resources("test_daemon:BusySaver",
+                                         {"port": "/dev/ttyUSB1"}),
+                         set([("serial", "/dev/ttyUSB1")]))
+
+    def test_held_data(self):
+        held = _HeldData(max_points=3)
+        for power in xrange(3):
+            held.update_many(DataPointBatch.from_data_points(
+                    [DataPoint(power, power, 18.0)]))
+        held.backfill(["interval"])
+        held.update_many(DataPointBatch.from_data_points(
+                [DataPoint(3, 3, 18.0), DataPoint(4, 4, 18.0)]))
+        self.assertEqual(held.dropped, 2)
+        saver = FlakySaver()
+        FlakySaver.saved = []
+        held.replay([saver])
+        self.assertEqual(FlakySaver.saved, [2, 3, 4])
+
+class SignalsTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._config_file = os.path.join(self._tempdir, "cucologger.conf")
+        self._now = int(time.time())
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _config(self, name):
+        return {"savers": {"CsvDataSaver": {
+                    "directory": os.path.join(self._tempdir, name)}}}
+
+    def _write_config(self, config):
+        json.dump(config, open(self._config_file, "w"))
+
+    def test_reload(self):
+        self._write_config(self._config("before"))
+        logger = CucoLogger(self._config("before"))
+        logger._config_file = self._config_file
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            yield make_message(self._now, 310, 18.0)
+            self._write_config(self._config("after"))
+            logger._on_reload(signal.SIGHUP, None)
+            yield make_message(self._now, 320, 18.0)
+            self._write_config({"savers": {"Nope": {}}})
+            logger._on_reload(signal.SIGHUP, None)
+            yield make_message(self._now, 330, 18.0)
+        logger._source = source()
+        logger.run()
+        # the reload happens between two messages, and a wrong configuration
+        # changes nothing
+        self.assertEqual(powers(os.path.join(self._tempdir, "before")),
+                         [300, 310, 320])
+        self.assertEqual(powers(os.path.join(self._tempdir, "after")), [330])
+
+    def test_reload_failure(self):
+        logger = CucoLogger(self._config("before"))
+        savers = logger._savers
+        config = self._config("after")
+        config['savers']['CsvDataSaver']['colour'] = "red"
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            self.assertRaises(CucoLoggerConfigException, logger.reload,
+                              config)
+            # the current savers are left alone
+            self.assertTrue(logger._savers is savers)
+            yield make_message(self._now, 310, 18.0)
+        logger._source = source()
+        logger.run()
+        self.assertEqual(powers(os.path.join(self._tempdir, "before")),
+                         [300, 310])
+
+    def test_reload_same_directory(self):
+        logger = CucoLogger(self._config("data"))
+        config = self._config("data")
+        config['savers']['CsvDataSaver']['queue'] = {"size": 10}
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            logger.reload(config)
+            yield make_message(self._now, 310, 18.0)
+            yield make_message(self._now, 320, 18.0)
+        logger._source = source()
+        logger.run()
+        self.assertEqual(logger._config, config)
+        self.assertEqual(powers(os.path.join(self._tempdir, "data")),
+                         [300, 310, 320])
+
+    def test_reload_busy(self):
+        BusySaver.release = threading.Event()
+        busy = os.path.join(self._tempdir, "busy")
+        logger = CucoLogger({"savers": {"test_daemon:BusySaver": {
+                                 "directory": busy}},
+                             "shutdown_timeout": 0.2})
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            start = time.time()
+            logger.reload(self._config("after"))
+            # not waiting for the busy saver
+            self.assertTrue(time.time() - start < 0.1)
+            yield make_message(self._now, 310, 18.0)
+            # its directory is still in use
+            self.assertRaises(CucoLoggerConfigException, logger.reload,
+                              self._config("busy"))
+            BusySaver.release.set()
+            time.sleep(0.1)
+            logger.reload(self._config("busy"))
+            yield make_message(self._now, 320, 18.0)
+        logger._source = source()
+        logger.run()
+        self.assertEqual(powers(os.path.join(self._tempdir, "after")), [310])
+        self.assertEqual(powers(busy), [320])
+
+    def test_reload_retry(self):
+        FlakySaver.saved = []
+        config = {"savers": {"test_daemon:FlakySaver": {
+                      "directory": os.path.join(self._tempdir, "data")}}}
+        logger = CucoLogger(config)
+        logger.RELOAD_RETRY_INTERVAL = 0.1
+        new_config = json.loads(json.dumps(config))
+        new_config['savers']['test_daemon:FlakySaver']['queue'] = {"size": 10}
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            FlakySaver.broken = True
+            logger.reload(new_config)
+            logger._pending_reload[3].join()
+            # neither configuration can be made
+            yield make_message(self._now, 310, 18.0)
+            self.assertTrue(logger._pending_reload is not None)
+            FlakySaver.broken = False
+            time.sleep(0.2)
+            yield make_message(self._now, 320, 18.0)
+            self.assertTrue(logger._pending_reload is None)
+        logger._source = source()
+        try:
+            logger.run()
+        finally:
+            FlakySaver.broken = False
+        self.assertEqual(logger._config, new_config)
+        self.assertEqual(FlakySaver.saved, [300, 310, 320])
+
+    def test_terminate_while_reading(self):
+        logger = CucoLogger(self._config("data"))
+        def source():
+            yield make_message(self._now, 300, 18.0)
+            logger._on_terminate(signal.SIGTERM, None)
+            yield make_message(self._now, 310, 18.0)
+        logger._source = source()
+        # what was read is saved, then the logger stops
+        logger.run()
+        self.assertEqual(powers(os.path.join(self._tempdir, "data")),
+                         [300, 310])
+
+    def test_terminate_while_saving(self):
+        logger = CucoLogger(self._config("data"))
+        class TerminatingSaver(DataSaver):
+            def update_many(self, batch):
+                logger._on_terminate(signal.SIGTERM, None)
+        logger._savers.append(TerminatingSaver())
+        logger._saver_names.append("terminating")
+        logger._source = [make_message(self._now, 300, 18.0),
+                          make_message(self._now, 310, 18.0)]
+        # the batch is saved, then the logger stops
+        logger.run()
+        self.assertEqual(powers(os.path.join(self._tempdir, "data")), [300])
+
+    def test_bounded_drain(self):
+        config = {"savers": {"test_daemon:StuckSaver": {}},
+                  "shutdown_timeout": 0.2}
+        logger = CucoLogger(config, source=[make_message(self._now, 300, 18.0)])
+        logger._stop_requested = True
+        start = time.time()
+        logger.run()
+        self.assertTrue(time.time() - start < 5)
+        StuckSaver.release.set()
+
+class PidFileTest(unittest.TestCase):
+    def test_running_pid(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            pidfile = os.path.join(tempdir, "cucologger.pid")
+            self.assertEqual(_running_pid(pidfile), None)
+            open(pidfile, "w").write("%d\n" % os.getpid())
+            self.assertEqual(_running_pid(pidfile), os.getpid())
+            # a child that is gone
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            os.waitpid(pid, 0)
+            open(pidfile, "w").write("%d\n" % pid)
+            self.assertEqual(_running_pid(pidfile), None)
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,10 +16,12 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
-import tempfile, shutil, time, os, bz2
+import tempfile, shutil, time, os, bz2, threading
 
-from data_save import CsvDataSaver
-from parser import DataPoint
+from data_save import CsvDataSaver, DataSaver, QueuedDataSaver, RrdDataSaver
+from data_save import PerDeviceSaver, DeviceFilterSaver
+from data_save import read_bz2_streams, append_bz2_stream
+from parser import DataPoint, DataPointBatch, CsvTimeFormatter
 
 class FastRotatingCsvDataSaver(CsvDataSaver):
     FILE_NAME_TEMPLATE = "power.%Y-%m-%d-%H-%M-%S.csv"
@@ -64,6 +66,7 @@ class CsvTest(unittest.TestCase):
         point2 = DataPoint(time=int(time.time()), temperature=18.5, power=420)
         second_file_name = self._file_name_now()
         saver.update(point2)
+        saver.wait_for_compression()
         self.assertTrue(os.path.exists(second_file_name))
         self.assertFalse(os.path.exists(first_file_name))
         self.assertTrue(os.path.exists(first_file_name + '.bz2'))
@@ -126,11 +129,444 @@ class CsvTest(unittest.TestCase):
         saver.close()
         del saver
 
-        save_file = bz2.BZ2File(file_path, "r")
-        data = save_file.read()
+        # appended as a second bz2 stream
+        data = "".join(read_bz2_streams(file_path))
         expected = "%s\n%s\n" % (point1.to_csv(), point2.to_csv())
         self.assertEqual(data, expected)
 
+    def test_resume_pending(self):
+        # as left by a run that was killed while compressing
+        file_path = time.strftime(os.path.join(self._tempdir,
+                                               CsvDataSaver.FILE_NAME_TEMPLATE))
+        pending = open(file_path + ".1-1.pending", "w")
+        pending.write("pending\n")
+        pending.close()
+
+        saver = CsvDataSaver(self._tempdir, compress=True)
+        point = DataPoint(time=int(time.time()), temperature=18.5, power=420)
+        saver.update(point)
+        saver.close()
+
+        data = "".join(read_bz2_streams(file_path + ".bz2"))
+        self.assertEqual(data, "pending\n%s\n" % point.to_csv())
+        self.assertEqual(sorted(os.listdir(self._tempdir)),
+                         [os.path.basename(file_path) + ".bz2",
+                          os.path.basename(file_path) + ".bz2.idx"])
+
+    def test_resume_pending_order(self):
+        file_path = time.strftime(os.path.join(self._tempdir,
+                                               CsvDataSaver.FILE_NAME_TEMPLATE))
+        # oldest first: pid 99 before pid 100, and within a process the
+        # count, the modification times being the same
+        now = time.time()
+        for suffix, mtime in ((".5-10.pending", now), (".5-2.pending", now),
+                              (".100-1.pending", now - 10),
+                              (".99-1.pending", now - 20)):
+            pending = open(file_path + suffix, "w")
+            pending.write(suffix + "\n")
+            pending.close()
+            os.utime(file_path + suffix, (mtime, mtime))
+
+        saver = CsvDataSaver(self._tempdir, compress=True)
+        saver.close()
+
+        data = "".join(read_bz2_streams(file_path + ".bz2"))
+        self.assertEqual(data, ".99-1.pending\n.100-1.pending\n"
+                               ".5-2.pending\n.5-10.pending\n")
+
+    def test_point_time_rotation(self):
+        # backfilled data goes to the file of its own day
+        saver = CsvDataSaver(self._tempdir)
+        noon = int(time.mktime(time.localtime()[:3] + (12, 0, 0, 0, 0, -1)))
+        points = [DataPoint(time=noon - days * 86400 + i, temperature=18.5,
+                            power=420 + i)
+                  for days in (3, 1, 0) for i in xrange(3)]
+        for point in points:
+            saver.update(point)
+        saver.close()
+
+        template_path = os.path.join(self._tempdir, CsvDataSaver.FILE_NAME_TEMPLATE)
+        for day in xrange(3):
+            day_points = points[3*day:3*day+3]
+            file_path = time.strftime(template_path,
+                                      time.localtime(day_points[0].time))
+            expected = "".join("%s\n" % point.to_csv() for point in day_points)
+            self.assertEqual(open(file_path).read(), expected)
+
+    def test_durability_record(self):
+        saver = CsvDataSaver(self._tempdir, durability="record")
+        point = DataPoint(time=int(time.time()), temperature=18.3, power=350)
+        saver.update(point)
+        file_path = time.strftime(os.path.join(self._tempdir,
+                                               CsvDataSaver.FILE_NAME_TEMPLATE))
+        # on disk without closing
+        self.assertEqual(open(file_path).read(), point.to_csv() + "\n")
+        saver.close()
+
+    def test_update_many(self):
+        noon = int(time.mktime(time.localtime()[:3] + (12, 0, 0, 0, 0, -1)))
+        points = [DataPoint(time=noon - days * 86400 + i, temperature=18.5,
+                            power=420 + i)
+                  for days in (1, 0) for i in xrange(3)]
+        saver = CsvDataSaver(self._tempdir, durability="record")
+        saver.update_many(DataPointBatch.from_data_points(points[1:]))
+        saver.update(points[0])
+        saver.close()
+
+        template_path = os.path.join(self._tempdir, CsvDataSaver.FILE_NAME_TEMPLATE)
+        for day_points in (points[1:3] + points[:1], points[3:]):
+            file_path = time.strftime(template_path,
+                                      time.localtime(day_points[0].time))
+            expected = "".join("%s\n" % point.to_csv() for point in day_points)
+            self.assertEqual(open(file_path).read(), expected)
+
+    def test_bad_durability(self):
+        self.assertRaises(ValueError, CsvDataSaver, self._tempdir,
+                          durability="never")
+
+class CsvTimeFormatterTest(unittest.TestCase):
+    def test_same_as_to_csv(self):
+        formatter = CsvTimeFormatter()
+        for time_stamp in range(1364000000, 1364000200, 7) + [0, 59, 60, 1e9,
+                                                             "13:02:39"]:
+            point = DataPoint(time=time_stamp, temperature=18.3, power=350)
+            self.assertEqual(formatter.format(time_stamp),
+                             point.to_csv().split(",")[0])
+
+class Bz2StreamsTest(unittest.TestCase):
+    def test_many_streams(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            source_path = os.path.join(tempdir, "source")
+            compressed_path = os.path.join(tempdir, "compressed.bz2")
+            expected = ""
+            for i in xrange(5):
+                data = "".join("line %d %d\n" % (i, j) for j in xrange(1000 * i))
+                open(source_path, "w").write(data)
+                append_bz2_stream(source_path, compressed_path)
+                expected += data
+            self.assertEqual("".join(read_bz2_streams(compressed_path)),
+                             expected)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_killed_append(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            compressed_path = os.path.join(tempdir, "power.csv.bz2")
+            index_path = compressed_path + ".idx"
+            first_path = os.path.join(tempdir, "first")
+            first = DataPoint(time=1364000000, temperature=18.0,
+                              power=300).to_csv() + "\n"
+            open(first_path, "w").write(first)
+            append_bz2_stream(first_path, compressed_path, index_path)
+            self.assertFalse(os.path.exists(compressed_path + ".appending"))
+
+            # killed half way through appending the second file, which is
+            # still there
+            second_path = os.path.join(tempdir, "second")
+            second = "".join(DataPoint(time=1364000006 + i, temperature=18.0,
+                                       power=310).to_csv() + "\n"
+                             for i in xrange(1000))
+            open(second_path, "w").write(second)
+            complete = open(compressed_path, "rb").read()
+            complete_index = open(index_path).read()
+            append_bz2_stream(second_path, compressed_path, index_path)
+            appended = open(compressed_path, "rb").read()
+            open(compressed_path + ".appending", "w").write(
+                    "%d %d\n%s\n" % (len(complete), len(complete_index),
+                                      second_path))
+            open(compressed_path, "wb").write(
+                    appended[:len(complete) + (len(appended) - len(complete)) / 2])
+
+            append_bz2_stream(second_path, compressed_path, index_path,
+                              remove_source=True)
+            self.assertEqual("".join(read_bz2_streams(compressed_path)),
+                             first + second)
+            self.assertEqual(len(open(index_path).readlines()), 2)
+            self.assertEqual(sorted(os.listdir(tempdir)),
+                             ["first", "power.csv.bz2", "power.csv.bz2.idx"])
+        finally:
+            shutil.rmtree(tempdir)
+
+class BlockedDataSaver(DataSaver):
+    def __init__(self):
+        self.unblock = threading.Event()
+        self.saved = []
+        self.backfilled = []
+        self.flushed = 0
+        self.closed = False
+
+    def update(self, data_point):
+        self.unblock.wait()
+        self.saved.append(data_point.power)
+
+    def backfill(self, intervals, device=None, temperature=None):
+        self.backfilled.append(intervals)
+
+    def flush(self):
+        self.flushed += 1
+
+    def close(self):
+        self.closed = True
+
+class QueuedTest(unittest.TestCase):
+    def _fill(self, saver, count):
+        for power in xrange(count):
+            saver.update(DataPoint(time=power, temperature=18.0, power=power))
+
+    def test_block(self):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=2)
+        producer = threading.Thread(target=self._fill, args=(saver, 20))
+        producer.start()
+        # at most one taken by the worker and two queued
+        producer.join(0.3)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(len(saver), 2)
+        self.assertEqual(saver.dropped, 0)
+        blocked.unblock.set()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        saver.close()
+        self.assertEqual(blocked.saved, range(20))
+        self.assertTrue(blocked.closed)
+
+    def test_drop_oldest(self):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=3, overflow="drop-oldest")
+        self._fill(saver, 10)
+        blocked.unblock.set()
+        saver.close()
+        # the worker may have taken the first one before blocking
+        self.assertEqual(blocked.saved[-3:], [7, 8, 9])
+        self.assertTrue(len(blocked.saved) <= 4)
+        self.assertEqual(saver.dropped, 10 - len(blocked.saved))
+
+    def test_coalesce_latest(self):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=2, overflow="coalesce-latest")
+        self._fill(saver, 10)
+        blocked.unblock.set()
+        saver.close()
+        self.assertEqual(blocked.saved[-1], 9)
+        self.assertTrue(len(blocked.saved) <= 3)
+
+    def _check_dropped_batches(self, overflow):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=1, overflow=overflow)
+        for start in xrange(0, 50, 5):
+            saver.update_many(DataPointBatch.from_data_points(
+                    [DataPoint(time=power, temperature=18.0, power=power)
+                     for power in xrange(start, start + 5)]))
+        blocked.unblock.set()
+        saver.close()
+        self.assertTrue(len(blocked.saved) <= 10)
+        # every data point of the batches lost counts
+        self.assertEqual(saver.dropped, 50 - len(blocked.saved))
+
+    def test_dropped_batches_drop_oldest(self):
+        self._check_dropped_batches("drop-oldest")
+
+    def test_dropped_batches_coalesce_latest(self):
+        self._check_dropped_batches("coalesce-latest")
+
+    def test_close_timeout(self):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, close_timeout=0.3)
+        self._fill(saver, 3)
+        start = time.time()
+        saver.close()
+        self.assertTrue(time.time() - start < 2)
+        self.assertFalse(blocked.closed)
+        blocked.unblock.set()
+
+    def _check_backfill(self, overflow):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=2, overflow=overflow)
+        # the worker may take the first one and wait on it, so that the queue
+        # is full either way
+        self._fill(saver, 2 if overflow == "block" else 3)
+        saver.backfill(["interval"])
+        if overflow != "block":
+            self._fill(saver, 10)
+        blocked.unblock.set()
+        saver.close()
+        self.assertEqual(blocked.backfilled, [["interval"]])
+
+    def test_backfill_block(self):
+        self._check_backfill("block")
+
+    def test_backfill_drop_oldest(self):
+        self._check_backfill("drop-oldest")
+
+    def test_backfill_coalesce_latest(self):
+        self._check_backfill("coalesce-latest")
+
+    def test_flush(self):
+        blocked = BlockedDataSaver()
+        blocked.unblock.set()
+        saver = QueuedDataSaver(blocked)
+        self._fill(saver, 5)
+        saver.flush()
+        saver.close()
+        self.assertEqual(blocked.saved, range(5))
+        self.assertEqual(blocked.flushed, 1)
+
+    def test_update_many(self):
+        blocked = BlockedDataSaver()
+        saver = QueuedDataSaver(blocked, size=1)
+        points = [DataPoint(time=i, temperature=18.0, power=i)
+                  for i in xrange(10)]
+        blocked.unblock.set()
+        saver.update_many(DataPointBatch.from_data_points(points[:5]))
+        saver.update_many(DataPointBatch())
+        saver.update_many(DataPointBatch.from_data_points(points[5:]))
+        saver.close()
+        self.assertEqual(blocked.saved, range(10))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, QueuedDataSaver, BlockedDataSaver(),
+                          overflow="ignore")
+
+class RrdTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._power_file = os.path.join(self._tempdir, RrdDataSaver.POWER_FILE)
+        self._temperature_file = os.path.join(self._tempdir,
+                                              RrdDataSaver.TEMPERATURE_FILE)
+        self._start = int(time.time()) - 3600
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _last(self, path):
+        import rrdtool
+        return rrdtool.last(path)
+
+    def _update(self, saver, *offsets):
+        for offset in offsets:
+            saver.update(DataPoint(self._start + offset, 300 + offset, 20.0))
+
+    def test_batch_size(self):
+        saver = RrdDataSaver(self._tempdir, batch_size=3)
+        self._update(saver, 0, 6)
+        self.assertEqual(saver._pending_count(), 2)
+        self.assertTrue(self._last(self._power_file) < self._start)
+        self._update(saver, 12)
+        self.assertEqual(saver._pending_count(), 0)
+        self.assertEqual(self._last(self._power_file), self._start + 12)
+        self.assertEqual(self._last(self._temperature_file), self._start + 12)
+        self._update(saver, 18)
+        saver.close()
+        self.assertEqual(self._last(self._power_file), self._start + 18)
+
+    def test_staleness(self):
+        saver = RrdDataSaver(self._tempdir, batch_size=100, max_staleness=30)
+        self._update(saver, 0, 6)
+        self.assertEqual(saver._pending_count(), 2)
+        # the oldest sample is 30 seconds older than the newest one
+        self._update(saver, 30)
+        self.assertEqual(saver._pending_count(), 0)
+        self.assertEqual(self._last(self._power_file), self._start + 30)
+        saver.close()
+
+    def test_staleness_without_samples(self):
+        saver = RrdDataSaver(self._tempdir, batch_size=100, max_staleness=0.2)
+        self._update(saver, 0)
+        deadline = time.time() + 5
+        while saver._pending_count() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(saver._pending_count(), 0)
+        self.assertEqual(self._last(self._power_file), self._start)
+        # and again for the next batch
+        self._update(saver, 6)
+        deadline = time.time() + 5
+        while saver._pending_count() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self._last(self._power_file), self._start + 6)
+        saver.close()
+
+    def test_update_failure(self):
+        saver = RrdDataSaver(self._tempdir, batch_size=100)
+        self._update(saver, 0, 6)
+        # rrdtool cannot open the power file
+        os.rename(self._power_file, self._power_file + ".away")
+        self.assertRaises(Exception, saver.flush)
+        # the temperature file got its samples, the power file keeps them
+        self.assertEqual(self._last(self._temperature_file), self._start + 6)
+        self.assertEqual(saver._pending_count(), 2)
+        os.rename(self._power_file + ".away", self._power_file)
+        self._update(saver, 12)
+        saver.flush()
+        self.assertEqual(saver._pending_count(), 0)
+        self.assertEqual(self._last(self._power_file), self._start + 12)
+        self.assertEqual(self._last(self._temperature_file), self._start + 12)
+        saver.close()
+
+class DevicesTest(unittest.TestCase):
+    def _batch(self, device, powers):
+        return DataPointBatch.from_data_points(
+                [DataPoint(time=i, temperature=18.0, power=power)
+                 for i, power in enumerate(powers)], device)
+
+    def test_per_device(self):
+        savers = {}
+        def factory(device):
+            saver = savers[device] = BlockedDataSaver()
+            saver.unblock.set()
+            return saver
+        saver = PerDeviceSaver(factory)
+        saver.update_many(self._batch("kitchen", [1, 2]))
+        saver.update_many(self._batch("garage", [3]))
+        saver.update(DataPoint(time=3, temperature=18.0, power=4,
+                               device="kitchen"))
+        saver.close()
+        self.assertEqual(savers["kitchen"].saved, [1, 2, 4])
+        self.assertEqual(savers["garage"].saved, [3])
+        self.assertTrue(savers["garage"].closed)
+
+    def test_filter(self):
+        blocked = BlockedDataSaver()
+        blocked.unblock.set()
+        saver = DeviceFilterSaver(blocked, "kitchen")
+        saver.update_many(self._batch("kitchen", [1, 2]))
+        saver.update_many(self._batch("garage", [3]))
+        self.assertEqual(blocked.saved, [1, 2])
+
+    def test_batch_device(self):
+        batch = self._batch("kitchen", [1, 2, 3])
+        self.assertEqual(batch[1].device, "kitchen")
+        self.assertEqual(batch[1:].device, "kitchen")
+        self.assertEqual([point.device for point in batch], ["kitchen"] * 3)
+
+    def test_logger(self):
+        # imported here, it needs the savers' dependencies
+        from cucologger import CucoLogger
+        from simulator import make_message
+        tempdir = tempfile.mkdtemp()
+        try:
+            config = {
+                "source": {"devices": {"kitchen": None, "garage": None}},
+                "savers": {"CsvDataSaver": {"directory": tempdir}},
+                }
+            now = int(time.time())
+            messages = [("kitchen", make_message(now, 300, 18.0)),
+                        ("garage", make_message(now, 1200, 12.5)),
+                        ("kitchen", make_message(now, 310, 18.0))]
+            CucoLogger(config, source=messages).run()
+            self.assertEqual(sorted(os.listdir(tempdir)), ["garage", "kitchen"])
+            def powers(device):
+                directory = os.path.join(tempdir, device)
+                return [line.split(",")[1]
+                        for file_name in os.listdir(directory)
+                        if file_name.endswith(".csv")
+                        for line in open(os.path.join(directory, file_name))]
+            self.assertEqual(powers("kitchen"), ["300", "310"])
+            self.assertEqual(powers("garage"), ["1200"])
+        finally:
+            shutil.rmtree(tempdir)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,153 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, time, urllib2, threading
+
+from data_save import RrdDataSaver
+from parser import DataPoint
+from graphing import GraphCache, GraphServer, GraphDefinition
+
+class ControlledGraphCache(GraphCache):
+    """
+    Tells the last update we want instead of asking rrdtool.
+    """
+    last_update = 0
+
+    def _last_update(self):
+        return self.last_update
+
+class GraphCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._rrd_directory = os.path.join(self._tempdir, "rrd")
+        self._cache_directory = os.path.join(self._tempdir, "cache")
+        saver = RrdDataSaver(self._rrd_directory)
+        now = int(time.time())
+        for i in xrange(10):
+            saver.update(DataPoint(time=now - 60 + 6 * i, power=300 + i,
+                                   temperature=20.0))
+        saver.close()
+        self._now = now
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_cached(self):
+        graphs = ControlledGraphCache(self._rrd_directory,
+                                      self._cache_directory, workers=0)
+        graphs.last_update = self._now
+        path = graphs.graph("day", self._now)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(graphs.graph("day", self._now), path)
+        self.assertEqual(graphs.renders, 1)
+        # a new sample in the time span, while a request still reads the
+        # previous graph
+        reading = open(path, "rb")
+        graphs.last_update = self._now + 6
+        self.assertEqual(graphs.graph("day", self._now), path)
+        self.assertEqual(graphs.renders, 2)
+        self.assertNotEqual(os.fstat(reading.fileno()).st_ino,
+                            os.stat(path).st_ino)
+        self.assertTrue(reading.read())
+        reading.close()
+        self.assertEqual(os.listdir(self._cache_directory),
+                         [os.path.basename(path)])
+        # a past day does not see it
+        graphs.graph("day", self._now - 86400)
+        graphs.last_update = self._now + 12
+        graphs.graph("day", self._now - 86400)
+        self.assertEqual(graphs.renders, 3)
+
+    def test_reload(self):
+        graphs = ControlledGraphCache(self._rrd_directory,
+                                      self._cache_directory, workers=0)
+        graphs.last_update = self._now
+        path = graphs.graph("week", self._now)
+        graphs = ControlledGraphCache(self._rrd_directory,
+                                      self._cache_directory, workers=0)
+        graphs.last_update = self._now
+        self.assertEqual(graphs.graph("week", self._now), path)
+        self.assertEqual(graphs.renders, 0)
+        graphs.last_update = self._now + 6
+        self.assertEqual(graphs.graph("week", self._now), path)
+        self.assertEqual(graphs.renders, 1)
+
+    def test_unfinished_render(self):
+        os.makedirs(self._cache_directory)
+        open(os.path.join(self._cache_directory,
+                          "day-%d.png.%d.tmp" % (self._now, self._now)),
+             "w").close()
+        ControlledGraphCache(self._rrd_directory, self._cache_directory,
+                             workers=0)
+        self.assertEqual(os.listdir(self._cache_directory), [])
+
+    def test_keep(self):
+        graphs = ControlledGraphCache(self._rrd_directory,
+                                      self._cache_directory, workers=0, keep=2)
+        for day in xrange(4):
+            graphs.graph("day", self._now - day * 86400)
+        self.assertEqual(len(os.listdir(self._cache_directory)), 2)
+
+    def test_unknown(self):
+        graphs = GraphCache(self._rrd_directory, self._cache_directory,
+                            workers=0)
+        self.assertRaises(ValueError, graphs.graph, "decade")
+
+    def _serve(self, graphs, check):
+        server = GraphServer(graphs, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            check("http://127.0.0.1:%d/" % server.server_address[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            graphs.close()
+
+    def _assert_status(self, url, status):
+        try:
+            urllib2.urlopen(url)
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, status)
+        else:
+            self.fail("%s did not fail" % url)
+
+    def test_server(self):
+        def check(url):
+            png = urllib2.urlopen(url + "day.png").read()
+            self.assertTrue(len(png) > 0)
+            self._assert_status(url + "decade.png", 404)
+            self._assert_status(url + "day.png?end=yesterday", 400)
+        self._serve(GraphCache(self._rrd_directory, self._cache_directory),
+                    check)
+
+    def test_server_errors(self):
+        definitions = {"backwards": GraphDefinition("backwards", -86400)}
+        def check(url):
+            # rrdtool refuses to draw a time span ending before it starts
+            self._assert_status(url + "backwards.png", 400)
+        self._serve(GraphCache(self._rrd_directory, self._cache_directory,
+                               definitions, workers=0), check)
+        def check(url):
+            self._assert_status(url + "day.png", 404)
+        self._serve(GraphCache(os.path.join(self._tempdir, "none"),
+                               self._cache_directory, workers=0), check)
+
+if __name__ == '__main__':
+    unittest.main()
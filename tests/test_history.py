@@ -0,0 +1,172 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, time
+
+from parser import CC128StreamParser, CC128StreamLiveParser
+from parser import DataPoint, DataPointBatch, HistoryRecord
+from data_save import CsvDataSaver
+from archive import ArchiveDataSaver, ArchiveReader
+from query import CsvArchive
+from simulator import HIST_TEMPLATE, make_message
+import history
+
+HIST = HIST_TEMPLATE % (1, "13:02:42", 32, 1.5, 0.25) + "\r\n"
+
+def local_time(*fields):
+    return int(time.mktime(fields + (0,) * (6 - len(fields)) + (0, 0, -1)))
+
+class ParserTest(unittest.TestCase):
+    def test_history(self):
+        stream_parser = CC128StreamParser(history=True)
+        self.assertEqual(list(stream_parser.parse_msg(HIST)), [])
+        record, = stream_parser.pop_history()
+        self.assertEqual(record.time, "13:02:42")
+        self.assertEqual(record.entries, [(0, "h", 4, 1.5), (0, "h", 2, 0.25)])
+        self.assertEqual(stream_parser.pop_history(), [])
+
+    def test_ignored(self):
+        stream_parser = CC128StreamParser()
+        self.assertEqual(list(stream_parser.parse_msg(HIST)), [])
+        self.assertEqual(stream_parser.pop_history(), [])
+
+    def test_live(self):
+        stream_parser = CC128StreamLiveParser(history=True)
+        before = int(time.time())
+        stream_parser.parse_batch(make_message(before, 300, 18.0) + HIST)
+        record, = stream_parser.pop_history()
+        self.assertTrue(before <= record.time <= time.time())
+
+class IntervalsTest(unittest.TestCase):
+    def test_bounds(self):
+        record = HistoryRecord(local_time(2013, 5, 10, 13, 2, 42),
+                               [(0, "h", 2, 0.25), (0, "h", 4, 1.5),
+                                (0, "d", 1, 10.0), (0, "m", 5, 300.0),
+                                (1, "d", 1, 2.0)])
+        bounds = [(interval.sensor, interval.start, interval.end,
+                   interval.energy) for interval in history.intervals(record)]
+        self.assertEqual(bounds, [
+                (0, local_time(2013, 5, 10, 11), local_time(2013, 5, 10, 13),
+                 250),
+                (0, local_time(2013, 5, 10, 9), local_time(2013, 5, 10, 11),
+                 1500),
+                (0, local_time(2013, 5, 9), local_time(2013, 5, 10), 10000),
+                (0, local_time(2012, 12, 1), local_time(2013, 1, 1), 300000),
+                (1, local_time(2013, 5, 9), local_time(2013, 5, 10), 2000)])
+        self.assertEqual(len(history.intervals(record, ("m",))), 1)
+
+class MissingPointsTest(unittest.TestCase):
+    def test_gap(self):
+        # 600W held for the first hour, nothing in the second
+        held = [(1000 + 6 * i, 600, 20.0) for i in xrange(600)]
+        interval = history.Interval(0, "h", 1000, 8200, 1500)
+        batch = history.missing_points([interval], lambda start, end: held)
+        self.assertEqual(list(batch.times), range(4600, 8200, 6))
+        self.assertEqual(set(batch.powers), set([900]))
+        self.assertEqual(set(batch.temperatures), set([20.0]))
+
+    def test_no_gap(self):
+        held = [(1000 + 6 * i, 600, 20.0) for i in xrange(1200)]
+        interval = history.Interval(0, "h", 1000, 8200, 1500)
+        self.assertEqual(len(history.missing_points(
+                [interval], lambda start, end: held)), 0)
+
+    def test_shortest_first(self):
+        # the first period explains 1 kWh of the 3 of the whole
+        intervals = [history.Interval(0, "d", 1000, 15400, 3000),
+                     history.Interval(0, "h", 1000, 8200, 1000)]
+        batch = history.missing_points(intervals, lambda start, end: [],
+                                       temperature=18.0)
+        self.assertEqual(list(batch.times), range(1000, 15400, 6))
+        self.assertEqual(batch.powers[0], 500)
+        self.assertEqual(batch.powers[-1], 1000)
+
+    def test_no_temperature(self):
+        interval = history.Interval(0, "h", 1000, 8200, 1500)
+        self.assertEqual(len(history.missing_points(
+                [interval], lambda start, end: [])), 0)
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._start = local_time(2013, 5, 10, 9)
+        # data from 9:00 to 10:00 and from 12:00 to 13:00
+        times = range(self._start, self._start + 3600, 6) + range(
+                self._start + 3 * 3600, self._start + 4 * 3600, 6)
+        self._batch = DataPointBatch.from_data_points(
+                [DataPoint(time_stamp, 500, 20.0) for time_stamp in times])
+        self._intervals = history.intervals(HistoryRecord(
+                self._start + 4 * 3600 + 162,
+                [(0, "h", 2, 1.0), (0, "h", 4, 1.5)]))
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _check(self, rows):
+        times = [row[0] for row in rows]
+        self.assertEqual(sorted(times), range(self._start,
+                                              self._start + 4 * 3600, 6))
+        energy = sum(row[1] for row in rows) * 6 / 3600.
+        self.assertAlmostEqual(energy, 2500, delta=5)
+
+    def test_csv(self):
+        saver = CsvDataSaver(self._tempdir)
+        saver.update_many(self._batch)
+        saver.backfill(self._intervals)
+        # nothing more the second time
+        saver.backfill(self._intervals)
+        saver.close()
+        self._check(list(CsvArchive(self._tempdir).rows(
+                self._start, self._start + 4 * 3600)))
+
+    def test_archive(self):
+        saver = ArchiveDataSaver(self._tempdir)
+        saver.update_many(self._batch)
+        saver.backfill(self._intervals)
+        saver.backfill(self._intervals)
+        # still appends after the new rows
+        saver.update(DataPoint(self._start + 4 * 3600, 500, 20.0))
+        saver.close()
+        reader = ArchiveReader(self._tempdir)
+        rows = [(point.time, point.power) for point in reader.data_points(
+                self._start, self._start + 5 * 3600)]
+        reader.close()
+        self.assertEqual([row[0] for row in rows],
+                         sorted(row[0] for row in rows))
+        self._check(rows[:-1])
+
+    def test_backfiller(self):
+        saver = CsvDataSaver(self._tempdir)
+        saver.update_many(self._batch)
+        backfiller = history.Backfiller([saver])
+        record = HistoryRecord(self._start + 4 * 3600 + 162,
+                               [(0, "h", 2, 1.0), (0, "h", 4, 1.5),
+                                (1, "h", 2, 0.5)])
+        backfiller.add(record)
+        # no temperature to go by yet
+        self.assertEqual(backfiller.intervals, 0)
+        backfiller.seen(self._batch)
+        backfiller.add(record)
+        backfiller.add(record)
+        self.assertEqual(backfiller.intervals, 2)
+        saver.close()
+        self._check(list(CsvArchive(self._tempdir).rows(
+                self._start, self._start + 4 * 3600)))
+
+if __name__ == '__main__':
+    unittest.main()
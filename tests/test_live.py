@@ -0,0 +1,102 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import json, socket, urllib2
+
+from parser import DataPoint, DataPointBatch
+from live import RingBuffer, LiveDataSaver
+
+def make_batch(times):
+    return DataPointBatch.from_data_points(
+            [DataPoint(time=t, power=t % 1000, temperature=t / 10.)
+             for t in times])
+
+class RingBufferTest(unittest.TestCase):
+    def test_wrap(self):
+        ring = RingBuffer(4)
+        self.assertEqual(ring.latest(), None)
+        ring.extend(range(1, 7), range(101, 107), [20.0] * 6)
+        self.assertEqual(len(ring), 4)
+        self.assertEqual(ring.latest(), (6, 106, 20.0))
+        self.assertEqual([row[0] for row in ring.range()], [3, 4, 5, 6])
+        self.assertEqual([row[0] for row in ring.range(4, 6)], [4, 5])
+        self.assertEqual(ring.range(7, 10), [])
+
+    def test_out_of_order(self):
+        ring = RingBuffer(4)
+        ring.extend([10, 5, 10, 12], [1, 2, 3, 4], [20.0] * 4)
+        self.assertEqual([row[0] for row in ring.range()], [10, 12])
+        self.assertEqual(ring.sequence, 2)
+
+    def test_since(self):
+        ring = RingBuffer(3)
+        ring.extend([1, 2], [1, 2], [20.0] * 2)
+        self.assertEqual(ring.since(1), (2, [(2, 2, 20.0)]))
+        ring.extend([3, 4, 5], [3, 4, 5], [20.0] * 3)
+        # what is not in the buffer any more is lost
+        sequence, rows = ring.since(1)
+        self.assertEqual(sequence, 5)
+        self.assertEqual([row[0] for row in rows], [3, 4, 5])
+
+class LiveDataSaverTest(unittest.TestCase):
+    def setUp(self):
+        self._saver = LiveDataSaver(retention=60, period=6, port=0)
+        self._url = "http://127.0.0.1:%d" % self._saver.port
+
+    def tearDown(self):
+        self._saver.close()
+
+    def _get(self, path):
+        return json.load(urllib2.urlopen(self._url + path, timeout=5))
+
+    def test_latest_and_range(self):
+        self.assertRaises(urllib2.HTTPError, self._get, "/latest")
+        self._saver.update_many(make_batch([1000, 1006, 1012]))
+        self._saver.update(DataPoint(time=1018, power=18, temperature=101.8))
+        self.assertEqual(self._get("/latest"), {'time': 1018, 'power': 18,
+                                                'temperature': 101.8})
+        self.assertEqual(self._get("/range?start=1006&end=1018"),
+                         [[1006, 6, 100.6], [1012, 12, 101.2]])
+        self.assertEqual(len(self._get("/range")), 4)
+
+    def test_stream(self):
+        self._saver.update_many(make_batch([1000]))
+        connection = socket.create_connection(("127.0.0.1", self._saver.port),
+                                              timeout=5)
+        try:
+            connection.sendall("GET /stream HTTP/1.0\r\n"
+                               "Last-Event-ID: 0\r\n\r\n")
+            stream = connection.makefile()
+            self.assertTrue(stream.readline().startswith("HTTP/1.0 200"))
+            while stream.readline() != "\r\n":
+                pass
+            def event():
+                lines = [stream.readline(), stream.readline(),
+                         stream.readline()]
+                self.assertEqual(lines[2], "\n")
+                return lines[0].strip(), json.loads(lines[1][len("data: "):])
+            # what was missed, then what comes
+            self.assertEqual(event(), ("id: 1", {'time': 1000, 'power': 0,
+                                                 'temperature': 100.0}))
+            self._saver.update_many(make_batch([1006]))
+            self.assertEqual(event()[0], "id: 2")
+        finally:
+            connection.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile, shutil, os, time, zlib
+
+from data_save import CsvDataSaver, append_bz2_stream, read_gzip_members
+from data_save import APPENDING_SUFFIX
+import compression
+from maintenance import Maintenance
+from query import CsvArchive
+from bulk_import import load_csv_file
+
+def day_rows(day, count, start=0):
+    return ["%s %02d:%02d:%02d,%d,%.1f" % (day, i // 3600, i // 60 % 60,
+                                           i % 60, 300 + i % 7, 18 + i % 3)
+            for i in xrange(start * 6, (start + count) * 6, 6)]
+
+class MaintenanceTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _path(self, file_name):
+        return os.path.join(self._tempdir, file_name)
+
+    def _write(self, file_name, rows):
+        csv_file = open(self._path(file_name), "w")
+        csv_file.write("".join(row + "\n" for row in rows))
+        csv_file.close()
+
+    def _files(self):
+        return sorted(os.listdir(self._tempdir))
+
+    def test_merge(self):
+        # compressed in the morning, the logger was killed while compressing
+        # the afternoon, and restarted in the evening
+        morning = day_rows("2013-03-01", 2000)
+        afternoon = day_rows("2013-03-01", 2000, 2000)
+        evening = day_rows("2013-03-01", 2000, 4000)
+        self._write("power.2013-03-01.csv.1-1.pending", morning)
+        append_bz2_stream(self._path("power.2013-03-01.csv.1-1.pending"),
+                          self._path("power.2013-03-01.csv.bz2"),
+                          self._path("power.2013-03-01.csv.bz2.idx"), 4096)
+        os.remove(self._path("power.2013-03-01.csv.1-1.pending"))
+        self._write("power.2013-03-01.csv.2-1.pending", afternoon)
+        append_bz2_stream(self._path("power.2013-03-01.csv.2-1.pending"),
+                          self._path("power.2013-03-01.csv.bz2"),
+                          self._path("power.2013-03-01.csv.bz2.idx"), 4096)
+        self._write("power.2013-03-01.csv", evening)
+        self._write("power.2013-03-02.csv", day_rows("2013-03-02", 100))
+        today = time.strftime(CsvDataSaver.FILE_NAME_TEMPLATE)
+        self._write(today, [])
+
+        maintenance = Maintenance(self._tempdir, jobs=2, block_size=4096)
+        results = maintenance.run()
+        self.assertEqual(sorted((result['day'], result['rows'],
+                                 result['duplicates']) for result in results),
+                         [("power.2013-03-01.csv", 6000, 2000),
+                          ("power.2013-03-02.csv", 100, 0)])
+        self.assertEqual(self._files(), sorted([
+                "maintenance.state.json", today,
+                "power.2013-03-01.csv.gz", "power.2013-03-01.csv.gz.idx",
+                "power.2013-03-02.csv.gz", "power.2013-03-02.csv.gz.idx"]))
+
+        data = "".join(read_gzip_members(self._path("power.2013-03-01.csv.gz")))
+        self.assertEqual(data.splitlines(), morning + afternoon + evening)
+        index = open(self._path("power.2013-03-01.csv.gz.idx")).readlines()
+        self.assertTrue(len(index) > 10)
+
+        # readers use the .gz files and their index
+        archive = CsvArchive(self._tempdir)
+        start = int(time.mktime((2013, 3, 1, 5, 0, 0, 0, 0, -1)))
+        rows = list(archive.lines(start, start + 3600))
+        self.assertEqual(rows, [row for row in morning + afternoon + evening
+                                if "2013-03-01 05:" <= row < "2013-03-01 06:"])
+        times, powers, temperatures = load_csv_file(
+                self._path("power.2013-03-02.csv.gz"))
+        self.assertEqual(len(times), 100)
+
+        # nothing new
+        self.assertEqual(Maintenance(self._tempdir).run(), [])
+
+        # late data for a processed day
+        self._write("power.2013-03-02.csv", day_rows("2013-03-02", 10, 100))
+        results = Maintenance(self._tempdir).run()
+        self.assertEqual([(result['day'], result['rows'])
+                          for result in results],
+                         [("power.2013-03-02.csv", 110)])
+
+    def test_backfill(self):
+        # gaps filled in from the history go between the rows
+        rows = day_rows("2013-03-03", 100)
+        self._write("power.2013-03-03.csv", rows[:40] + rows[60:])
+        self._write("power.2013-03-03.csv.backfill", rows[40:60])
+        results = Maintenance(self._tempdir, jobs=1).run()
+        self.assertEqual([result['rows'] for result in results], [100])
+        data = "".join(read_gzip_members(self._path("power.2013-03-03.csv.gz")))
+        self.assertEqual(data.splitlines(), rows)
+        self.assertFalse(os.path.exists(
+                self._path("power.2013-03-03.csv.backfill")))
+
+    def test_killed_compression(self):
+        morning = day_rows("2013-03-04", 2000)
+        afternoon = day_rows("2013-03-04", 2000, 2000)
+        compressed_path = self._path("power.2013-03-04.csv.bz2")
+        index_path = compressed_path + CsvDataSaver.INDEX_SUFFIX
+        self._write("power.2013-03-04.csv.1-1.pending", morning)
+        append_bz2_stream(self._path("power.2013-03-04.csv.1-1.pending"),
+                          compressed_path, index_path)
+        os.remove(self._path("power.2013-03-04.csv.1-1.pending"))
+        # killed halfway through compressing the afternoon
+        pending_path = self._path("power.2013-03-04.csv.2-1.pending")
+        self._write("power.2013-03-04.csv.2-1.pending", afternoon)
+        start = os.path.getsize(compressed_path)
+        index_start = os.path.getsize(index_path)
+        append_bz2_stream(pending_path, compressed_path, index_path, 4096)
+        compressed_file = open(compressed_path, "r+b")
+        compressed_file.truncate((start + os.path.getsize(compressed_path)) / 2)
+        compressed_file.close()
+        appending = open(compressed_path + APPENDING_SUFFIX, "w")
+        appending.write("%d %d\n%s\n" % (start, index_start, pending_path))
+        appending.close()
+
+        results = Maintenance(self._tempdir, jobs=1).run()
+        self.assertEqual([(result['rows'], result['duplicates'])
+                          for result in results], [(4000, 0)])
+        data = "".join(read_gzip_members(self._path("power.2013-03-04.csv.gz")))
+        self.assertEqual(data.splitlines(), morning + afternoon)
+        self.assertEqual(self._files(), sorted([
+                "maintenance.state.json",
+                "power.2013-03-04.csv.gz", "power.2013-03-04.csv.gz.idx"]))
+
+    def test_swing_door_backfill(self):
+        header = compression.format_header(6, 300, [("power", 5)]).rstrip("\n")
+        rows = day_rows("2013-03-05", 100)
+        self._write("power.2013-03-05.csv", [header] + rows[:40] + rows[60:])
+        self._write("power.2013-03-05.csv.backfill", rows[40:60])
+        Maintenance(self._tempdir, jobs=1).run()
+        data = "".join(read_gzip_members(self._path("power.2013-03-05.csv.gz")))
+        self.assertEqual(data.splitlines(), [header] + rows)
+
+    def test_verify(self):
+        self._write("power.2013-03-02.csv", day_rows("2013-03-02", 100))
+        maintenance = Maintenance(self._tempdir, jobs=1)
+        maintenance.run()
+        self.assertEqual([result.get('error') for result in
+                          maintenance.verify()], [None])
+
+        path = self._path("power.2013-03-02.csv.gz")
+        data = "".join(read_gzip_members(path))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzip_file = open(path, "wb")
+        gzip_file.write(compressor.compress(data.replace(
+                "2013-03-02 00:00:06,306", "2013-03-02 00:00:06,999")))
+        gzip_file.write(compressor.flush())
+        gzip_file.close()
+        results = Maintenance(self._tempdir).verify()
+        self.assertTrue("does not match" in results[0]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
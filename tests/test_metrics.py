@@ -0,0 +1,116 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, json, urllib2
+
+import metrics
+from metrics import Metrics, Histogram, NULL_METRICS, StatsFileWriter, \
+        PrometheusServer
+from simulator import SimulatedCC128
+from cucologger import CucoLogger
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram()
+        for i in xrange(90):
+            histogram.observe(0.0002)
+        for i in xrange(10):
+            histogram.observe(0.2)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(.5), 0.00025)
+        self.assertEqual(histogram.percentile(.99), 0.25)
+        histogram.observe(100)
+        self.assertEqual(histogram.percentile(1), float('inf'))
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.counter("messages").inc(3)
+        metrics.gauge("depth", lambda: 7, saver="Csv")
+        metrics.histogram("seconds", stage="parse").observe(0.003)
+        lines = metrics.to_prometheus().splitlines()
+        self.assertTrue("# TYPE messages counter" in lines)
+        self.assertTrue("messages 3" in lines)
+        self.assertTrue('depth{saver="Csv"} 7' in lines)
+        self.assertTrue('seconds_bucket{stage="parse",le="0.0025"} 0' in lines)
+        self.assertTrue('seconds_bucket{stage="parse",le="0.005"} 1' in lines)
+        self.assertTrue('seconds_bucket{stage="parse",le="+Inf"} 1' in lines)
+        self.assertTrue('seconds_count{stage="parse"} 1' in lines)
+
+    def test_null_metrics(self):
+        NULL_METRICS.counter("messages").inc()
+        NULL_METRICS.histogram("seconds").observe(1)
+        self.assertFalse(NULL_METRICS.enabled)
+
+    def test_timer(self):
+        histogram = Metrics().histogram("seconds")
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.count, 1)
+        # nothing is timed when metrics are disabled
+        clock = metrics.time.time
+        metrics.time.time = None
+        try:
+            with NULL_METRICS.histogram("seconds").time():
+                pass
+        finally:
+            metrics.time.time = clock
+
+    def test_prometheus_server(self):
+        metrics = Metrics()
+        metrics.counter("messages").inc()
+        server = PrometheusServer(metrics, port=0)
+        try:
+            body = urllib2.urlopen("http://127.0.0.1:%d/metrics"
+                                   % server.port).read()
+        finally:
+            server.close()
+        self.assertTrue("messages 1\n" in body)
+
+class LoggerMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_stats_file(self):
+        stats_path = os.path.join(self._tempdir, "stats.json")
+        config = {
+            "savers": {"CsvDataSaver": {
+                "directory": os.path.join(self._tempdir, "csv"),
+                "queue": {"size": 10}}},
+            "metrics": {"stats_file": stats_path, "interval": 60},
+            }
+        messages = list(SimulatedCC128(speed=0, count=30, seed=1))
+        messages.append("<msg><time>garbage</msg>")
+        CucoLogger(config, source=messages).run()
+        stats = json.load(open(stats_path))
+        self.assertEqual(stats['counters']['cucologger_messages'], 31)
+        self.assertEqual(stats['counters']['cucologger_data_points'], 30)
+        self.assertEqual(stats['gauges']['cucologger_malformed_messages'], 1)
+        self.assertEqual(stats['gauges'][
+                'cucologger_queue_depth{saver="CsvDataSaver"}'], 0)
+        saver_time = stats['histograms'][
+                'cucologger_saver_seconds{saver="CsvDataSaver"}']
+        self.assertEqual(saver_time['count'], 30)
+        self.assertEqual(stats['histograms'][
+                'cucologger_queued_save_seconds{saver="CsvDataSaver"}']
+                ['count'], 30)
+        self.assertEqual(stats['histograms'][
+                'cucologger_csv_rotation_seconds{saver="CsvDataSaver"}']
+                ['count'], 1)
@@ -0,0 +1,124 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import time, calendar
+
+from parser import CC128Parser, CC128StreamParser, CC128StreamLiveParser
+from parser import CSVParser, CSVTimeParser
+from parser import CSV_TIME_FORMAT, DataPoint, DataPointBatch
+
+MESSAGES = [
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:39</time>"
+    "<tmpr>18.7</tmpr><sensor>1</sensor><id>01234</id><type>1</type>"
+    "<ch1><watts>00345</watts></ch1><ch2><watts>02151</watts></ch2>"
+    "<ch3><watts>00000</watts></ch3></msg>\r\n",
+    # history message, ignored
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:42</time>"
+    "<hist><dsw>00032</dsw><type>1</type><units>kwhr</units><data>"
+    "<sensor>0</sensor><h024>001.1</h024></data></hist></msg>\r\n",
+    # empty temperature, ignored
+    "<msg><src>CC128-v0.11</src><time>13:02:45</time><tmpr></tmpr>"
+    "<ch1><watts>00345</watts></ch1></msg>\r\n",
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:48</time>"
+    "<tmpr>18.8</tmpr><sensor>0</sensor><id>01234</id><type>1</type>"
+    "<ch1><watts>00350</watts></ch1></msg>\r\n",
+]
+
+class CC128StreamParserTest(unittest.TestCase):
+    def _to_csv(self, data_points):
+        return [data_point.to_csv() for data_point in data_points]
+
+    def _reference(self):
+        bs4_parser = CC128Parser()
+        expected = []
+        for line in MESSAGES:
+            expected.extend(bs4_parser.parse_msg(line))
+        return self._to_csv(expected)
+
+    def test_same_as_bs4(self):
+        stream_parser = CC128StreamParser()
+        result = []
+        for line in MESSAGES:
+            result.extend(stream_parser.parse_msg(line))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(self._to_csv(result), self._reference())
+
+    def test_chunked(self):
+        data = "".join(MESSAGES)
+        for chunk_size in (1, 3, 7, 64):
+            stream_parser = CC128StreamParser()
+            result = []
+            for i in xrange(0, len(data), chunk_size):
+                result.extend(stream_parser.parse_msg(data[i:i+chunk_size]))
+            self.assertEqual(self._to_csv(result), self._reference())
+
+    def test_garbage(self):
+        stream_parser = CC128StreamParser()
+        result = list(stream_parser.parse_msg("junk</msg><msg><time>1</ti"))
+        result += list(stream_parser.parse_msg("me><msg>" + MESSAGES[0]))
+        self.assertEqual(self._to_csv(result), self._reference()[:1])
+
+class DataPointBatchTest(unittest.TestCase):
+    def test_batch(self):
+        points = [DataPoint(time=1364000000 + i, power=300 + i,
+                            temperature=18.5) for i in xrange(10)]
+        batch = DataPointBatch.from_data_points(points)
+        self.assertEqual(len(batch), 10)
+        self.assertEqual([p.to_csv() for p in batch],
+                         [p.to_csv() for p in points])
+        self.assertEqual(batch[-1].to_csv(), points[-1].to_csv())
+        self.assertEqual([p.power for p in batch[2:4]], [302, 303])
+        self.assertRaises(TypeError, batch.append,
+                          DataPoint(time="13:02:39", power=1, temperature=1.))
+
+    def test_parse_batch(self):
+        batch = CC128StreamLiveParser().parse_batch("".join(MESSAGES))
+        self.assertEqual([p.power for p in batch], [345, 350])
+        # time stamps are not in seconds
+        self.assertRaises(TypeError, CC128StreamParser().parse_batch,
+                          MESSAGES[0])
+        data = "2013-03-01 00:00:06,350,18.3\n2013-03-01 00:00:12,420,18.5\n"
+        self.assertEqual([p.to_csv() for p in CSVParser().parse_batch(data)],
+                         data.splitlines())
+
+class CSVParserTest(unittest.TestCase):
+    def _reference(self, time_string):
+        return calendar.timegm(time.strptime(time_string, CSV_TIME_FORMAT))
+
+    def test_time_parser(self):
+        time_parser = CSVTimeParser()
+        for time_stamp in range(1364000000, 1364200000, 997) + [0, 951825599]:
+            time_string = time.strftime(CSV_TIME_FORMAT, time.gmtime(time_stamp))
+            self.assertEqual(time_parser.parse(time_string), time_stamp)
+        # not the expected layout, falls back to strptime
+        self.assertEqual(time_parser.parse("2013-3-1 1:02:03"),
+                         self._reference("2013-3-1 1:02:03"))
+        self.assertRaises(ValueError, time_parser.parse, "2013-03-01 25:00:00")
+        self.assertRaises(ValueError, time_parser.parse, "2013-03-01 2x:00:00")
+
+    def test_columns(self):
+        data = "2013-03-01 00:00:06,350,18.3\n2013-03-01 00:00:12,420,18.5\n"
+        times, powers, temperatures = CSVParser().parse_columns(data)
+        expected = list(CSVParser().parse_msg(data))
+        self.assertEqual(list(times), [p.time for p in expected])
+        self.assertEqual(list(powers), [p.power for p in expected])
+        self.assertEqual(list(temperatures), [p.temperature for p in expected])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile, shutil, time, os
+
+from data_save import CsvDataSaver
+from parser import DataPoint
+from query import CsvArchive, read_index
+
+class CsvArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        # three days of data, starting at local midnight two days ago
+        today = time.localtime()[:3]
+        self._start = int(time.mktime(today + (0, 0, 0, 0, 0, -1))) - 2 * 86400
+        self._points = [DataPoint(time=self._start + 60 * i,
+                                  power=300 + i % 97,
+                                  temperature=15 + (i % 50) / 10.)
+                        for i in xrange(3 * 24 * 60)]
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _save(self, compress):
+        saver = CsvDataSaver(self._tempdir, compress=compress,
+                             index_interval=16, compressed_block_size=4096)
+        for point in self._points:
+            saver.update(point)
+        saver.close()
+
+    def _check(self, start, end):
+        archive = CsvArchive(self._tempdir)
+        expected = [(p.time, p.power, p.temperature) for p in self._points
+                    if start <= p.time < end]
+        self.assertEqual(list(archive.rows(start, end)), expected)
+
+        aggregates = archive.aggregate(start, end)
+        powers = [row[1] for row in expected]
+        self.assertEqual(aggregates['power'].count, len(expected))
+        self.assertEqual(aggregates['power'].min, min(powers))
+        self.assertEqual(aggregates['power'].max, max(powers))
+        self.assertEqual(aggregates['power'].sum, sum(powers))
+        self.assertAlmostEqual(aggregates['temperature'].avg,
+                               sum(row[2] for row in expected) / len(expected))
+
+    def _check_ranges(self):
+        hour = 3600
+        self._check(self._start + 14 * hour, self._start + 15 * hour)
+        self._check(self._start + 20 * hour + 30, self._start + 50 * hour)
+        self._check(self._start - hour, self._start + 72 * hour)
+
+    def test_plain(self):
+        self._save(compress=False)
+        times, offsets = read_index(self._tempdir + "/" + time.strftime(
+                CsvDataSaver.FILE_NAME_TEMPLATE, time.localtime(self._start))
+                + ".idx")
+        self.assertEqual(len(times), 24 * 60 / 16)
+        self._check_ranges()
+
+    def test_compressed(self):
+        self._save(compress=True)
+        times, offsets = read_index(self._tempdir + "/" + time.strftime(
+                CsvDataSaver.FILE_NAME_TEMPLATE, time.localtime(self._start))
+                + ".bz2.idx")
+        self.assertTrue(len(times) > 5)
+        self._check_ranges()
+
+    def test_pending(self):
+        # as left before or during their compression
+        self._save(compress=False)
+        for file_name in os.listdir(self._tempdir):
+            path = os.path.join(self._tempdir, file_name)
+            if file_name.endswith(CsvDataSaver.INDEX_SUFFIX):
+                os.remove(path)
+            else:
+                os.rename(path, path + ".1-1.pending")
+        self._check_ranges()
+
+if __name__ == '__main__':
+    unittest.main()
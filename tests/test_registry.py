@@ -0,0 +1,119 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+import registry
+from cucologger import CucoLogger, CucoLoggerConfigException, make_saver
+from data_save import DataSaver, QueuedDataSaver
+from simulator import SimulatedCC128
+
+class RecordingSaver(DataSaver):
+    def __init__(self, name="recording"):
+        self.name = name
+        self.powers = []
+
+    def update(self, data_point):
+        self.powers.append(data_point.power)
+
+SAVED = {}
+
+def recording_saver(name):
+    saver = SAVED[name] = RecordingSaver(name)
+    return saver
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self._savers = dict(registry.SAVERS)
+
+    def tearDown(self):
+        registry.SAVERS.clear()
+        registry.SAVERS.update(self._savers)
+        shutil.rmtree(self.tempdir)
+        SAVED.clear()
+
+    def test_registered_saver(self):
+        registry.register_saver("RecordingSaver", recording_saver)
+        config = {"savers": {"RecordingSaver": {"name": "mine"}}}
+        CucoLogger(config, source=SimulatedCC128(speed=0, count=3,
+                                                 hist_every=0)).run()
+        self.assertEqual(len(SAVED["mine"].powers), 3)
+
+    def test_queued(self):
+        registry.register_saver("RecordingSaver", recording_saver)
+        saver = make_saver("RecordingSaver", {"name": "queued"})
+        self.assertTrue(isinstance(saver, QueuedDataSaver))
+        saver.close()
+        saver = make_saver("RecordingSaver", {"name": "inline",
+                                              "queue": False})
+        self.assertTrue(saver is SAVED["inline"])
+        self.assertRaises(CucoLoggerConfigException, make_saver,
+                          "RecordingSaver", {"queue": 1000})
+
+    def test_module_reference(self):
+        saver = registry.saver_class("data_save:ThermostatSaver")
+        self.assertEqual(saver.__name__, "ThermostatSaver")
+        self.assertRaises(registry.RegistryError, registry.saver_class,
+                          "data_save:NoSuchSaver")
+        self.assertRaises(registry.RegistryError, registry.saver_class,
+                          "no_such_module:Saver")
+        self.assertRaises(registry.RegistryError, registry.register_saver,
+                          "Broken", "no_class")
+
+    def test_checked_first(self):
+        directory = os.path.join(self.tempdir, "csv")
+        for config in (
+                {"savers": {"CsvDataSaver": {"directory": directory},
+                            "NoSuchSaver": {}}},
+                {"savers": {"CsvDataSaver": {"directory": directory}},
+                 "parser": "regexp"},
+                {"savers": {"CsvDataSaver": {"directory": directory}},
+                 "source": {"type": "carrier-pigeon"}},
+                {"savers": {"CsvDataSaver": {"directory": directory,
+                                             "queue": {"overflow": "spill"}}}},
+                {"savers": {"CsvDataSaver": {"directory": directory,
+                                             "queue": False}},
+                 "backfill": {}},
+                ):
+            self.assertRaises(CucoLoggerConfigException, CucoLogger, config,
+                              [])
+            # no saver was created
+            self.assertFalse(os.path.exists(directory))
+
+    def test_source(self):
+        config = {"savers": {"data_save:DataSaver": {}},
+                  "source": {"type": "simulator", "speed": 0, "count": 2}}
+        logger = CucoLogger(config)
+        self.assertEqual(len(list(logger._source)), 2)
+        config['source']['colour'] = "red"
+        self.assertRaises(CucoLoggerConfigException, CucoLogger, config)
+
+    def test_lazy_imports(self):
+        # in a new interpreter, nothing imported them yet
+        code = ("import sys, cucologger, data_save, parser\n"
+                "print ' '.join(sorted(set(['rrdtool', 'bz2', 'bs4', 'serial',"
+                " 'serial_tools', 'archive', 'rollup', 'spool'])"
+                " & set(sys.modules)))\n")
+        directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=directory)
+        self.assertEqual(output.strip(), "")
+
+if __name__ == '__main__':
+    unittest.main()
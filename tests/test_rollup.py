@@ -0,0 +1,134 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import tempfile, shutil, os
+
+from parser import DataPoint, DataPointBatch
+from rollup import RollupDataSaver, Window, read_rollups
+
+# a Monday, midnight UTC
+START = 1370217600
+
+class RecordingSink(object):
+    def __init__(self):
+        self.windows = []
+
+    def emit(self, name, window):
+        self.windows.append((name, window))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def points(times, power=600, temperature=20.0):
+    return DataPointBatch.from_data_points(
+            [DataPoint(time=t, power=power, temperature=temperature)
+             for t in times])
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_window(self):
+        window = Window(0)
+        for power, temperature in ((100, 20.0), (300, 19.0), (200, 21.0)):
+            window.add(power, temperature, power / 600.)
+        self.assertEqual((window.count, window.power_min, window.power_max),
+                         (3, 100, 300))
+        self.assertEqual(window.power_mean, 200)
+        self.assertEqual((window.temperature_min, window.temperature_max),
+                         (19.0, 21.0))
+        self.assertAlmostEqual(window.energy, 1.0)
+
+    def test_minutes(self):
+        sink = RecordingSink()
+        saver = RollupDataSaver(self._tempdir, resolutions=["1m", "1h"],
+                                allowed_lateness=0, sinks=[sink])
+        # two hours of data every 6 seconds at 600W
+        saver.update_many(points(range(START, START + 7200, 6)))
+        saver.update(DataPoint(time=START + 7200, power=0, temperature=20.0))
+        minutes = [window for name, window in sink.windows if name == "1m"]
+        hours = [window for name, window in sink.windows if name == "1h"]
+        self.assertEqual(len(minutes), 120)
+        self.assertEqual(minutes[0].start, START)
+        self.assertEqual(minutes[0].count, 10)
+        self.assertEqual(len(hours), 2)
+        # 600W for an hour
+        self.assertAlmostEqual(hours[0].energy, 600.0)
+        self.assertEqual(hours[1].count, 600)
+
+    def test_late(self):
+        sink = RecordingSink()
+        saver = RollupDataSaver(self._tempdir, resolutions=["1m"],
+                                allowed_lateness=30, sinks=[sink])
+        saver.update_many(points([START, START + 6, START + 66]))
+        # still within the allowed lateness
+        saver.update_many(points([START + 12, START + 90]))
+        self.assertEqual([window.count for name, window in sink.windows], [3])
+        # too late
+        saver.update_many(points([START + 18]))
+        self.assertEqual(saver.late, 1)
+
+    def test_restart(self):
+        saver = RollupDataSaver(self._tempdir, resolutions=["10m"],
+                                allowed_lateness=0)
+        saver.update_many(points(range(START, START + 300, 6)))
+        saver.close()
+        saver = RollupDataSaver(self._tempdir, resolutions=["10m"],
+                                allowed_lateness=0)
+        saver.update_many(points(range(START + 300, START + 606, 6)))
+        saver.close()
+        rows = list(read_rollups(self._tempdir, "10m", START, START + 86400))
+        self.assertEqual(len(rows), 1)
+        start, count, power_min, power_max, power_mean, energy = rows[0][:6]
+        self.assertEqual((start, count, power_min, power_max),
+                         (START, 100, 600, 600))
+        self.assertAlmostEqual(energy, 100.0)
+
+    def test_crash(self):
+        saver = RollupDataSaver(self._tempdir, resolutions=["1m"],
+                                allowed_lateness=0)
+        saver.update_many(points(range(START, START + 300, 6)))
+        state_path = os.path.join(self._tempdir, RollupDataSaver.STATE_FILE)
+        stale_state = open(state_path).read()
+        saver.update_many(points(range(START + 300, START + 600, 6)))
+        # killed before saving the state of the windows just written, and in
+        # the middle of a line
+        open(state_path, "w").write(stale_state)
+        open(os.path.join(self._tempdir, "rollup.1m.csv"), "a").write("2013-")
+
+        saver = RollupDataSaver(self._tempdir, resolutions=["1m"],
+                                allowed_lateness=0)
+        # given again by a spool, with what comes next
+        saver.update_many(points(range(START + 300, START + 726, 6)))
+        saver.close()
+        rows = list(read_rollups(self._tempdir, "1m", START, START + 86400))
+        self.assertEqual([row[0] for row in rows], range(START, START + 720, 60))
+        self.assertEqual([row[1] for row in rows], [10] * 12)
+
+    def test_bad_resolution(self):
+        self.assertRaises(ValueError, RollupDataSaver, self._tempdir,
+                          resolutions=["1w"])
+
+if __name__ == '__main__':
+    unittest.main()
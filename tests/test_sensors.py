@@ -0,0 +1,229 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, time, calendar
+
+from parser import CC128Parser, CC128StreamParser, CSVParser
+from parser import DataPoint, DataPointBatch
+from data_save import CsvDataSaver, SensorFilterSaver
+from query import CsvArchive
+from spool import pack_batch, unpack_batch
+from test_data_save import BlockedDataSaver
+
+MESSAGES = [
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:39</time>"
+    "<tmpr>18.7</tmpr><sensor>1</sensor><id>01234</id><type>1</type>"
+    "<ch1><watts>00345</watts></ch1><ch2><watts>02151</watts></ch2>"
+    "<ch3><watts>00000</watts></ch3></msg>\r\n",
+    # history message, ignored
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:42</time>"
+    "<hist><dsw>00032</dsw><type>1</type><units>kwhr</units><data>"
+    "<sensor>0</sensor><h024>001.1</h024></data></hist></msg>\r\n",
+    "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:48</time>"
+    "<tmpr>18.8</tmpr><sensor>0</sensor><id>01234</id><type>1</type>"
+    "<ch1><watts>00350</watts></ch1></msg>\r\n",
+]
+
+def make_batch(rows):
+    """
+    rows are (time, sensor, channels) tuples.
+    """
+    return DataPointBatch.from_data_points(
+            [DataPoint(time_stamp, sum(channels), 18.5, sensor=sensor,
+                       channels=channels)
+             for time_stamp, sensor, channels in rows])
+
+class ParserTest(unittest.TestCase):
+    def _parse(self, parser):
+        points = []
+        for message in MESSAGES:
+            points.extend(parser.parse_msg(message))
+        return [(point.time, point.power, point.temperature, point.sensor,
+                 point.channels) for point in points]
+
+    def test_stream(self):
+        self.assertEqual(self._parse(CC128StreamParser(sensors=True)),
+                         [("13:02:39", 2496, 18.7, 1, (345, 2151, 0)),
+                          ("13:02:48", 350, 18.8, 0, (350, 0, 0))])
+
+    def test_same_as_bs4(self):
+        self.assertEqual(self._parse(CC128StreamParser(sensors=True)),
+                         self._parse(CC128Parser(sensors=True)))
+
+    def test_bad_channel(self):
+        parser = CC128StreamParser(sensors=True)
+        for number in (0, 4):
+            message = MESSAGES[2].replace("ch1>", "ch%d>" % number)
+            self.assertEqual(list(parser.parse_msg(message)), [])
+        self.assertEqual(parser.malformed, 2)
+
+    def test_legacy(self):
+        # without sensors, the first channel of every sensor as before
+        self.assertEqual([row[:4] for row in self._parse(CC128StreamParser())],
+                         [("13:02:39", 345, 18.7, None),
+                          ("13:02:48", 350, 18.8, None)])
+
+class BatchTest(unittest.TestCase):
+    def test_mixed(self):
+        sensor_point = DataPoint(1, 100, 18.5, sensor=0, channels=(100, 0, 0))
+        plain_point = DataPoint(2, 200, 18.5)
+        for data_points in ([sensor_point, plain_point],
+                            [plain_point, sensor_point]):
+            self.assertRaises(ValueError, DataPointBatch.from_data_points,
+                              data_points)
+        batch = DataPointBatch.from_data_points([sensor_point])
+        self.assertRaises(ValueError, batch.append, plain_point)
+        self.assertRaises(ValueError, batch.extend,
+                          DataPointBatch.from_data_points([plain_point]))
+        # nothing half appended
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(len(batch.sensors), 1)
+        self.assertEqual([(point.time, point.sensor, point.channels)
+                          for point in batch], [(1, 0, (100, 0, 0))])
+
+    def test_by_sensor(self):
+        batch = make_batch([(1, 0, (100, 0, 0)), (1, 2, (5, 6, 7)),
+                            (7, 0, (110, 0, 0)), (7, 2, (8, 9, 10))])
+        batches = batch.by_sensor()
+        self.assertEqual(sorted(batches), [0, 2])
+        self.assertEqual(list(batches[0].powers), [100, 110])
+        self.assertEqual([point.channels for point in batches[2]],
+                         [(5, 6, 7), (8, 9, 10)])
+        self.assertEqual(batch[1:3][0].sensor, 2)
+        self.assertEqual(batch[3].channels, (8, 9, 10))
+
+    def test_filter(self):
+        batch = make_batch([(1, 0, (100, 0, 0)), (1, 2, (5, 6, 7))])
+        blocked = BlockedDataSaver()
+        blocked.unblock.set()
+        SensorFilterSaver(blocked, 2).update_many(batch)
+        self.assertEqual(blocked.saved, [18])
+        legacy = BlockedDataSaver()
+        legacy.unblock.set()
+        saver = SensorFilterSaver(legacy, 0)
+        saver.update_many(batch)
+        saver.update(DataPoint(time=3, power=120, temperature=18.5))
+        self.assertEqual(legacy.saved, [100, 120])
+
+    def test_spool(self):
+        batch = make_batch([(1000, 0, (100, 0, 0)), (1000, 3, (1, 2, 3))])
+        batch.device = u"kitchen"
+        unpacked = unpack_batch(pack_batch(batch)[8:])
+        self.assertEqual([(point.time, point.power, point.sensor,
+                           point.channels, point.device)
+                          for point in unpacked],
+                         [(1000, 100, 0, (100, 0, 0), u"kitchen"),
+                          (1000, 6, 3, (1, 2, 3), u"kitchen")])
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._start = calendar.timegm((2013, 3, 23, 12, 0, 0))
+        self._rows = []
+        for i in xrange(20):
+            time_stamp = self._start + 6 * i
+            self._rows.append((time_stamp, 0, (300 + i, 0, 0)))
+            self._rows.append((time_stamp, 1, (i, 2 * i, 3 * i)))
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_csv(self):
+        saver = CsvDataSaver(self._tempdir)
+        saver.update_many(make_batch(self._rows[:10]))
+        for point in make_batch(self._rows[10:]):
+            saver.update(point)
+        saver.close()
+        file_name, = [name for name in os.listdir(self._tempdir)
+                      if name.endswith(".csv")]
+        data = open(os.path.join(self._tempdir, file_name)).read()
+        batch = CSVParser().parse_batch(data)
+        self.assertEqual([(point.time, point.sensor, point.channels)
+                          for point in batch], self._rows)
+
+        archive = CsvArchive(self._tempdir)
+        self.assertEqual([row[1] for row in archive.rows(self._start,
+                                                         self._start + 60)],
+                         range(300, 310))
+        rows = list(CsvArchive(self._tempdir, sensor=1).rows(self._start,
+                                                             self._start + 60))
+        self.assertEqual([row[1] for row in rows],
+                         [6 * i for i in xrange(10)])
+
+    def test_csv_legacy_rows(self):
+        saver = CsvDataSaver(self._tempdir)
+        saver.update(DataPoint(self._start, 290, 18.5))
+        saver.update_many(make_batch(self._rows[:2]))
+        saver.close()
+        file_name, = [name for name in os.listdir(self._tempdir)
+                      if name.endswith(".csv")]
+        data = open(os.path.join(self._tempdir, file_name)).read()
+        self.assertEqual([(point.power, point.sensor, point.channels)
+                          for point in CSVParser().parse_batch(data)],
+                         [(290, 0, (290, 0, 0)), (300, 0, (300, 0, 0)),
+                          (0, 1, (0, 0, 0))])
+
+    def test_csv_swing_door(self):
+        saver = CsvDataSaver(self._tempdir, swing_door={'power': 5})
+        self.assertRaises(ValueError, saver.update_many,
+                          make_batch(self._rows[:2]))
+
+    def test_rrd(self):
+        from data_save import RrdDataSaver
+        saver = RrdDataSaver(self._tempdir, batch_size=100)
+        saver.update_many(make_batch(self._rows))
+        # sensor 0 also goes to the power and temperature files
+        self.assertEqual(saver._pending_count(), 20 + 2 * 20)
+        saver.close()
+        self.assertEqual(sorted(os.listdir(self._tempdir)),
+                         ["power.rrd", "sensor0.rrd", "sensor1.rrd",
+                          "temperature.rrd"])
+
+class LoggerTest(unittest.TestCase):
+    def test_config(self):
+        from cucologger import CucoLogger, CucoLoggerConfigException
+        from simulator import make_message
+        tempdir = tempfile.mkdtemp()
+        try:
+            config = {
+                "sensors": True,
+                "savers": {"CsvDataSaver": {"directory": tempdir},
+                           "RollupDataSaver": {
+                               "directory": os.path.join(tempdir, "rollup")}},
+                }
+            now = int(time.time())
+            messages = [make_message(now, 300, 18.0),
+                        make_message(now, 40, 18.0, sensor=2)]
+            logger = CucoLogger(config, source=messages)
+            logger.run()
+            lines = [line for file_name in os.listdir(tempdir)
+                     if file_name.endswith(".csv")
+                     for line in open(os.path.join(tempdir, file_name))]
+            self.assertEqual([line.split(",")[3] for line in lines],
+                             ["0", "2"])
+
+            del config['sensors']
+            self.assertRaises(CucoLoggerConfigException, CucoLogger,
+                    dict(config, savers={"CsvDataSaver": {
+                            "directory": tempdir, "sensor": 2}}),
+                    source=[])
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
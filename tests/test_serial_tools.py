@@ -0,0 +1,196 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import os, threading, tty, time, signal
+
+from serial_tools import CC128Source, MultiCC128Source
+
+MESSAGE = ("<msg><src>CC128-v0.11</src><time>13:02:39</time><tmpr>18.7</tmpr>"
+           "<ch1><watts>00345</watts></ch1></msg>")
+
+class PtyOpener(object):
+    """
+    Opens the slave side of a new pty each time it is called.
+    """
+    def __init__(self):
+        self.masters = []
+        self.opened = threading.Event()
+
+    def __call__(self):
+        master, slave = os.openpty()
+        # like pyserial does
+        tty.setraw(slave)
+        self.masters.append(master)
+        self.opened.set()
+        return os.fdopen(slave, "rb")
+
+    def write(self, data):
+        os.write(self.masters[-1], data)
+
+class CC128SourceTest(unittest.TestCase):
+    def test_frames(self):
+        opener = PtyOpener()
+        source = CC128Source(opener=opener)
+        frames = iter(source)
+        # open happens on the first read
+        writer = threading.Timer(0.1, opener.write,
+                                 [MESSAGE + "\r\n" + MESSAGE[:20]])
+        writer.start()
+        self.assertEqual(frames.next(), MESSAGE)
+        opener.write(MESSAGE[20:] + "\r\n")
+        self.assertEqual(frames.next(), MESSAGE)
+        source.close()
+        os.close(opener.masters[-1])
+
+    def test_reconnect(self):
+        opener = PtyOpener()
+        source = CC128Source(opener=opener, reconnect_interval=0.01)
+        frames = iter(source)
+        threading.Timer(0.1, opener.write, [MESSAGE]).start()
+        self.assertEqual(frames.next(), MESSAGE)
+
+        # like an unplugged device: reads fail
+        opener.opened.clear()
+        os.close(opener.masters[-1])
+        def write_when_reopened():
+            opener.opened.wait(5)
+            opener.write(MESSAGE)
+        threading.Thread(target=write_when_reopened).start()
+        self.assertEqual(frames.next(), MESSAGE)
+        self.assertEqual(source.reconnections, 1)
+        source.close()
+        os.close(opener.masters[-1])
+
+    def test_silence(self):
+        opener = PtyOpener()
+        source = CC128Source(opener=opener, silence_timeout=0.1,
+                             reconnect_interval=0.01)
+        frames = iter(source)
+        def write_on_second_open():
+            while len(opener.masters) < 2:
+                opener.opened.wait(5)
+                opener.opened.clear()
+            opener.write(MESSAGE)
+        threading.Thread(target=write_on_second_open).start()
+        self.assertEqual(frames.next(), MESSAGE)
+        self.assertTrue(source.reconnections >= 1)
+        source.close()
+        for master in opener.masters:
+            os.close(master)
+
+    def test_stop(self):
+        opener = PtyOpener()
+        source = CC128Source(opener=opener)
+        frames = iter(source)
+        threading.Timer(0.1, opener.write, [MESSAGE + "\r\n"]).start()
+        self.assertEqual(frames.next(), MESSAGE)
+        # from a signal handler, while waiting for data
+        previous = signal.signal(signal.SIGALRM,
+                                 lambda signum, frame: source.stop())
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.1)
+            start = time.time()
+            self.assertEqual(list(frames), [])
+            self.assertTrue(time.time() - start < 0.5)
+        finally:
+            signal.signal(signal.SIGALRM, previous)
+        source.close()
+        os.close(opener.masters[-1])
+
+    def test_serial_port(self):
+        # through pyserial, on a pty instead of the real device
+        master, slave = os.openpty()
+        source = CC128Source(port=os.ttyname(slave))
+        frames = iter(source)
+        threading.Timer(0.1, os.write, [master, MESSAGE + "\r\n"]).start()
+        self.assertEqual(frames.next(), MESSAGE)
+        source.close()
+        os.close(master)
+        os.close(slave)
+
+class PortPtyOpener(object):
+    """
+    Opens the slave side of a new pty for each port.
+    """
+    def __init__(self):
+        self.masters = {}
+
+    def __call__(self, port):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.masters[port] = master
+        return os.fdopen(slave, "rb")
+
+class MultiCC128SourceTest(unittest.TestCase):
+    def test_frames(self):
+        opener = PortPtyOpener()
+        source = MultiCC128Source({"kitchen": "port1", "garage": "port2"},
+                                  opener=opener)
+        frames = iter(source)
+        # devices are opened on the first read
+        writer = threading.Timer(0.1, lambda: (
+                os.write(opener.masters["port1"], MESSAGE + "\r\n"),
+                os.write(opener.masters["port2"], MESSAGE[:20])))
+        writer.start()
+        self.assertEqual(frames.next(), ("kitchen", MESSAGE))
+        os.write(opener.masters["port2"], MESSAGE[20:] + "\r\n")
+        self.assertEqual(frames.next(), ("garage", MESSAGE))
+        self.assertEqual(source.devices(), ["garage", "kitchen"])
+        source.close()
+        for master in opener.masters.values():
+            os.close(master)
+
+    def test_reconnect(self):
+        opener = PortPtyOpener()
+        source = MultiCC128Source({"kitchen": "port1", "garage": "port2"},
+                                  reconnect_interval=0.1, opener=opener)
+        frames = iter(source)
+        writer = threading.Timer(0.1, lambda: (
+                os.close(opener.masters.pop("port1")),
+                os.write(opener.masters["port2"], MESSAGE + "\r\n")))
+        writer.start()
+        self.assertEqual(frames.next(), ("garage", MESSAGE))
+        # kitchen is reopened while garage keeps going
+        time.sleep(0.3)
+        os.write(opener.masters["port2"], MESSAGE + "\r\n")
+        self.assertEqual(frames.next(), ("garage", MESSAGE))
+        os.write(opener.masters["port1"], MESSAGE + "\r\n")
+        self.assertEqual(frames.next(), ("kitchen", MESSAGE))
+        self.assertEqual(source.reconnections, 1)
+        source.close()
+        for master in opener.masters.values():
+            os.close(master)
+
+    def test_stop(self):
+        opener = PortPtyOpener()
+        source = MultiCC128Source({"kitchen": "port1"}, opener=opener)
+        frames = iter(source)
+        # the device is opened on the first read
+        threading.Timer(0.1, lambda: os.write(opener.masters["port1"],
+                                              MESSAGE + "\r\n")).start()
+        self.assertEqual(frames.next(), ("kitchen", MESSAGE))
+        threading.Timer(0.1, source.stop).start()
+        start = time.time()
+        self.assertEqual(list(frames), [])
+        self.assertTrue(time.time() - start < 2)
+        source.close()
+        os.close(opener.masters["port1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, time
+
+from parser import CC128StreamParser, CC128StreamLiveParser, IteratorLogger
+from serial_tools import CC128Source
+from simulator import SimulatedCC128, ReplaySource, serve_on_pty
+from cucologger import CucoLogger
+
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_simulated_messages(self):
+        messages = list(SimulatedCC128(speed=0, count=20, seed=1,
+                                       hist_every=10))
+        # two history messages
+        self.assertEqual(len(messages), 22)
+        data_points = [data_point for message in messages
+                       for data_point in CC128StreamParser().parse_msg(message)]
+        self.assertEqual(len(data_points), 20)
+        for data_point in data_points:
+            self.assertTrue(data_point.power >= 150)
+            self.assertTrue(10 < data_point.temperature < 30)
+
+    def test_speed(self):
+        start = time.time()
+        list(SimulatedCC128(speed=60, count=6, period=6))
+        # 5 periods of 6 seconds, 60 times faster
+        self.assertTrue(0.4 < time.time() - start < 2)
+
+    def test_replay_logged(self):
+        log_path = os.path.join(self._tempdir, "capture.log")
+        messages = list(SimulatedCC128(speed=0, count=5, seed=2))
+        for message in IteratorLogger(messages, log_path):
+            pass
+        self.assertEqual(list(ReplaySource(log_path, speed=0)), messages)
+
+    def test_pty(self):
+        messages = list(SimulatedCC128(speed=0, count=5, seed=3))
+        path, thread = serve_on_pty(messages)
+        source = CC128Source(opener=lambda: open(path, "rb"))
+        frames = iter(source)
+        received = [frames.next() for message in messages]
+        source.close()
+        self.assertEqual(received, messages)
+
+    def test_logger_with_source(self):
+        directory = os.path.join(self._tempdir, "csv")
+        config = {"savers": {"CsvDataSaver": {"directory": directory}}}
+        messages = SimulatedCC128(speed=0, count=50, seed=4)
+        CucoLogger(config, source=messages).run()
+        lines = []
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".csv"):
+                lines.extend(open(os.path.join(directory, file_name)))
+        self.assertEqual(len(lines), 50)
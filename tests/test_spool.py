@@ -0,0 +1,236 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os, tempfile, shutil, threading, time
+
+from data_save import DataSaver, QueuedDataSaver
+from parser import DataPoint, DataPointBatch
+from spool import Spool, SpoolingDataSaver, pack_batch, unpack_batch
+
+def make_batch(times, device=None):
+    return DataPointBatch.from_data_points(
+            [DataPoint(time=t, power=t % 1000, temperature=t / 10.)
+             for t in times], device)
+
+def rows(batch):
+    return [(p.time, p.power, p.temperature, p.device) for p in batch]
+
+class RecordingSaver(DataSaver):
+    """
+    Keeps what it was given, only considering it saved once flushed.
+    """
+    def __init__(self):
+        self.given = []
+        self.saved = []
+        self.fail = False
+
+    def update_many(self, batch):
+        if self.fail:
+            raise IOError("disk full")
+        self.given.extend(point.time for point in batch)
+
+    def flush(self):
+        if self.fail:
+            raise IOError("disk full")
+        self.saved.extend(self.given)
+        self.given = []
+
+class SlowFlushSaver(RecordingSaver):
+    def __init__(self):
+        RecordingSaver.__init__(self)
+        self.unblock = threading.Event()
+
+    def flush(self):
+        self.unblock.wait()
+        RecordingSaver.flush(self)
+
+class SlowSaver(RecordingSaver):
+    def update_many(self, batch):
+        time.sleep(0.005)
+        RecordingSaver.update_many(self, batch)
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_pack(self):
+        batch = make_batch([1000, 1006], u"kitchen")
+        record = pack_batch(batch)
+        self.assertEqual(rows(unpack_batch(record[8:])), rows(batch))
+        self.assertEqual(unpack_batch(pack_batch(make_batch([1]))[8:]).device,
+                         None)
+
+    def test_read(self):
+        spool = Spool(self._tempdir)
+        spool.append(make_batch([1, 2]))
+        middle = spool.append(make_batch([3]))
+        spool.append(make_batch([4], "garage"))
+        end = spool.append(make_batch([5, 6]))
+        spool.close()
+        spool = Spool(self._tempdir)
+        batches = list(spool.read(0))
+        # same device ones are merged
+        self.assertEqual([[p.time for p in batch] for end, batch in batches],
+                         [[1, 2, 3], [4], [5, 6]])
+        self.assertEqual(batches[-1][0], end)
+        self.assertEqual([batch.times.tolist()
+                          for end, batch in spool.read(middle)], [[4], [5, 6]])
+        self.assertEqual([batch.times.tolist()
+                          for end, batch in spool.read(0, batch_size=2)],
+                         [[1, 2], [3], [4], [5, 6]])
+        spool.close()
+
+    def test_torn_write(self):
+        spool = Spool(self._tempdir)
+        spool.append(make_batch([1]))
+        end = spool.append(make_batch([2]))
+        spool.close()
+        segment_path = os.path.join(self._tempdir, os.listdir(self._tempdir)[0])
+        segment = open(segment_path, "ab")
+        segment.write(pack_batch(make_batch([3]))[:-4])
+        segment.close()
+        spool = Spool(self._tempdir)
+        self.assertEqual(spool.end, end)
+        self.assertEqual(os.path.getsize(segment_path), end)
+        spool.append(make_batch([4]))
+        self.assertEqual([batch.times.tolist() for e, batch in spool.read(0)],
+                         [[1, 2, 4]])
+        spool.close()
+
+    def test_segments(self):
+        spool = Spool(self._tempdir, segment_size=100)
+        offsets = [spool.append(make_batch([t])) for t in xrange(20)]
+        self.assertTrue(len(spool.segments()) > 3)
+        self.assertEqual(len(list(spool.read(0, batch_size=1))), 20)
+        spool.truncate(offsets[10])
+        first = spool.segments()[0]
+        self.assertTrue(0 < first <= offsets[10])
+        self.assertEqual(list(spool.read(offsets[10]))[0][1].times[0], 11)
+        spool.close()
+
+class SpoolingDataSaverTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_crash_replay(self):
+        saver = RecordingSaver()
+        spooling = SpoolingDataSaver(Spool(self._tempdir), [("recording", saver)],
+                                     ack_interval=3600)
+        for t in xrange(5):
+            spooling.update_many(make_batch([t]))
+        spooling.flush()
+        for t in xrange(5, 10):
+            spooling.update_many(make_batch([t]))
+        self.assertEqual(saver.saved, range(5))
+        # killed: what was not flushed is lost by the saver, not the spool
+        saver = RecordingSaver()
+        spooling = SpoolingDataSaver(Spool(self._tempdir), [("recording", saver),
+                                     ("new", RecordingSaver())])
+        self.assertEqual(saver.given, range(5, 10))
+        spooling.update_many(make_batch([10]))
+        spooling.close()
+        self.assertEqual(saver.saved, range(5, 11))
+
+    def test_replay_not_dropped(self):
+        spooling = SpoolingDataSaver(Spool(self._tempdir),
+                                     [("slow", RecordingSaver())])
+        for t in xrange(20):
+            spooling.update_many(make_batch([t]))
+        # killed before acknowledging any of it
+        saver = SlowSaver()
+        queued = QueuedDataSaver(saver, size=2, overflow="drop-oldest")
+        spooling = SpoolingDataSaver(Spool(self._tempdir), [("slow", queued)],
+                                     replay_batch_size=1)
+        spooling.close()
+        self.assertEqual(queued.dropped, 0)
+        self.assertEqual(saver.saved, range(20))
+
+    def test_failing_saver(self):
+        good, bad = RecordingSaver(), RecordingSaver()
+        spooling = SpoolingDataSaver(Spool(self._tempdir),
+                                     [("good", good), ("bad", bad)],
+                                     ack_interval=3600, retry_interval=0)
+        spooling.update_many(make_batch([0]))
+        bad.fail = True
+        spooling.update_many(make_batch([1]))
+        spooling.update_many(make_batch([2]))
+        bad.fail = False
+        # retried with everything since it last acknowledged
+        spooling.update_many(make_batch([3]))
+        spooling.update_many(make_batch([4]))
+        spooling.close()
+        self.assertEqual(good.saved, range(5))
+        # 0 was given again, it had not been acknowledged
+        self.assertEqual(bad.saved, [0] + range(5))
+
+    def test_queued_ack(self):
+        saver = SlowFlushSaver()
+        spool = Spool(self._tempdir)
+        spooling = SpoolingDataSaver(spool, [("slow", QueuedDataSaver(saver))],
+                                     ack_interval=0)
+        start = time.time()
+        for t in xrange(5):
+            spooling.update_many(make_batch([t]))
+        # not waiting for the flushes
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(spool.acked("slow"), 0)
+        saver.unblock.set()
+        for i in xrange(100):
+            time.sleep(0.01)
+            spooling.update_many(make_batch([5 + i]))
+            if spool.acked("slow") > 0:
+                break
+        self.assertTrue(spool.acked("slow") > 0)
+        spooling.close()
+        self.assertEqual(spool.acked("slow"), spool.end)
+
+    def test_truncate(self):
+        saver = RecordingSaver()
+        spool = Spool(self._tempdir, segment_size=100)
+        spooling = SpoolingDataSaver(spool, [("recording", saver)],
+                                     ack_interval=3600)
+        for t in xrange(50):
+            spooling.update_many(make_batch([t]))
+        self.assertTrue(len(spool.segments()) > 3)
+        spooling.flush()
+        # only the one being written is left
+        self.assertEqual(len(spool.segments()), 1)
+        spooling.close()
+
+class QueuedSyncTest(unittest.TestCase):
+    def test_sync(self):
+        saver = RecordingSaver()
+        queued = QueuedDataSaver(saver)
+        queued.update_many(make_batch([1, 2]))
+        queued.sync()
+        self.assertEqual(saver.saved, [1, 2])
+        saver.fail = True
+        queued.update_many(make_batch([3]))
+        self.assertRaises(RuntimeError, queued.sync)
+        saver.fail = False
+        queued.sync()
+        queued.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# Copyright 2013 Guillaume Emont <guij@emont.org>
+#
+# This file is part of CucoLogger
+#
+# CucoLogger is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import socket, json, time, os, threading
+
+from data_save import ThermostatSaver
+from parser import DataPoint
+
+class FakeThermostat(object):
+    def __init__(self):
+        self.port = 0
+        self.listen()
+        self._connection = None
+        self._data = ""
+
+    def listen(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', self.port))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+
+    def stop_listening(self):
+        self._server.close()
+
+    def accept(self):
+        self._server.settimeout(5)
+        self._connection, address = self._server.accept()
+        self._connection.settimeout(0.2)
+
+    def receive(self):
+        """
+        Return the temperatures received until nothing comes for a while.
+        """
+        while True:
+            try:
+                data = self._connection.recv(4096)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            self._data += data
+        lines = self._data.split("\n")
+        self._data = lines.pop()
+        return [json.loads(line)["current_temperature"] for line in lines]
+
+    def drop_connection(self):
+        self._connection.close()
+        self._connection = None
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+        self._server.close()
+
+def data_point(temperature):
+    return DataPoint(time=int(time.time()), power=300, temperature=temperature)
+
+class StuckThermostatSaver(ThermostatSaver):
+    """
+    Its thread is stuck connecting until released.
+    """
+    def __init__(self, *args, **kwargs):
+        self.connecting = threading.Event()
+        self.released = threading.Event()
+        ThermostatSaver.__init__(self, *args, **kwargs)
+
+    def _connect(self):
+        self.connecting.set()
+        self.released.wait()
+        ThermostatSaver._connect(self)
+
+class ThermostatSaverTest(unittest.TestCase):
+    def setUp(self):
+        self._thermostat = FakeThermostat()
+
+    def tearDown(self):
+        self._thermostat.close()
+
+    def test_deadband(self):
+        saver = ThermostatSaver(port=self._thermostat.port, deadband=0.5)
+        self._thermostat.accept()
+        for temperature in (18.0, 18.2, 18.4, 18.6, 18.7):
+            saver.update(data_point(temperature))
+            time.sleep(0.05)
+        self.assertEqual(self._thermostat.receive(), ["18.0", "18.6"])
+        saver.close()
+
+    def test_latest_only(self):
+        saver = ThermostatSaver(port=self._thermostat.port, min_interval=0.5)
+        self._thermostat.accept()
+        saver.update(data_point(18.0))
+        time.sleep(0.1)
+        for temperature in (19.0, 20.0, 21.0):
+            saver.update(data_point(temperature))
+        time.sleep(0.6)
+        self.assertEqual(self._thermostat.receive(), ["18.0", "21.0"])
+        saver.close()
+
+    def test_reconnect(self):
+        saver = ThermostatSaver(port=self._thermostat.port,
+                                initial_backoff=0.05)
+        self._thermostat.accept()
+        saver.update(data_point(18.0))
+        self.assertEqual(self._thermostat.receive(), ["18.0"])
+        # the saver cannot reconnect, and send 18.0 again, before the updates
+        # below
+        self._thermostat.stop_listening()
+        self._thermostat.drop_connection()
+        # does not block while disconnected
+        start = time.time()
+        for i in xrange(100):
+            saver.update(data_point(19.0))
+        self.assertTrue(time.time() - start < 0.1)
+        self._thermostat.listen()
+        self._thermostat.accept()
+        # the latest temperature is sent again on the new connection
+        self.assertEqual(self._thermostat.receive(), ["19.0"])
+        self.assertEqual(saver.connections, 2)
+        saver.close()
+
+    def test_idle(self):
+        saver = ThermostatSaver(port=self._thermostat.port, min_interval=0.1,
+                                max_interval=None)
+        self._thermostat.accept()
+        saver.update(data_point(18.0))
+        self.assertEqual(self._thermostat.receive(), ["18.0"])
+        # nothing left to send: the sender must sleep rather than spin
+        start = os.times()
+        time.sleep(1)
+        for temperature in (18.0, 18.0):
+            saver.update(data_point(temperature))
+        time.sleep(1)
+        end = os.times()
+        cpu_time = (end[0] + end[1]) - (start[0] + start[1])
+        self.assertTrue(cpu_time < 0.2, cpu_time)
+        self.assertEqual(self._thermostat.receive(), [])
+        saver.close()
+
+    def test_no_thermostat(self):
+        port = self._thermostat.port
+        self._thermostat.close()
+        saver = ThermostatSaver(port=port)
+        start = time.time()
+        saver.update(data_point(18.0))
+        saver.close()
+        self.assertTrue(time.time() - start < 1)
+
+    def test_close_stuck(self):
+        saver = StuckThermostatSaver(port=self._thermostat.port,
+                                     close_timeout=0.1)
+        saver.connecting.wait(5)
+        saver.close()
+        # the thread still has its wake pipe
+        os.fstat(saver._wake_reader)
+        os.fstat(saver._wake_writer)
+        saver.released.set()
+        saver._thread.join(5)
+        self.assertFalse(saver._thread.is_alive())
+        self.assertRaises(OSError, os.fstat, saver._wake_reader)
+
+if __name__ == '__main__':
+    unittest.main()